@@ -0,0 +1,126 @@
+import argparse
+import configparser
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.append(os.path.join(os.getcwd(), "src"))
+sys.path.append(os.path.join(os.getcwd(), "bench"))
+from generate_data import generate
+from backends import connect
+from instrumentation import InstrumentedCursor, RunReport
+from create_tables import reset_schema
+from etl import load_staging_tables, insert_tables
+from dq_check import table_validation
+
+
+def local_config(data_dir, database):
+    """
+    Builds a dwh.cfg configuration that runs the pipeline on the local engine against a
+    generated data set.
+
+    Args:
+        data_dir (string): output directory of generate_data.generate
+        database (string): DuckDB database file for the run
+    """
+
+    config = configparser.ConfigParser()
+    config.read("dwh.cfg")
+
+    config["BACKEND"] = {"engine": "local"}
+    config["LOCAL"] = {
+        "database": database,
+        "log_data": os.path.join(data_dir, "log_data"),
+        "log_jsonpath": os.path.join(data_dir, "log_json_path.json"),
+        "song_data": os.path.join(data_dir, "song_data")
+    }
+
+    return config
+
+
+def run_pipeline(config):
+    """
+    Runs create -> load -> insert -> dq on one connection, timing each stage and counting
+    the rows each stage loaded (see RunReport.loaded_rows).
+
+    Returns:
+        dict: stage name -> {"seconds": ..., "rows": ...}
+    """
+
+    conn = connect(config)
+    report = RunReport("benchmark", redshift=False)
+    cur = InstrumentedCursor(conn.cursor(), report)
+    stages = {}
+
+    for stage, steps in (("create", [reset_schema]), ("load", [load_staging_tables]),
+                         ("insert", [insert_tables]), ("dq", [table_validation])):
+        start = time.perf_counter()
+        with report.step(stage):
+            for step in steps:
+                step(cur, conn)
+
+        stages[stage] = {
+            "seconds": time.perf_counter() - start,
+            "rows": report.loaded_rows(stage)
+        }
+
+    conn.close()
+
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end pipeline benchmark on synthetic data")
+    parser.add_argument("--scale", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--next-song-fraction", type=float, default=0.8)
+    parser.add_argument("--match-rate", type=float, default=0.9)
+    parser.add_argument("--work-dir", default="bench_data")
+    args = parser.parse_args()
+
+    results = []
+
+    for scale in args.scale:
+        data_dir = os.path.join(args.work_dir, f"sf{scale}")
+
+        print("**********************************************")
+        print(f"Generating scale factor {scale}...")
+        if os.path.isdir(data_dir):
+            print(f"{data_dir} exists, reusing it")
+            data = None
+        else:
+            data = generate(data_dir, scale, args.days, args.next_song_fraction, args.match_rate)
+            print(data)
+
+        config = local_config(data_dir, os.path.join(args.work_dir, f"sf{scale}.duckdb"))
+        stages = run_pipeline(config)
+
+        if data is not None:
+            stages["load"]["bytes_per_second"] = (data["song_bytes"] + data["log_bytes"]) / stages["load"]["seconds"]
+
+        for stage, stats in stages.items():
+            stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else None
+            results.append({"scale": scale, "stage": stage, **stats})
+
+    print("**********************************************")
+    print(f"{'scale':>6} {'stage':<8} {'seconds':>10} {'rows':>12} {'rows/s':>12}")
+    for result in results:
+        print(f"{result['scale']:>6} {result['stage']:<8} {result['seconds']:>10.2f} {result['rows']:>12} "
+              f"{result['rows_per_second'] or 0:>12.0f}")
+
+    config = configparser.ConfigParser()
+    config.read("dwh.cfg")
+    run_log_dir = config.get("ETL", "RUN_LOG_DIR", fallback="logs")
+    os.makedirs(run_log_dir, exist_ok=True)
+    path = os.path.join(run_log_dir, f"benchmark_{datetime.now().strftime('%Y%m%d%H%M%S')}.json")
+
+    with open(path, "w") as f:
+        json.dump(results, f, indent=1)
+
+    print(f"Benchmark results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import random
+import string
+from datetime import datetime, timedelta, timezone
+
+# Sizes of the 1x data set, roughly the shape of the udacity-dend song_data and log_data
+BASE_SONGS = 1500
+BASE_USERS = 100
+BASE_EVENTS_PER_DAY = 300
+
+LOG_FIELDS = ["artist", "auth", "firstName", "gender", "itemInSession", "lastName", "length", "level", "location",
+              "method", "page", "registration", "sessionId", "song", "status", "ts", "userAgent", "userId"]
+OTHER_PAGES = ["Home", "Login", "Logout", "Settings", "Upgrade", "Downgrade", "Help", "About", "Add to Playlist"]
+LOCATIONS = ["San Francisco-Oakland-Hayward, CA", "Atlanta-Sandy Springs-Roswell, GA", "Chicago-Naperville-Elgin, IL-IN-WI",
+             "New York-Newark-Jersey City, NY-NJ-PA", "Lansing-East Lansing, MI", "Portland-South Portland, ME"]
+USER_AGENTS = ['"Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0"',
+               '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+               "Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.1; WOW64; Trident/6.0)"]
+
+
+def random_id(rng, prefix, length=16):
+    """
+    Million Song Dataset style identifier, e.g. SOUPIRU12A6D4FA1E1.
+    """
+
+    return prefix + "".join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(length))
+
+
+def random_words(rng, count):
+    return " ".join(rng.choice(string.ascii_uppercase) + "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9)))
+                    for _ in range(count))
+
+
+def generate_songs(rng, scale):
+    """
+    Generates song_data records with the fields of staging_songs.  Artists have several
+    songs each, like the real catalogue.
+
+    Args:
+        rng (class): random.Random
+        scale (int): scale factor
+
+    Returns:
+        list: song records
+    """
+
+    artists = []
+    for _ in range(max(1, BASE_SONGS * scale // 3)):
+        located = rng.random() < 0.4
+        artists.append({
+            "artist_id": random_id(rng, "AR"),
+            "artist_name": random_words(rng, rng.randint(1, 3)),
+            "artist_location": rng.choice(LOCATIONS) if located else "",
+            "artist_latitude": round(rng.uniform(-60, 60), 5) if located else None,
+            "artist_longitude": round(rng.uniform(-150, 150), 5) if located else None
+        })
+
+    songs = []
+    for _ in range(BASE_SONGS * scale):
+        artist = rng.choice(artists)
+        songs.append({
+            "num_songs": 1,
+            **artist,
+            "song_id": random_id(rng, "SO"),
+            "title": random_words(rng, rng.randint(1, 5)),
+            "duration": round(rng.uniform(90, 480), 5),
+            "year": rng.choice([0] + list(range(1960, 2019)))
+        })
+
+    return songs
+
+
+def write_songs(songs, song_dir):
+    """
+    Writes one JSON file per song under song_data/<A>/<B>/<C>/<track id>.json, like the
+    real data set.
+
+    Returns:
+        int: bytes written
+    """
+
+    written = 0
+    rng = random.Random(len(songs))
+
+    for song in songs:
+        track_id = random_id(rng, "TR")
+        folder = os.path.join(song_dir, *track_id[2:5])
+        os.makedirs(folder, exist_ok=True)
+
+        body = json.dumps({key: song[key] for key in ["num_songs", "artist_id", "artist_latitude", "artist_longitude",
+                                                       "artist_location", "artist_name", "song_id", "title", "duration", "year"]})
+        with open(os.path.join(folder, track_id + ".json"), "w") as f:
+            f.write(body)
+        written += len(body)
+
+    return written
+
+
+def generate_users(rng, scale):
+    users = []
+    for i in range(BASE_USERS * scale):
+        users.append({
+            "userId": str(i + 1),
+            "firstName": random_words(rng, 1),
+            "lastName": random_words(rng, 1),
+            "gender": rng.choice("MF"),
+            "level": rng.choice(["free", "paid"]),
+            "location": rng.choice(LOCATIONS),
+            "userAgent": rng.choice(USER_AGENTS),
+            "registration": float(rng.randint(1535000000000, 1541000000000))
+        })
+
+    return users
+
+
+def write_logs(rng, songs, users, scale, days, start, next_song_fraction, match_rate, log_dir):
+    """
+    Writes one newline-delimited JSON file of eventsim-style events per day under
+    log_data/YYYY/MM/YYYY-MM-DD-events.json.  next_song_fraction of the events are
+    'NextSong' page views, and match_rate of those play a song (title and artist name)
+    that exists in song_data, so the songplays join finds them.
+
+    Returns:
+        tuple: (events written, bytes written)
+    """
+
+    events = written = 0
+    session_id = 0
+
+    for day in range(days):
+        current = start + timedelta(days=day)
+        folder = os.path.join(log_dir, current.strftime("%Y"), current.strftime("%m"))
+        os.makedirs(folder, exist_ok=True)
+        day_start_ms = int(current.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+        with open(os.path.join(folder, current.strftime("%Y-%m-%d-events.json")), "w") as f:
+            item_in_session = 0
+            user = rng.choice(users)
+
+            for i in range(BASE_EVENTS_PER_DAY * scale):
+                if rng.random() < 0.05:
+                    session_id += 1
+                    item_in_session = 0
+                    user = rng.choice(users)
+                    if rng.random() < 0.1:
+                        user["level"] = "paid" if user["level"] == "free" else "free"
+
+                event = {"auth": "Logged In", "itemInSession": item_in_session, "method": "PUT", "status": 200,
+                         "sessionId": session_id, "ts": day_start_ms + rng.randint(0, 86399999),
+                         "artist": None, "song": None, "length": None}
+                event.update({key: user[key] for key in ["firstName", "gender", "lastName", "level", "location",
+                                                         "registration", "userAgent", "userId"]})
+
+                if rng.random() < next_song_fraction:
+                    event["page"] = "NextSong"
+                    if rng.random() < match_rate:
+                        song = rng.choice(songs)
+                        event.update(artist=song["artist_name"], song=song["title"], length=song["duration"])
+                    else:
+                        event.update(artist=random_words(rng, 2), song=random_words(rng, 3), length=round(rng.uniform(90, 480), 5))
+                else:
+                    event["page"] = rng.choice(OTHER_PAGES)
+                    event["method"] = "GET"
+
+                line = json.dumps({key: event[key] for key in LOG_FIELDS}) + "\n"
+                f.write(line)
+                written += len(line)
+                events += 1
+                item_in_session += 1
+
+    return events, written
+
+
+def generate(output_dir, scale=1, days=30, next_song_fraction=0.8, match_rate=0.9, seed=42):
+    """
+    Generates a synthetic song_data/log_data set at a scale factor of the 1x size, plus
+    the log_json_path.json used by the staging_events COPY.
+
+    Args:
+        output_dir (string): directory receiving song_data, log_data and log_json_path.json
+        scale (int): scale factor, 1 to 1000
+        days (int): number of daily log_data partitions, starting 2018-11-01
+        next_song_fraction (float): fraction of events with page = 'NextSong'
+        match_rate (float): fraction of NextSong events playing a song present in song_data
+        seed (int): random seed, the same arguments always generate the same data
+
+    Returns:
+        dict: record counts and bytes written
+    """
+
+    rng = random.Random(seed)
+    songs = generate_songs(rng, scale)
+    users = generate_users(rng, scale)
+
+    song_bytes = write_songs(songs, os.path.join(output_dir, "song_data"))
+    events, log_bytes = write_logs(rng, songs, users, scale, days, datetime(2018, 11, 1),
+                                   next_song_fraction, match_rate, os.path.join(output_dir, "log_data"))
+
+    with open(os.path.join(output_dir, "log_json_path.json"), "w") as f:
+        json.dump({"jsonpaths": [f"$['{field}']" for field in LOG_FIELDS]}, f, indent=4)
+
+    return {"songs": len(songs), "users": len(users), "events": events,
+            "song_bytes": song_bytes, "log_bytes": log_bytes}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic song_data and log_data")
+    parser.add_argument("--output-dir", default="bench_data/sf1")
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--next-song-fraction", type=float, default=0.8)
+    parser.add_argument("--match-rate", type=float, default=0.9)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    print(generate(args.output_dir, args.scale, args.days, args.next_song_fraction, args.match_rate, args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,75 +1,150 @@
-import boto3
 import configparser
 import os
+import sys
+from datetime import datetime
 
-main_config = configparser.ConfigParser()
-main_config.read("dwh.cfg")
+sys.path.append(os.getcwd())
+from util.aws_functions import aws_clients, final_snapshots, snapshot_status, wait_until
 
-aws_creds_path = os.path.expanduser("~\\.aws\\credentials")
-aws_creds = configparser.ConfigParser()
-aws_creds.read(aws_creds_path)
+main_config_path = "dwh.cfg"
 
-aws_config_path = os.path.expanduser("~\\.aws\\config")
-aws_config = configparser.ConfigParser()
-aws_config.read(aws_config_path)
 
-# CLUSTER
-CLUSTER_IDENTIFIER    = main_config.get("CLUSTER","CLUSTER_IDENTIFIER")
+def pause_cluster(redshift, cluster_identifier):
+    """
+    Pauses the cluster: compute billing stops, while its storage and data are kept for
+    infra_deploy.py to resume.
+    """
 
-# IAM
-IAM_ROLE_NAME         = main_config.get("IAM_ROLE","IAM_ROLE_NAME")
+    try:
+        redshift.pause_cluster(ClusterIdentifier=cluster_identifier)
 
-# AWS CREDENTIALS & CONFIG
-KEY                   = aws_creds.get("default", "aws_access_key_id")
-SECRET                = aws_creds.get("default", "aws_secret_access_key")
-REGION                = aws_config.get("default", "region")
+        print(redshift.describe_clusters(ClusterIdentifier=cluster_identifier)['Clusters'][0]['ClusterStatus'])
 
-print("**********************************************")
-print("Establishing boto3 resources and clients...")
+    except Exception as e:
+        print(e)
 
-iam_client = boto3.client('iam',
-                          aws_access_key_id=KEY,
-                          aws_secret_access_key=SECRET,
-                          region_name=REGION
-                         )
 
-redshift = boto3.client('redshift',
-                       aws_access_key_id=KEY,
-                       aws_secret_access_key=SECRET,
-                       region_name=REGION
-                       )
+def delete_cluster(redshift, cluster_identifier, snapshot_identifier=None, timeout=1800):
+    """
+    Deletes the cluster, first taking a final snapshot when snapshot_identifier is given.
+    Snapshot names must be unique, so the final snapshot is named snapshot_identifier plus
+    a timestamp.  Older final snapshots are only deleted once the new one is available, so
+    a failed snapshot never leaves the warehouse without one.
 
-print("**********************************************")
-print("Deleting Cluster...")
+    Args:
+        redshift (class): boto3 redshift client
+        cluster_identifier (string): cluster identifier
+        snapshot_identifier (string): base name of the final snapshot, None to skip the snapshot
+        timeout (float): deadline in seconds for the new snapshot to become available
+    """
 
-try:
-    redshift.delete_cluster(
-        ClusterIdentifier=CLUSTER_IDENTIFIER,
-        SkipFinalClusterSnapshot=True
-        )
-    
-    print(redshift.describe_clusters(ClusterIdentifier=CLUSTER_IDENTIFIER)['Clusters'][0])
+    try:
+        if snapshot_identifier is None:
+            redshift.delete_cluster(
+                ClusterIdentifier=cluster_identifier,
+                SkipFinalClusterSnapshot=True
+                )
+            print(redshift.describe_clusters(ClusterIdentifier=cluster_identifier)['Clusters'][0])
 
-except Exception as e:
-    print(e)
+        else:
+            previous = final_snapshots(redshift, snapshot_identifier)
+            final_snapshot = f"{snapshot_identifier}-{datetime.now().strftime('%Y%m%d%H%M%S')}"
 
-print("**********************************************")
-print("Detatching IAM Role policies...")
+            redshift.delete_cluster(
+                ClusterIdentifier=cluster_identifier,
+                SkipFinalClusterSnapshot=False,
+                FinalClusterSnapshotIdentifier=final_snapshot
+                )
+            print(redshift.describe_clusters(ClusterIdentifier=cluster_identifier)['Clusters'][0])
 
-try:
-    iam_client.detach_role_policy(
-        RoleName=IAM_ROLE_NAME,
-        PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
-        )
+            wait_until(lambda: snapshot_status(redshift, final_snapshot) == "available",
+                       f"snapshot {final_snapshot}", timeout)
 
-except Exception as e:
-    print(e)
+            for snapshot in previous:
+                redshift.delete_cluster_snapshot(SnapshotIdentifier=snapshot)
+                print(f"Deleted previous snapshot {snapshot}")
 
-print("**********************************************")
-print("Deleting IAM Role")
+    except Exception as e:
+        print(e)
 
-try:
-    iam_client.delete_role(RoleName=IAM_ROLE_NAME)
 
-except Exception as e:
-    print(e)
\ No newline at end of file
+def delete_role(iam_client, role_name):
+    """
+    Detaches the IAM role's policies and deletes it.
+    """
+
+    print("**********************************************")
+    print("Detatching IAM Role policies...")
+
+    try:
+        iam_client.detach_role_policy(
+            RoleName=role_name,
+            PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
+            )
+
+    except Exception as e:
+        print(e)
+
+    print("**********************************************")
+    print("Deleting IAM Role")
+
+    try:
+        iam_client.delete_role(RoleName=role_name)
+
+    except Exception as e:
+        print(e)
+
+
+def decommission(main_config, clients):
+    """
+    Shuts the warehouse down according to POLICY in the [LIFECYCLE] section of dwh.cfg:
+     pause     pause the cluster, infra_deploy.py resumes it
+     snapshot  delete the cluster with a final snapshot, infra_deploy.py restores from it
+     delete    delete the cluster without a snapshot, and the IAM role with it
+    The IAM role is kept by pause and snapshot, since the resumed or restored cluster
+    still uses it to read S3.
+
+    Args:
+        main_config (class): configparser.ConfigParser() for dwh.cfg
+        clients (dict): boto3 clients from util.aws_functions.aws_clients
+    """
+
+    cluster_identifier = main_config.get("CLUSTER", "CLUSTER_IDENTIFIER")
+    policy = main_config.get("LIFECYCLE", "POLICY", fallback="delete")
+
+    if policy == "pause":
+        print("**********************************************")
+        print("Pausing Cluster...")
+        pause_cluster(clients["redshift"], cluster_identifier)
+
+    elif policy == "snapshot":
+        snapshot_identifier = main_config.get("LIFECYCLE", "SNAPSHOT_IDENTIFIER", fallback="") or f"{cluster_identifier}-final"
+
+        print("**********************************************")
+        print(f"Deleting Cluster with final snapshot {snapshot_identifier}...")
+        delete_cluster(clients["redshift"], cluster_identifier, snapshot_identifier,
+                       main_config.getfloat("AWS", "WAIT_TIMEOUT", fallback=1800))
+
+    elif policy == "delete":
+        print("**********************************************")
+        print("Deleting Cluster...")
+        delete_cluster(clients["redshift"], cluster_identifier)
+        delete_role(clients["iam"], main_config.get("IAM_ROLE", "IAM_ROLE_NAME"))
+
+    else:
+        raise ValueError(f"Unknown lifecycle policy {policy}, expected pause, snapshot or delete")
+
+
+def main():
+    main_config = configparser.ConfigParser()
+    main_config.read(main_config_path)
+
+    print("**********************************************")
+    print("Establishing boto3 resources and clients...")
+    clients = aws_clients(main_config, services=("iam", "redshift"))
+
+    decommission(main_config, clients)
+
+
+if __name__ == "__main__":
+    main()
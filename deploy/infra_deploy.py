@@ -1,189 +1,487 @@
-import boto3
 import json
 import psycopg2
 import configparser
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 sys.path.append(os.getcwd())
 from util.config_functions import modify_config_file
+from util.aws_functions import aws_clients, cluster_status, final_snapshots, snapshot_status, wait_until
 
 main_config_path = "dwh.cfg"
-main_config = configparser.ConfigParser()
-main_config.read(main_config_path)
+aws_config_path = os.path.expanduser("~\\.aws\\config")
 
-aws_creds_path = os.path.expanduser("~\\.aws\\credentials")
-aws_creds = configparser.ConfigParser()
-aws_creds.read(aws_creds_path)
 
-aws_config_path = os.path.expanduser("~\\.aws\\config")
-aws_config = configparser.ConfigParser()
-aws_config.read(aws_config_path)
-
-# CLUSTER
-CLUSTER_IDENTIFIER    = main_config.get("CLUSTER","CLUSTER_IDENTIFIER")
-CLUSTER_TYPE          = main_config.get("CLUSTER","CLUSTER_TYPE")
-NODE_TYPE             = main_config.get("CLUSTER","NODE_TYPE")
-NUM_NODES             = main_config.get("CLUSTER","NUM_NODES")
-
-# DATABASE
-DB_NAME               = main_config.get("DB","DB_NAME")
-DB_USER               = main_config.get("DB","DB_USER")
-DB_PASSWORD           = main_config.get("DB","DB_PASSWORD")
-DB_PORT               = main_config.get("DB","DB_PORT")
-
-# IAM
-IAM_ROLE_NAME         = main_config.get("IAM_ROLE","IAM_ROLE_NAME")
-
-# AWS CREDENTIALS & CONFIG
-KEY                   = aws_creds.get("default", "aws_access_key_id")
-SECRET                = aws_creds.get("default", "aws_secret_access_key")
-REGION                = aws_config.get("default", "region")
-
-print("**********************************************")
-print("Establishing boto3 resources and clients...")
-
-iam_client = boto3.client('iam',
-                          aws_access_key_id=KEY,
-                          aws_secret_access_key=SECRET,
-                          region_name=REGION
-                         )
-
-redshift = boto3.client('redshift',
-                       aws_access_key_id=KEY,
-                       aws_secret_access_key=SECRET,
-                       region_name=REGION
-                       )
-
-ec2 = boto3.resource('ec2',
-                     aws_access_key_id=KEY,
-                     aws_secret_access_key=SECRET,
-                     region_name=REGION
-                     )
-
-ec2_client = boto3.client("ec2",
-                          aws_access_key_id=KEY,
-                          aws_secret_access_key=SECRET,
-                          region_name=REGION
-                          )
-
-print("**********************************************")
-print("Creating IAM Role")
-
-try:
-    dwhRole = iam_client.create_role(
-        Path='/',
-        RoleName=IAM_ROLE_NAME,
-        Description = "Allows Redshift clusters to call AWS services on your behalf.",
-        AssumeRolePolicyDocument=json.dumps(
-            {'Statement': [{'Action': 'sts:AssumeRole',
-               'Effect': 'Allow',
-               'Principal': {'Service': 'redshift.amazonaws.com'}}],
-             'Version': '2012-10-17'})
-    )    
-except Exception as e:
-    print(e)
-
-print("**********************************************")
-print("Updating local .aws/config file with Role ARN")
-
-aws_profile = "profile Redshift"
-aws_config_key = "role_arn"
-role_arn = iam_client.get_role(RoleName=IAM_ROLE_NAME)['Role']['Arn']
-
-modify_config_file(
-    config_file=aws_config_path,
-    config_obj=aws_config,
-    config_section=aws_profile,
-    config_key=aws_config_key,
-    config_val=role_arn
-)
-
-print("**********************************************")
-print("Attaching policies to IAM Role")
-
-try:
-    iam_client.attach_role_policy(RoleName=IAM_ROLE_NAME,
-                                  PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
-                                 )
-
-except Exception as e:
-    print(e)
-
-print("**********************************************")
-print("Creating cluster...")
-
-try:
-    response = redshift.create_cluster(
-        ClusterType=CLUSTER_TYPE,
-        NodeType=NODE_TYPE,
-        NumberOfNodes=int(NUM_NODES),
-        DBName=DB_NAME,
-        ClusterIdentifier=CLUSTER_IDENTIFIER,
-        MasterUsername=DB_USER,
-        MasterUserPassword=DB_PASSWORD,
-        PubliclyAccessible=True,
-        IamRoles=[role_arn]
+@contextmanager
+def phase(timings, name):
+    """
+    Prints a banner for a provisioning phase and records its wall time in timings.
+    """
+
+    print("**********************************************")
+    print(f"{name}...")
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - start
+        print(f"{name} took {timings[name]:.1f}s")
+
+
+def create_role(iam_client, role_name):
+    """
+    Creates the IAM role Redshift assumes to read S3, if it doesn't exist yet.
+
+    Args:
+        iam_client (class): boto3 iam client
+        role_name (string): IAM role name
+
+    Returns:
+        string: role ARN
+    """
+
+    try:
+        iam_client.create_role(
+            Path='/',
+            RoleName=role_name,
+            Description = "Allows Redshift clusters to call AWS services on your behalf.",
+            AssumeRolePolicyDocument=json.dumps(
+                {'Statement': [{'Action': 'sts:AssumeRole',
+                   'Effect': 'Allow',
+                   'Principal': {'Service': 'redshift.amazonaws.com'}}],
+                 'Version': '2012-10-17'})
+        )
+    except Exception as e:
+        print(e)
+
+    return iam_client.get_role(RoleName=role_name)['Role']['Arn']
+
+
+def attach_policies(iam_client, role_name):
+    """
+    Attaches the S3 read-only policy to the IAM role.
+    """
+
+    try:
+        iam_client.attach_role_policy(RoleName=role_name,
+                                      PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
+                                     )
+    except Exception as e:
+        print(e)
+
+
+def authorize_ingress(ec2_client, ec2, port):
+    """
+    Opens the database port in the default security group.
+
+    Args:
+        ec2_client (class): boto3 ec2 client
+        ec2 (class): boto3 ec2 resource
+        port (int): database port
+    """
+
+    try:
+        group_id = ec2_client.describe_security_groups()["SecurityGroups"][0]["GroupId"]
+        defaultSg = ec2.SecurityGroup(group_id)
+        defaultSg.authorize_ingress(
+            GroupName=defaultSg.group_name,
+            CidrIp='0.0.0.0/0',
+            IpProtocol='TCP',
+            FromPort=port,
+            ToPort=port
+        )
+    except Exception as e:
+        print(e)
+
+
+def wlm_configuration(config):
+    """
+    Builds the manual WLM configuration from the [WLM] section of dwh.cfg: an ETL queue
+    for sessions tagged with ETL_QUERY_GROUP, which gets the larger share of memory so
+    big INSERT ... SELECT and COPY steps don't spill to disk, an analytics queue for
+    ANALYTICS_QUERY_GROUP, the default queue with the remaining memory, and optionally
+    short query acceleration.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+
+    Returns:
+        list: value of the wlm_json_configuration parameter
+    """
+
+    etl_memory = config.getint("WLM", "ETL_MEMORY_PERCENT", fallback=60)
+    analytics_memory = config.getint("WLM", "ANALYTICS_MEMORY_PERCENT", fallback=30)
+
+    if etl_memory + analytics_memory >= 100:
+        raise ValueError("ETL_MEMORY_PERCENT + ANALYTICS_MEMORY_PERCENT must leave memory for the default queue")
+
+    queues = [
+        {
+            "query_group": [config.get("WLM", "ETL_QUERY_GROUP", fallback="etl")],
+            "query_group_wild_card": 0,
+            "memory_percent_to_use": etl_memory,
+            "query_concurrency": config.getint("WLM", "ETL_CONCURRENCY", fallback=3)
+        },
+        {
+            "query_group": [config.get("WLM", "ANALYTICS_QUERY_GROUP", fallback="analytics")],
+            "query_group_wild_card": 0,
+            "memory_percent_to_use": analytics_memory,
+            "query_concurrency": config.getint("WLM", "ANALYTICS_CONCURRENCY", fallback=5)
+        },
+        {
+            "memory_percent_to_use": 100 - etl_memory - analytics_memory,
+            "query_concurrency": 5
+        }
+    ]
+
+    if config.getboolean("WLM", "SHORT_QUERY_ACCELERATION", fallback=True):
+        queues.append({"short_query_queue": True})
+
+    return queues
+
+
+def create_parameter_group(redshift, config):
+    """
+    Creates the cluster parameter group named PARAMETER_GROUP in [WLM], if it doesn't exist
+    yet, and sets its WLM configuration.
+
+    Args:
+        redshift (class): boto3 redshift client
+        config (class): configparser.ConfigParser() for dwh.cfg
+
+    Returns:
+        string: parameter group name, None when PARAMETER_GROUP is empty
+    """
+
+    name = config.get("WLM", "PARAMETER_GROUP", fallback="")
+
+    if not name:
+        return None
+
+    try:
+        redshift.create_cluster_parameter_group(
+            ParameterGroupName=name,
+            ParameterGroupFamily="redshift-1.0",
+            Description="WLM with separate ETL and analytics queues"
+        )
+    except Exception as e:
+        print(e)
+
+    try:
+        redshift.modify_cluster_parameter_group(
+            ParameterGroupName=name,
+            Parameters=[{"ParameterName": "wlm_json_configuration", "ParameterValue": json.dumps(wlm_configuration(config))}]
+        )
+    except Exception as e:
+        print(e)
+
+    return name
+
+
+def create_cluster(redshift, config, role_arn, parameter_group=None):
+    """
+    Requests a cluster with the [CLUSTER] and [DB] settings of dwh.cfg, if it doesn't
+    exist yet.  Returns as soon as the request is accepted.
+    """
+
+    group_args = {"ClusterParameterGroupName": parameter_group} if parameter_group else {}
+
+    try:
+        redshift.create_cluster(
+            ClusterType=config.get("CLUSTER", "CLUSTER_TYPE"),
+            NodeType=config.get("CLUSTER", "NODE_TYPE"),
+            NumberOfNodes=config.getint("CLUSTER", "NUM_NODES"),
+            DBName=config.get("DB", "DB_NAME"),
+            ClusterIdentifier=config.get("CLUSTER", "CLUSTER_IDENTIFIER"),
+            MasterUsername=config.get("DB", "DB_USER"),
+            MasterUserPassword=config.get("DB", "DB_PASSWORD"),
+            PubliclyAccessible=True,
+            IamRoles=[role_arn],
+            **group_args
+        )
+    except Exception as e:
+        print(e)
+
+
+def assign_parameter_group(redshift, cluster_identifier, parameter_group):
+    """
+    Assigns a parameter group to an available cluster, unless it already has it.  The new
+    WLM configuration takes effect after the next reboot, which is left to the operator so
+    running queries aren't cut off.
+
+    Args:
+        redshift (class): boto3 redshift client
+        cluster_identifier (string): cluster identifier
+        parameter_group (string): cluster parameter group, None to keep the current one
+    """
+
+    if not parameter_group:
+        return
+
+    groups = redshift.describe_clusters(ClusterIdentifier=cluster_identifier)['Clusters'][0].get('ClusterParameterGroups', [])
+    if parameter_group in [group['ParameterGroupName'] for group in groups]:
+        return
+
+    print(f"Assigning parameter group {parameter_group}, it takes effect after the cluster reboots")
+    redshift.modify_cluster(ClusterIdentifier=cluster_identifier, ClusterParameterGroupName=parameter_group)
+
+
+def start_cluster(redshift, config, role_arn, timeout, parameter_group=None):
+    """
+    Brings the cluster up according to the [LIFECYCLE] POLICY left behind by
+    infra_decomm.py: a paused cluster is resumed, with the snapshot policy a deleted cluster
+    is restored from the latest final snapshot taken under SNAPSHOT_IDENTIFIER, and otherwise
+    a new, empty cluster is created.
+    A cluster still pausing or being deleted is waited for first.
+
+    Args:
+        redshift (class): boto3 redshift client
+        config (class): configparser.ConfigParser() for dwh.cfg
+        role_arn (string): IAM role ARN attached to a created or restored cluster
+        timeout (float): deadline in seconds for the waits
+        parameter_group (string): cluster parameter group attached to a created or restored
+                                  cluster, and assigned to an existing one once it is
+                                  available
+
+    Returns:
+        string: created, resumed, restored or existing
+    """
+
+    cluster_identifier = config.get("CLUSTER", "CLUSTER_IDENTIFIER")
+    snapshot_identifier = config.get("LIFECYCLE", "SNAPSHOT_IDENTIFIER", fallback="") or f"{cluster_identifier}-final"
+
+    transitional = ("pausing", "deleting", "final-snapshot")
+    status = cluster_status(redshift, cluster_identifier)
+
+    if status in transitional:
+        def settled():
+            nonlocal status
+            status = cluster_status(redshift, cluster_identifier)
+            return status not in transitional
+
+        wait_until(settled, f"cluster {cluster_identifier} to finish {status}", timeout)
+
+    group_args = {"ClusterParameterGroupName": parameter_group} if parameter_group else {}
+
+    # A paused or busy cluster rejects modify_cluster with InvalidClusterState, so the
+    # parameter group is only assigned once the cluster is available again
+    if status == "paused":
+        print(f"Resuming paused cluster {cluster_identifier}")
+        redshift.resume_cluster(ClusterIdentifier=cluster_identifier)
+        wait_for_cluster(redshift, cluster_identifier, timeout)
+        assign_parameter_group(redshift, cluster_identifier, parameter_group)
+        return "resumed"
+
+    if status is not None:
+        print(f"Cluster {cluster_identifier} already exists ({status})")
+        if parameter_group:
+            wait_for_cluster(redshift, cluster_identifier, timeout)
+            assign_parameter_group(redshift, cluster_identifier, parameter_group)
+        return "existing"
+
+    snapshots = final_snapshots(redshift, snapshot_identifier) if config.get("LIFECYCLE", "POLICY", fallback="delete") == "snapshot" else []
+
+    if snapshots:
+        snapshot_identifier = snapshots[-1]
+        wait_until(lambda: snapshot_status(redshift, snapshot_identifier) == "available",
+                   f"snapshot {snapshot_identifier}", timeout)
+
+        print(f"Restoring cluster {cluster_identifier} from snapshot {snapshot_identifier}")
+        redshift.restore_from_cluster_snapshot(
+            ClusterIdentifier=cluster_identifier,
+            SnapshotIdentifier=snapshot_identifier,
+            NodeType=config.get("CLUSTER", "NODE_TYPE"),
+            NumberOfNodes=config.getint("CLUSTER", "NUM_NODES"),
+            PubliclyAccessible=True,
+            IamRoles=[role_arn],
+            **group_args
+        )
+        return "restored"
+
+    create_cluster(redshift, config, role_arn, parameter_group)
+    return "created"
+
+
+def wait_for_cluster(redshift, cluster_identifier, timeout):
+    """
+    Waits, with exponential backoff, until the cluster is available and accepting
+    connections.
+
+    Args:
+        redshift (class): boto3 redshift client
+        cluster_identifier (string): cluster identifier
+        timeout (float): deadline in seconds
+
+    Returns:
+        string: cluster endpoint address
+    """
+
+    def available():
+        cluster = redshift.describe_clusters(ClusterIdentifier=cluster_identifier)['Clusters'][0]
+
+        if cluster['ClusterStatus'] == 'available' and cluster.get('ClusterAvailabilityStatus', 'Available') == 'Available':
+            return cluster['Endpoint']['Address']
+
+    return wait_until(available, f"cluster {cluster_identifier}", timeout)
+
+
+def validate_connection(config, host):
+    """
+    Opens and closes a database connection to the new cluster.
+    """
+
+    try:
+        conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(
+            host, config.get("DB", "DB_NAME"), config.get("DB", "DB_USER"),
+            config.get("DB", "DB_PASSWORD"), config.get("DB", "DB_PORT")))
+        conn.close()
+
+        print("Successfully connected to cluster")
+
+    except Exception as e:
+        print(e)
+
+
+def has_watermark(config, host):
+    """
+    Checks whether the warehouse on the cluster records a log_data watermark, i.e. whether
+    an incremental load can start from it.  A cluster that can't be queried, or whose
+    load_watermark table is missing or empty, has none.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+        host (string): cluster endpoint address
+
+    Returns:
+        bool: whether load_watermark holds the log_data watermark
+    """
+
+    try:
+        conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(
+            host, config.get("DB", "DB_NAME"), config.get("DB", "DB_USER"),
+            config.get("DB", "DB_PASSWORD"), config.get("DB", "DB_PORT")))
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT COUNT(*) FROM load_watermark WHERE source = 'log_data'")
+                return cur.fetchone()[0] > 0
+        finally:
+            conn.close()
+
+    except Exception as e:
+        print(f"No load watermark found: {e}")
+        return False
+
+
+def provision(main_config, clients):
+    """
+    Provisions the IAM role, cluster and security group ingress, writes the role ARN to
+    the local .aws/config file and the cluster endpoint to dwh.cfg.  The cluster request
+    only needs the role, so the policy attachment and the ingress rule run concurrently
+    with the cluster boot instead of after it.  LOAD_MODE in dwh.cfg is set to incremental
+    when the cluster was resumed or restored with its data and a load watermark, and to
+    full otherwise.
+
+    Args:
+        main_config (class): configparser.ConfigParser() for dwh.cfg
+        clients (dict): boto3 clients from util.aws_functions.aws_clients
+
+    Returns:
+        dict: phase name -> wall time in seconds
+    """
+
+    role_name = main_config.get("IAM_ROLE", "IAM_ROLE_NAME")
+    cluster_identifier = main_config.get("CLUSTER", "CLUSTER_IDENTIFIER")
+    timeout = main_config.getfloat("AWS", "WAIT_TIMEOUT", fallback=1800)
+    timings = {}
+    start = time.perf_counter()
+
+    with phase(timings, "Creating IAM Role"):
+        role_arn = create_role(clients["iam"], role_name)
+
+    aws_config = configparser.ConfigParser()
+    aws_config.read(aws_config_path)
+    modify_config_file(
+        config_file=aws_config_path,
+        config_obj=aws_config,
+        config_section="profile Redshift",
+        config_key="role_arn",
+        config_val=role_arn
     )
-    
-except Exception as e:
-    print(e)
-
-print("**********************************************")
-print("Waiting for cluster availability...")
-
-while redshift.describe_clusters(ClusterIdentifier=CLUSTER_IDENTIFIER)['Clusters'][0]['ClusterStatus'] != 'available':
-    False
-
-else:
-    while redshift.describe_clusters(ClusterIdentifier=CLUSTER_IDENTIFIER)['Clusters'][0]['ClusterAvailabilityStatus'] != 'Available':
-        False
-    
-    else:
-        clusterProps = redshift.describe_clusters(ClusterIdentifier=CLUSTER_IDENTIFIER)['Clusters'][0]
-        clusterHost = clusterProps['Endpoint']['Address']
-
-        print(f"{clusterHost} now available")
-
-print("**********************************************")
-print("Adding Cluster endpoint to dwh.cfg file...")
-
-main_config_section = "DB"
-main_config_key = "DB_HOST"
-
-modify_config_file(
-    config_file=main_config_path,
-    config_obj=main_config,
-    config_section=main_config_section,
-    config_key=main_config_key,
-    config_val=clusterHost
-)
-    
-print("**********************************************")
-print("Specifying ingress rules to default sec group")
-
-try:
-    group_id = ec2_client.describe_security_groups()["SecurityGroups"][0]["GroupId"]
-    defaultSg = ec2.SecurityGroup(group_id)
-    defaultSg.authorize_ingress(
-        GroupName=defaultSg.group_name,
-        CidrIp='0.0.0.0/0',
-        IpProtocol='TCP',
-        FromPort=int(DB_PORT),
-        ToPort=int(DB_PORT)  
+
+    def boot_cluster():
+        with phase(timings, "Creating WLM parameter group"):
+            parameter_group = create_parameter_group(clients["redshift"], main_config)
+        with phase(timings, "Starting cluster"):
+            started = start_cluster(clients["redshift"], main_config, role_arn, timeout, parameter_group)
+        with phase(timings, "Waiting for cluster availability"):
+            return started, wait_for_cluster(clients["redshift"], cluster_identifier, timeout)
+
+    def attach():
+        with phase(timings, "Attaching policies to IAM Role"):
+            attach_policies(clients["iam"], role_name)
+
+    def ingress():
+        with phase(timings, "Specifying ingress rules to default sec group"):
+            authorize_ingress(clients["ec2"], clients["ec2_resource"], main_config.getint("DB", "DB_PORT"))
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        cluster = executor.submit(boot_cluster)
+        setup = [executor.submit(attach), executor.submit(ingress)]
+
+        for future in setup:
+            future.result()
+        started, cluster_host = cluster.result()
+
+    print(f"{cluster_host} now available ({started})")
+
+    modify_config_file(
+        config_file=main_config_path,
+        config_obj=main_config,
+        config_section="DB",
+        config_key="DB_HOST",
+        config_val=cluster_host
+    )
+
+    with phase(timings, "Validating cluster availability"):
+        validate_connection(main_config, cluster_host)
+
+    # A resumed or restored warehouse still holds its tables and load watermark, so the
+    # next ETL run only needs the new log_data partitions; a new cluster, or one whose
+    # watermark is missing, needs a full load.
+    incremental = started != "created" and has_watermark(main_config, cluster_host)
+    modify_config_file(
+        config_file=main_config_path,
+        config_obj=main_config,
+        config_section="ETL",
+        config_key="LOAD_MODE",
+        config_val="incremental" if incremental else "full"
     )
 
-except Exception as e:
-    print(e)
-    
-print("**********************************************")
-print("Validating cluster availability...")
+    timings["total"] = time.perf_counter() - start
+
+    print("**********************************************")
+    print("Provisioning timing summary")
+    for name, seconds in timings.items():
+        print(f" {name:<46} {seconds:>8.1f}s")
+
+    return timings
+
+
+def main():
+    main_config = configparser.ConfigParser()
+    main_config.read(main_config_path)
+
+    print("**********************************************")
+    print("Establishing boto3 resources and clients...")
+    clients = aws_clients(main_config)
 
-try:
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(clusterHost, DB_NAME, DB_USER, DB_PASSWORD, DB_PORT))
-    conn.close()
+    provision(main_config, clients)
 
-    print("Successfully connected to cluster")
 
-except Exception as e:
-    print(e)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
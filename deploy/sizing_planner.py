@@ -0,0 +1,219 @@
+import argparse
+import configparser
+import glob
+import json
+import os
+import sys
+
+sys.path.append(os.getcwd())
+sys.path.append(os.path.join(os.getcwd(), "src"))
+from util.config_functions import modify_config_file
+from storage import list_objects
+from backends import data_prefix
+
+main_config_path = "dwh.cfg"
+
+# Slices per node, allowed node counts and on-demand price per node hour (us-west-2).
+# Prices change; update them from the Redshift pricing page before relying on the cost.
+NODE_CATALOG = {
+    "dc2.large":    {"slices": 2,  "min_nodes": 1, "max_nodes": 32,  "price": 0.25},
+    "dc2.8xlarge":  {"slices": 16, "min_nodes": 2, "max_nodes": 128, "price": 4.80},
+    "ra3.xlplus":   {"slices": 2,  "min_nodes": 1, "max_nodes": 32,  "price": 1.086},
+    "ra3.4xlarge":  {"slices": 4,  "min_nodes": 2, "max_nodes": 64,  "price": 3.26},
+    "ra3.16xlarge": {"slices": 16, "min_nodes": 2, "max_nodes": 128, "price": 13.04}
+}
+
+# Used until run reports from Redshift loads exist: COPY bytes per second per slice for
+# small gzip-less JSON files, and the per-file overhead that dominates song_data.
+DEFAULT_BYTES_PER_SLICE_SECOND = 2 * 1024 * 1024
+DEFAULT_SECONDS_PER_FILE = 0.05
+
+
+def input_profile(config):
+    """
+    Counts the objects and bytes under the LOG_DATA and SONG_DATA prefixes (or their local
+    directory stand-ins).
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+
+    Returns:
+        dict: key -> {"prefix": ..., "files": ..., "bytes": ...}
+    """
+
+    profile = {}
+
+    for key in ("LOG_DATA", "SONG_DATA"):
+        prefix = data_prefix(config, key)
+        objects = list_objects(prefix)
+        profile[key] = {"prefix": prefix, "files": len(objects), "bytes": sum(size for _, size in objects)}
+
+    return profile
+
+
+def throughput_history(run_log_dir):
+    """
+    Reads the COPY statements of past Redshift ETL run reports and returns the observed
+    load throughput per slice for every node type they ran on.
+
+    Args:
+        run_log_dir (string): directory of the etl_<timestamp>.json run reports
+
+    Returns:
+        dict: node type -> {"bytes_per_slice_second": ..., "copies": ...}
+    """
+
+    totals = {}
+
+    for path in sorted(glob.glob(os.path.join(run_log_dir, "etl_*.json"))):
+        with open(path) as f:
+            report = json.load(f)
+
+        cluster = report.get("cluster")
+        if not cluster or cluster.get("node_type") not in NODE_CATALOG:
+            continue
+
+        slices = NODE_CATALOG[cluster["node_type"]]["slices"] * int(cluster["num_nodes"])
+
+        for entry in report["statements"]:
+            if entry["statement"].startswith("COPY") and entry.get("summary_bytes") and entry["seconds"] > 0:
+                total = totals.setdefault(cluster["node_type"], {"bytes": 0, "slice_seconds": 0, "copies": 0})
+                total["bytes"] += entry["summary_bytes"]
+                total["slice_seconds"] += entry["seconds"] * slices
+                total["copies"] += 1
+
+    return {node_type: {"bytes_per_slice_second": total["bytes"] / total["slice_seconds"], "copies": total["copies"]}
+            for node_type, total in totals.items()}
+
+
+def estimate_load_seconds(profile, slices, bytes_per_slice_second=None):
+    """
+    Estimates the staging load time on a cluster with the given number of slices.  With
+    measured throughput the estimate is total bytes over aggregate throughput; without,
+    the default throughput plus a per-file overhead spread over the slices is used.
+    """
+
+    total_bytes = sum(source["bytes"] for source in profile.values())
+
+    if bytes_per_slice_second:
+        return total_bytes / (slices * bytes_per_slice_second)
+
+    total_files = sum(source["files"] for source in profile.values())
+
+    return (total_bytes / DEFAULT_BYTES_PER_SLICE_SECOND + total_files * DEFAULT_SECONDS_PER_FILE) / slices
+
+
+def plan(profile, history, window_seconds, node_types, max_nodes, overhead_seconds=0):
+    """
+    Evaluates every node type and count of the catalog and picks the cheapest option whose
+    estimated load fits the window; ties go to fewer nodes.  The cost covers the load plus
+    overhead_seconds of cluster time every run pays regardless of size (boot, DDL, inserts).
+    When no option fits, the fastest one is returned.  Node types without throughput
+    history use the per-slice throughput measured on another node type, or the defaults.
+
+    Args:
+        profile (dict): output of input_profile
+        history (dict): output of throughput_history
+        window_seconds (float): load window deadline
+        node_types (list): candidate node types from NODE_CATALOG
+        max_nodes (int): upper bound on the node count
+        overhead_seconds (float): fixed cluster time per run
+
+    Returns:
+        tuple: (chosen option, list of every evaluated option); an option is a dict of
+               node_type, num_nodes, slices, seconds, cost and meets_window
+    """
+
+    fallback = max(history.values(), key=lambda measured: measured["copies"], default=None)
+    options = []
+
+    for node_type in node_types:
+        node = NODE_CATALOG[node_type]
+        measured = history.get(node_type, fallback)
+
+        for num_nodes in range(node["min_nodes"], min(node["max_nodes"], max_nodes) + 1):
+            slices = node["slices"] * num_nodes
+            seconds = estimate_load_seconds(profile, slices, measured and measured["bytes_per_slice_second"])
+            options.append({
+                "node_type": node_type,
+                "num_nodes": num_nodes,
+                "slices": slices,
+                "seconds": seconds,
+                "cost": node["price"] * num_nodes * (seconds + overhead_seconds) / 3600,
+                "meets_window": seconds <= window_seconds
+            })
+
+    fitting = [option for option in options if option["meets_window"]]
+
+    if fitting:
+        chosen = min(fitting, key=lambda option: (option["cost"], option["num_nodes"]))
+    else:
+        chosen = min(options, key=lambda option: option["seconds"])
+
+    return chosen, options
+
+
+def apply_plan(config, chosen):
+    """
+    Writes the chosen node type, node count and slice count to dwh.cfg, for
+    infra_deploy.py and the manifest builder to pick up.
+    """
+
+    for section, key, value in (("CLUSTER", "NODE_TYPE", chosen["node_type"]),
+                                ("CLUSTER", "NUM_NODES", str(chosen["num_nodes"])),
+                                ("CLUSTER", "CLUSTER_TYPE", "single-node" if chosen["num_nodes"] == 1 else "multi-node"),
+                                ("ETL", "MANIFEST_SLICES", str(chosen["slices"]))):
+        modify_config_file(
+            config_file=main_config_path,
+            config_obj=config,
+            config_section=section,
+            config_key=key,
+            config_val=value
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recommend a cluster size that loads the input data within a deadline")
+    parser.add_argument("--apply", action="store_true", help="write the recommendation to dwh.cfg")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(main_config_path)
+
+    window_seconds = config.getfloat("SIZING", "LOAD_WINDOW_MINUTES", fallback=30) * 60
+    node_types = [node_type.strip() for node_type in config.get("SIZING", "NODE_TYPES", fallback=",".join(NODE_CATALOG)).split(",")]
+    max_nodes = config.getint("SIZING", "MAX_NODES", fallback=8)
+    overhead_seconds = config.getfloat("SIZING", "OVERHEAD_MINUTES", fallback=10) * 60
+
+    print("**********************************************")
+    print("Profiling input prefixes...")
+    profile = input_profile(config)
+    for key, source in profile.items():
+        print(f" {key:<10} {source['files']:>10} files {source['bytes'] / 1024 / 1024:>12.1f} MB  {source['prefix']}")
+
+    history = throughput_history(config.get("ETL", "RUN_LOG_DIR", fallback="logs"))
+    for node_type, measured in history.items():
+        print(f" {node_type:<14} {measured['bytes_per_slice_second'] / 1024 / 1024:>8.2f} MB/s per slice over {measured['copies']} COPYs")
+    if not history:
+        print(" No Redshift run reports yet, using default throughput")
+
+    chosen, options = plan(profile, history, window_seconds, node_types, max_nodes, overhead_seconds)
+
+    print("**********************************************")
+    print(f"{'node type':<14} {'nodes':>5} {'slices':>6} {'minutes':>9} {'cost':>8}")
+    for option in sorted(options, key=lambda option: option["cost"])[:10]:
+        print(f"{option['node_type']:<14} {option['num_nodes']:>5} {option['slices']:>6} "
+              f"{option['seconds'] / 60:>9.1f} {option['cost']:>8.3f}{'' if option['meets_window'] else '  misses window'}")
+
+    print("**********************************************")
+    if not chosen["meets_window"]:
+        print(f"No option loads within {window_seconds / 60:.0f} minutes, recommending the fastest")
+    print(f"Recommended: {chosen['num_nodes']} x {chosen['node_type']} ({chosen['slices']} slices), "
+          f"~{chosen['seconds'] / 60:.1f} minutes, ~${chosen['cost']:.3f} per run")
+
+    if args.apply:
+        apply_plan(config, chosen)
+
+
+if __name__ == "__main__":
+    main()
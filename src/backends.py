@@ -0,0 +1,592 @@
+import gzip
+import json
+import os
+import re
+import tempfile
+from datetime import datetime, timezone
+from compaction import iter_records, read_object
+from storage import list_objects
+
+
+def redshift_dsn(config):
+    """
+    Builds the psycopg2 connection string from the [DB] section of dwh.cfg.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+    """
+
+    return "host={} dbname={} user={} password={} port={}".format(*config['DB'].values())
+
+
+def is_local(config):
+    """
+    True when dwh.cfg selects the local offline engine instead of Redshift.
+    """
+
+    return config.get("BACKEND", "ENGINE", fallback="redshift") == "local"
+
+
+def data_prefix(config, key):
+    """
+    Returns the input location for one of the [S3] keys (LOG_DATA, SONG_DATA, LOG_JSONPATH):
+    the S3 URI for Redshift, or its local directory stand-in from [LOCAL] for the local engine.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+        key (string): key present in the [S3] section
+    """
+
+    if is_local(config):
+        return config.get("LOCAL", key)
+
+    return config.get("S3", key)
+
+
+def connect(config):
+    """
+    Opens a DB-API connection to the engine selected in the [BACKEND] section of dwh.cfg.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+
+    Returns:
+        class: psycopg2 connection, or a LocalConnection for the local engine
+    """
+
+    if is_local(config):
+        return LocalConnection(config)
+
+    import psycopg2
+
+    return psycopg2.connect(redshift_dsn(config), **session_args(config))
+
+
+def connection_pool(config, maxconn):
+    """
+    Creates a thread-safe pool of connections to the engine selected in dwh.cfg, exposing
+    psycopg2's getconn/putconn/closeall interface.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+        maxconn (int): maximum number of pooled connections
+    """
+
+    if is_local(config):
+        return LocalConnectionPool(config)
+
+    from psycopg2 import pool
+
+    return pool.ThreadedConnectionPool(1, maxconn, redshift_dsn(config), **session_args(config))
+
+
+def session_args(config):
+    """
+    Extra psycopg2.connect arguments for Redshift sessions.  Every connection keeps a registry
+    of the statements prepared in its session (see execute_prepared), and when ETL_QUERY_GROUP
+    is set in the [WLM] section of dwh.cfg it is opened with SET query_group, so its
+    statements are routed to the ETL queue of the cluster's WLM configuration.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+    """
+
+    query_group = config.get("WLM", "ETL_QUERY_GROUP", fallback="")
+
+    from psycopg2.extensions import connection
+
+    class SessionConnection(connection):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = set()
+            if query_group:
+                with self.cursor() as cur:
+                    cur.execute("SET query_group TO %s", (query_group,))
+                self.commit()
+
+    return {"connection_factory": SessionConnection}
+
+
+def execute_prepared(cur, name, query, params=()):
+    """
+    Executes a statement that runs many times per session as a server-side prepared
+    statement: it is parsed and planned by PREPARE on its first use in the session, and every
+    later call only sends EXECUTE with the parameters.  Connections without a registry of
+    prepared statements (the local engine) execute the statement text as usual.
+
+    Args:
+        cur (class): psycopg2 cursor for db interaction
+        name (string): prepared statement name, unique per statement
+        query (string): SELECT, INSERT, UPDATE or DELETE with %s placeholders
+        params (tuple): parameter values
+    """
+
+    prepared = getattr(cur.connection, "prepared", None)
+
+    if prepared is None:
+        cur.execute(query, params)
+        return
+
+    if name not in prepared:
+        positions = iter(range(1, len(params) + 1))
+        cur.execute(f"PREPARE {name} AS " + re.sub(r"%s", lambda _: f"${next(positions)}", query))
+        prepared.add(name)
+
+    cur.execute(f"EXECUTE {name}" + (f" ({', '.join(['%s'] * len(params))})" if params else ""), params)
+
+
+class LocalConnectionPool:
+    """
+    Connection pool for the local engine.  DuckDB connections are cheap, so each
+    getconn opens a new one on the shared database file.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.connections = []
+
+    def getconn(self):
+        conn = LocalConnection(self.config)
+        self.connections.append(conn)
+        return conn
+
+    def putconn(self, conn):
+        conn.rollback()
+        conn.close()
+        self.connections.remove(conn)
+
+    def closeall(self):
+        for conn in list(self.connections):
+            self.putconn(conn)
+
+
+class LocalConnection:
+    """
+    psycopg2-like connection to an embedded DuckDB database that executes the statements
+    in sql_queries.py offline.  Redshift-only syntax is rewritten by translate(), and COPY
+    statements are executed by reading the matching local JSON files.  Like psycopg2, a
+    transaction is opened by the first statement and ended by commit() or rollback(),
+    unless autocommit is set.  The STV_SLICES and SVV_TABLE_INFO system views are stood
+    in for by temp views, the latter reporting every table as sorted with fresh statistics.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg, using the [LOCAL] section
+    """
+
+    def __init__(self, config):
+        import duckdb
+
+        database = config.get("LOCAL", "DATABASE", fallback=":memory:")
+        if database != ":memory:":
+            os.makedirs(os.path.dirname(database) or ".", exist_ok=True)
+
+        self.db = duckdb.connect(database)
+        self.path_map = {
+            config.get("S3", key).strip("'\""): config.get("LOCAL", key)
+            for key in config["LOCAL"] if key != "database" and config.has_option("S3", key)
+        }
+        self.in_transaction = False
+        self.autocommit = False
+        self.closed = False
+
+        self.db.execute(f"CREATE OR REPLACE TEMP VIEW stv_slices AS SELECT range AS slice FROM range({os.cpu_count() or 1})")
+        self.db.execute("""
+            CREATE OR REPLACE TEMP VIEW svv_table_info AS
+            SELECT table_name AS "table", 0.0 AS unsorted, 0.0 AS stats_off, estimated_size AS tbl_rows,
+                   estimated_size AS estimated_visible_rows, 0 AS size
+            FROM duckdb_tables()
+        """)
+
+    def cursor(self, name=None):
+        return LocalCursor(self, name)
+
+    def begin(self):
+        if not self.in_transaction and not self.autocommit:
+            self.db.execute("BEGIN TRANSACTION")
+            self.in_transaction = True
+
+    def commit(self):
+        if self.in_transaction:
+            self.db.execute("COMMIT")
+            self.in_transaction = False
+
+    def rollback(self):
+        if self.in_transaction:
+            self.db.execute("ROLLBACK")
+            self.in_transaction = False
+
+    def close(self):
+        if not self.closed:
+            self.rollback()
+            self.db.close()
+            self.closed = True
+
+    def resolve(self, path):
+        """
+        Maps an S3 location used in sql_queries.py onto its local stand-in.
+        """
+
+        path = path.strip("'\"")
+
+        for s3_prefix, local_prefix in self.path_map.items():
+            if path.startswith(s3_prefix):
+                return local_prefix + path[len(s3_prefix):]
+
+        return path
+
+
+class LocalCursor:
+    """
+    psycopg2-like cursor of a LocalConnection.  As with psycopg2, an unnamed cursor buffers
+    its whole result client-side (so it survives a commit), while a named cursor streams
+    rows from the engine on demand.
+    """
+
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.connection = conn
+        self.name = name
+        self.result = None
+        self.description = None
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.result = None
+
+    def execute(self, query, params=None):
+        """
+        Executes one or more ';'-separated statements, keeping the result of the last.
+        psycopg2 placeholders in them are bound as DuckDB parameters (see local_parameters).
+        """
+
+        self.conn.begin()
+
+        for statement in split_statements(query):
+            self.description = None
+            self.rowcount = -1
+            self.result = None
+
+            if re.match(r"\s*COPY\s", statement, re.IGNORECASE):
+                self.rowcount = copy_local(self.conn, statement, params)
+                continue
+
+            statement, statement_params = local_parameters(statement, params)
+            self.result = self.conn.db.execute(translate(statement), statement_params)
+
+            if re.match(r"\s*(INSERT|UPDATE|DELETE|REFRESH)\s", statement, re.IGNORECASE):
+                self.rowcount = self.result.fetchone()[0]
+                self.result = None
+            elif re.match(r"\s*(CREATE|DROP|ALTER)\s", statement, re.IGNORECASE):
+                self.result = None
+            else:
+                self.description = self.result.description
+                if self.name is None:
+                    self.result = BufferedResult(self.result.fetchall())
+
+    def fetchone(self):
+        return self.result.fetchone()
+
+    def fetchmany(self, size=1):
+        return self.result.fetchmany(size)
+
+    def fetchall(self):
+        return self.result.fetchall()
+
+
+class BufferedResult:
+    """
+    Client-side copy of a result set, read by an unnamed LocalCursor.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.position = 0
+
+    def fetchmany(self, size=1):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return rows
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+
+def split_statements(query):
+    """
+    Splits SQL text on semicolons that aren't inside quotes, dropping empty statements.
+    """
+
+    statements, current, quote = [], [], None
+
+    for char in query:
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char == ";":
+            statements.append("".join(current))
+            current = []
+            continue
+        current.append(char)
+
+    statements.append("".join(current))
+
+    return [statement for statement in statements if statement.strip()]
+
+
+TRANSLATIONS = [
+    (re.compile(r"\bDISTSTYLE\s+\w+", re.IGNORECASE), ""),
+    (re.compile(r"\b(COMPOUND\s+|INTERLEAVED\s+)?(SORTKEY|DISTKEY)\s*\([^)]*\)", re.IGNORECASE), ""),
+    (re.compile(r"\b(SORTKEY|DISTKEY)\b", re.IGNORECASE), ""),
+    (re.compile(r"\bENCODE\s+\w+", re.IGNORECASE), ""),
+    (re.compile(r"\bPRIMARY\s+KEY\b", re.IGNORECASE), ""),
+    (re.compile(r"\bnumeric\b(?!\s*\()", re.IGNORECASE), "DECIMAL(18,0)"),
+    (re.compile(r"\bGETDATE\(\)", re.IGNORECASE), "current_localtimestamp()"),
+    (re.compile(r"^\s*VACUUM\s+(?:FULL|SORT\s+ONLY|DELETE\s+ONLY|REINDEX)\s+(\w+).*$", re.IGNORECASE | re.DOTALL), r"VACUUM \1"),
+    (re.compile(r"\bPREDICATE\s+COLUMNS\b", re.IGNORECASE), ""),
+]
+
+
+def replace_function(statement, name, template):
+    """
+    Replaces every call name(args) in a statement with template.format(args), matching
+    the call's parentheses so nested calls in the arguments are kept intact.
+    """
+
+    pattern = re.compile(rf"\b{name}\s*\(", re.IGNORECASE)
+
+    while True:
+        match = pattern.search(statement)
+        if not match:
+            return statement
+
+        depth, end = 1, match.end()
+        while depth:
+            depth += {"(": 1, ")": -1}.get(statement[end], 0)
+            end += 1
+
+        statement = statement[:match.start()] + template.format(statement[match.end():end - 1]) + statement[end:]
+
+
+def translate_materialized_view(statement):
+    """
+    DuckDB has no materialized views: one is stood in for by a table holding its rows plus a
+    <name>_definition view holding its query, and a refresh replaces the table's rows with
+    the view's.  Returns None for any other statement.
+    """
+
+    create = re.match(r"\s*CREATE\s+MATERIALIZED\s+VIEW\s+(\w+)\s.*?\bAS\b(.*)$", statement, re.IGNORECASE | re.DOTALL)
+    if create:
+        name, query = create.groups()
+        return f"CREATE OR REPLACE VIEW {name}_definition AS{query};\nCREATE TABLE {name} AS SELECT * FROM {name}_definition"
+
+    refresh = re.match(r"\s*REFRESH\s+MATERIALIZED\s+VIEW\s+(\w+)", statement, re.IGNORECASE)
+    if refresh:
+        name = refresh.group(1)
+        return f"DELETE FROM {name};\nINSERT INTO {name} SELECT * FROM {name}_definition"
+
+    drop = re.match(r"\s*DROP\s+MATERIALIZED\s+VIEW\s+IF\s+EXISTS\s+(\w+)", statement, re.IGNORECASE)
+    if drop:
+        name = drop.group(1)
+        return f"DROP TABLE IF EXISTS {name};\nDROP VIEW IF EXISTS {name}_definition"
+
+    return None
+
+
+def local_parameters(statement, params):
+    """
+    Rewrites psycopg2 placeholders into DuckDB's parameter style, %(name)s into $name and %s
+    into ?, and %% back into %, so values are bound by the engine instead of being spliced
+    into the statement text.
+
+    Args:
+        statement (string): one SQL statement
+        params (dict|tuple): psycopg2 query parameters, None when there are none
+
+    Returns:
+        tuple: (statement, the parameters it uses or None)
+    """
+
+    if params is None:
+        return statement, None
+
+    names = []
+
+    def placeholder(match):
+        if match.group(0) == "%%":
+            return "%"
+        if match.group(1):
+            names.append(match.group(1))
+            return f"${match.group(1)}"
+        return "?"
+
+    statement = re.sub(r"%\((\w+)\)s|%s|%%", placeholder, statement)
+
+    if isinstance(params, dict):
+        return statement, {name: params[name] for name in names} or None
+
+    return statement, list(params) or None
+
+
+def translate(statement):
+    """
+    Rewrites Redshift-only syntax into DuckDB SQL: dist/sort keys, encodings and
+    (unenforced) primary keys are dropped, IDENTITY columns become sequence defaults,
+    Redshift functions are swapped for their DuckDB equivalents and materialized views
+    are stood in for by tables.
+
+    Args:
+        statement (string): single SQL statement from sql_queries.py
+
+    Returns:
+        string: DuckDB statement
+    """
+
+    view = translate_materialized_view(statement)
+    if view:
+        return view
+
+    for pattern, replacement in TRANSLATIONS:
+        statement = pattern.sub(replacement, statement)
+
+    statement = replace_function(statement, "FNV_HASH", "CAST(hash({}) >> 1 AS BIGINT)")
+
+    create = re.match(r"\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", statement, re.IGNORECASE)
+    identity = re.search(r"IDENTITY\s*\(\s*(\d+)\s*,\s*(\d+)\s*\)", statement, re.IGNORECASE)
+
+    if create and identity:
+        sequence = f"{create.group(1)}_identity_seq"
+        statement = (f"CREATE SEQUENCE IF NOT EXISTS {sequence} INCREMENT {identity.group(2)} MINVALUE {identity.group(1)} START {identity.group(1)};\n"
+                     + statement[:identity.start()] + f"DEFAULT nextval('{sequence}')" + statement[identity.end():])
+
+    drop = re.match(r"\s*DROP\s+TABLE\s+IF\s+EXISTS\s+(\w+)", statement, re.IGNORECASE)
+    if drop:
+        statement += f";\nDROP SEQUENCE IF EXISTS {drop.group(1)}_identity_seq"
+
+    return statement
+
+
+def copy_files(source):
+    """
+    Lists the local files matched by a COPY source, which like an S3 prefix may be a
+    directory, a file, or the leading part of file names.
+    """
+
+    if os.path.isdir(source) or os.path.isfile(source):
+        return [path for path, _ in list_objects(source)] if os.path.isdir(source) else [source]
+
+    directory, prefix = os.path.split(source)
+    files = []
+
+    for name in sorted(os.listdir(directory or ".")):
+        if name.startswith(prefix):
+            files.extend(copy_files(os.path.join(directory, name)))
+
+    return files
+
+
+def read_text(path):
+    """
+    Reads a local data file, transparently decompressing .gz files.
+    """
+
+    if path.endswith(".gz"):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return f.read()
+
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def jsonpath_keys(path):
+    """
+    Reads the field names out of a Redshift jsonpaths file ($['field'] or $.field entries),
+    from S3 or a local file.
+    """
+
+    paths = json.loads(read_object(path))["jsonpaths"]
+
+    return [re.sub(r"^\$(\[['\"]|\.)|['\"]\]$", "", jsonpath) for jsonpath in paths]
+
+
+def copy_local(conn, statement, params=None):
+    """
+    Executes a Redshift COPY ... JSON statement against local files: the source (or the
+    entries of a MANIFEST) is resolved to local JSON/NDJSON files, optionally gzip'd,
+    whose fields are mapped onto the table by jsonpaths or 'auto' name matching, with
+    'epochmillisecs' timestamps converted, then bulk inserted through DuckDB.
+
+    Args:
+        conn (class): LocalConnection executing the statement
+        statement (string): COPY statement
+        params (dict): psycopg2 query parameters, e.g. the source of a %(source)s placeholder
+
+    Returns:
+        int: number of rows loaded
+    """
+
+    match = re.match(r"\s*COPY\s+(\w+)\s*(?:\(([^)]*)\))?\s+FROM\s+'?([^'\s]+)'?", statement, re.IGNORECASE)
+    table, column_list, source = match.groups()
+
+    parameter = re.fullmatch(r"%\((\w+)\)s", source)
+    if parameter:
+        source = params[parameter.group(1)]
+
+    table_columns = conn.db.execute(f"DESCRIBE {table}").fetchall()
+    types = {name.lower(): column_type for name, column_type, *_ in table_columns}
+    columns = [name.strip().lower() for name in column_list.split(",")] if column_list else list(types)
+
+    json_option = re.search(r"\bJSON\s+'([^']*)'", statement, re.IGNORECASE).group(1)
+    epoch_millis = re.search(r"timeformat\s+(?:as\s+)?'epochmillisecs'", statement, re.IGNORECASE)
+    keys = None if json_option.lower().startswith("auto") else jsonpath_keys(conn.resolve(json_option))
+
+    if re.search(r"\bMANIFEST\b", statement, re.IGNORECASE):
+        with open(conn.resolve(source), encoding="utf-8") as f:
+            files = [conn.resolve(entry["url"]) for entry in json.load(f)["entries"]]
+    else:
+        files = copy_files(conn.resolve(source))
+
+    fd, staged = tempfile.mkstemp(suffix=".json")
+    rows = 0
+
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as out:
+            for path in files:
+                for record in iter_records(read_text(path)):
+                    if keys is None:
+                        record = {key.lower(): value for key, value in record.items()}
+                        values = [record.get(column) for column in columns]
+                    else:
+                        values = [record.get(key) for key in keys]
+
+                    row = {}
+                    for column, value in zip(columns, values):
+                        if value is not None and epoch_millis and types[column].startswith("TIMESTAMP"):
+                            value = datetime.fromtimestamp(value / 1000, timezone.utc).replace(tzinfo=None).isoformat()
+                        row[column] = None if value is None else str(value)
+
+                    out.write(json.dumps(row) + "\n")
+                    rows += 1
+
+        if rows:
+            select = ", ".join(f"CAST(NULLIF({column}, '') AS {types[column]})" if types[column] != "VARCHAR" else column
+                               for column in columns)
+            read = "read_json('{}', format='newline_delimited', columns={{{}}})".format(
+                staged, ", ".join(f"'{column}': 'VARCHAR'" for column in columns))
+            conn.db.execute(f"INSERT INTO {table} ({', '.join(columns)}) SELECT {select} FROM {read}")
+
+    finally:
+        os.remove(staged)
+
+    return rows
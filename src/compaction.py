@@ -0,0 +1,191 @@
+import gzip
+import json
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from storage import list_objects, split_s3_uri, submit_bounded
+
+
+def plan_batches(objects, target_bytes):
+    """
+    Streams (path, size) tuples into lists of paths whose raw size adds up to roughly
+    target_bytes, so only one batch of paths is held in memory at a time.
+
+    Args:
+        objects (iterable): (path, size in bytes) tuples, e.g. from storage.list_objects
+        target_bytes (int): uncompressed bytes per batch
+
+    Yields:
+        list: paths of one batch
+    """
+
+    batch, batch_bytes = [], 0
+
+    for path, size in objects:
+        batch.append(path)
+        batch_bytes += size
+
+        if batch_bytes >= target_bytes:
+            yield batch
+            batch, batch_bytes = [], 0
+
+    if batch:
+        yield batch
+
+
+def read_object(path):
+    """
+    Reads an S3 object or local file as text.
+
+    Args:
+        path (string): s3:// URI or local file path
+    """
+
+    if path.startswith("s3://"):
+        import boto3
+
+        bucket, key = split_s3_uri(path)
+        return boto3.client("s3").get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8")
+
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def iter_records(text):
+    """
+    Parses every JSON object in a file, whether it holds a single object (song_data) or
+    one object per line (log_data).
+
+    Args:
+        text (string): file contents
+
+    Yields:
+        dict: parsed JSON object
+    """
+
+    decoder = json.JSONDecoder()
+    pos = 0
+
+    while True:
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        if pos >= len(text):
+            return
+        record, pos = decoder.raw_decode(text, pos)
+        yield record
+
+
+def write_output(local_path, location):
+    """
+    Moves a finished batch from its local temp file to its output location.
+
+    Args:
+        local_path (string): local temp file holding the batch
+        location (string): s3:// URI or local path the batch is published to
+    """
+
+    if location.startswith("s3://"):
+        import boto3
+
+        bucket, key = split_s3_uri(location)
+        boto3.client("s3").upload_file(local_path, bucket, key)
+        os.remove(local_path)
+
+    else:
+        os.makedirs(os.path.dirname(location) or ".", exist_ok=True)
+        os.replace(local_path, location)
+
+
+def compact_batch(paths, location):
+    """
+    Process pool worker: parses every file of a batch and streams its records as
+    gzip-compressed newline-delimited JSON into a single output object.
+
+    Args:
+        paths (list): input files of the batch
+        location (string): s3:// URI or local path of the output object
+
+    Returns:
+        dict: file, record and byte counts of the batch
+    """
+
+    raw_bytes = records = 0
+    fd, local_path = tempfile.mkstemp(suffix=".json.gz")
+
+    with os.fdopen(fd, "wb") as f, gzip.GzipFile(fileobj=f, mode="wb") as out:
+        for path in paths:
+            text = read_object(path)
+            raw_bytes += len(text.encode("utf-8"))
+            for record in iter_records(text):
+                out.write(json.dumps(record).encode("utf-8") + b"\n")
+                records += 1
+
+    compressed_bytes = os.path.getsize(local_path)
+    write_output(local_path, location)
+
+    return {"location": location, "files": len(paths), "records": records,
+            "raw_bytes": raw_bytes, "compressed_bytes": compressed_bytes}
+
+
+def compact(source_prefix, output_prefix, target_bytes, workers):
+    """
+    Packs every small JSON file under a prefix into gzip'd NDJSON batches of about
+    target_bytes (uncompressed).  Batches are parsed and compressed on a process pool;
+    at most two batches per worker are in flight, so memory stays bounded however many
+    input files there are.
+
+    Args:
+        source_prefix (string): S3 prefix or local directory of the input JSON files
+        output_prefix (string): S3 prefix or local directory the batches are written to
+        target_bytes (int): uncompressed bytes per batch
+        workers (int): process pool size
+
+    Returns:
+        dict: file, record and byte totals across all batches
+    """
+
+    output_prefix = output_prefix.strip("'\"").rstrip("/")
+    if not output_prefix:
+        raise ValueError("compact needs an output prefix, batches would be written from the filesystem root")
+
+    batches = plan_batches(list_objects(source_prefix), target_bytes)
+    totals = {"batches": 0, "files": 0, "records": 0, "raw_bytes": 0, "compressed_bytes": 0}
+
+    def collect(futures):
+        for future in futures:
+            add_totals(totals, future.result())
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        submit_bounded(executor, compact_batch,
+                       ((paths, f"{output_prefix}/batch_{i:05d}.json.gz") for i, paths in enumerate(batches)),
+                       workers * 2, collect)
+
+    return totals
+
+
+def add_totals(totals, batch):
+    """
+    Adds the stats of a finished batch to the running totals of a compaction.
+    """
+
+    totals["batches"] += 1
+    for key in ("files", "records", "raw_bytes", "compressed_bytes"):
+        totals[key] += batch[key]
+
+
+def gzip_copy(query, prefix):
+    """
+    Rewrites a COPY statement to load compacted batches from a prefix with the GZIP option.
+
+    Args:
+        query (string): COPY statement from sql_queries.py
+        prefix (string): S3 prefix of the compacted batches
+
+    Returns:
+        string: COPY statement reading the gzip'd batches
+    """
+
+    query = re.sub(r"FROM\s+\S+", lambda _: f"FROM '{prefix}'", query, count=1)
+
+    return query.rstrip() + "\n GZIP\n"
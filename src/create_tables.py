@@ -1,53 +1,284 @@
+import argparse
 import configparser
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+import re
+from backends import connect, is_local
+from instrumentation import InstrumentedCursor, RunReport, report_queue_times
+from sql_queries import create_table_queries, drop_table_queries, create_view_queries, drop_view_queries, tables, rollup_views
 
-def drop_tables(cur, conn):
+REDSHIFT_CATALOG_QUERY = """
+ SELECT tablename, "column", type, encoding, distkey, sortkey
+ FROM pg_table_def
+ WHERE schemaname = 'public'
+"""
+
+LOCAL_CATALOG_QUERY = """
+ SELECT table_name, column_name, data_type
+ FROM information_schema.columns
+ WHERE table_schema = 'main'
+"""
+
+RELATIONS_QUERY = """
+ SELECT table_name
+ FROM information_schema.tables
+ WHERE table_schema IN ('public', 'main')
+"""
+
+# Model types as the Redshift catalog spells them, and the local engine's catalog types
+# mapped onto the same names
+REDSHIFT_TYPES = {"VARCHAR": "character varying", "CHAR": "character", "DOUBLE PRECISION": "double precision",
+                  "NUMERIC": "numeric", "INT": "integer", "INTEGER": "integer", "BIGINT": "bigint",
+                  "SMALLINT": "smallint", "TIMESTAMP": "timestamp without time zone", "DATE": "date",
+                  "BOOLEAN": "boolean"}
+LOCAL_TYPES = {"VARCHAR": "character varying", "DOUBLE": "double precision", "INTEGER": "integer", "BIGINT": "bigint",
+               "SMALLINT": "smallint", "TIMESTAMP": "timestamp without time zone", "DATE": "date", "BOOLEAN": "boolean"}
+
+
+def apply_schema(cur, conn, statements):
     """
-    This function loops through the drop_table_queries list imported from sql_queries.py,
-    dropping all tables if they exist in the Redshift database.
+    Sends DDL statements to the database as one batch in a single transaction: one round
+    trip and one commit instead of one per statement, and a failure part way through rolls
+    the whole set back instead of leaving a half-built schema.
 
     Args:
         cur (class): psycopg2 cursor for db interaction
         conn (class): psycopg2 db connection session
+        statements (list): DDL statements in execution order
     """
-    
-    print("Dropping existing tables...")
-    for query in drop_table_queries:
-        cur.execute(query)
+
+    if not statements:
+        print("Schema is up to date, nothing to apply \n")
+        return
+
+    print(f"Applying {len(statements)} DDL statements in one transaction...")
+    try:
+        cur.execute(";\n".join(statements))
         conn.commit()
-    print("Existing tables dropped! \n")
+    except Exception:
+        conn.rollback()
+        raise
+    print("Schema applied! \n")
+
+
+def model_type(column, redshift=True):
+    """
+    The type of a model column as the catalog reports it, e.g. character varying(256).  The
+    local engine doesn't keep VARCHAR/CHAR lengths, so they are left out there.
+    """
+
+    name = REDSHIFT_TYPES.get(column.type.upper(), column.type.lower())
+    length = column.length or ("18,0" if name == "numeric" else None)
+
+    if length and (redshift or name not in ("character varying", "character")):
+        return f"{name}({str(length).replace(' ', '')})"
+
+    return name
+
+
+def catalog_type(data_type):
+    """
+    Maps a local engine catalog type, e.g. DECIMAL(18,0), onto the names model_type uses.
+    """
+
+    decimal = re.match(r"DECIMAL\((\d+),(\d+)\)", data_type)
+    if decimal:
+        return "numeric({},{})".format(*decimal.groups())
+
+    return LOCAL_TYPES.get(data_type, data_type.lower())
 
 
-def create_tables(cur, conn):
+def read_catalog(cur, redshift):
     """
-    This function loops through the create_table_queries list imported from sql_queries.py,
-    creating the staging, fact, and dimension tables in the Redshift database.
+    Reads the columns of every table in the database: type, encoding, distribution key and
+    sort key position from PG_TABLE_DEF on Redshift, the type from information_schema for
+    the local engine.
+
+    Args:
+        cur (class): psycopg2 cursor for db interaction
+        redshift (bool): whether the connection is Redshift
+
+    Returns:
+        dict: table -> {column -> {"type", and on Redshift "encoding", "distkey", "sortkey"}}
+    """
+
+    catalog = {}
+
+    if redshift:
+        cur.execute(REDSHIFT_CATALOG_QUERY)
+        for table, column, data_type, encoding, distkey, sortkey in cur.fetchall():
+            catalog.setdefault(table, {})[column.lower()] = {"type": data_type, "encoding": encoding,
+                                                             "distkey": bool(distkey), "sortkey": int(sortkey)}
+    else:
+        cur.execute(LOCAL_CATALOG_QUERY)
+        for table, column, data_type in cur.fetchall():
+            catalog.setdefault(table, {})[column.lower()] = {"type": catalog_type(data_type)}
+
+    return catalog
+
+
+def table_differences(table, columns, redshift=True):
+    """
+    Compares a table of the model with its columns in the catalog.
+
+    Args:
+        table (class): table_model.Table
+        columns (dict): the table's entry of read_catalog
+        redshift (bool): whether the catalog is Redshift's, which also has encodings and keys
+
+    Returns:
+        list: the differences, empty when the table matches the model
+    """
+
+    differences = []
+    model_columns = {column.name.lower(): column for column in table.columns}
+
+    for name in model_columns.keys() - columns.keys():
+        differences.append(f"column {name} missing")
+    for name in columns.keys() - model_columns.keys():
+        differences.append(f"column {name} not in the model")
+
+    for name, column in model_columns.items():
+        if name not in columns:
+            continue
+
+        actual = columns[name]
+        expected = {"type": model_type(column, redshift)}
+
+        if redshift:
+            sortkey = [key.lower() for key in table.sortkey]
+            position = sortkey.index(name) + 1 if name in sortkey else 0
+            expected.update(distkey=name == (table.distkey or "").lower(),
+                            sortkey=-position if table.sortkey_style == "INTERLEAVED" else position)
+            if column.encoding:
+                expected["encoding"] = "none" if column.encoding.upper() == "RAW" else column.encoding.lower()
+
+        for attribute, value in expected.items():
+            if actual[attribute] != value:
+                differences.append(f"{name} {attribute} {actual[attribute]} -> {value}")
+
+    return differences
+
+
+def view_tables(view):
+    """
+    Names of the tables a rollup view reads.
+    """
+
+    return set(re.findall(r"\b(?:FROM|JOIN)\s+(\w+)", view.query, re.IGNORECASE))
+
+
+def plan_schema(catalog, relations, redshift=True):
+    """
+    Diffs the model against the catalog and returns the DDL that brings the database in line:
+    tables whose definition changed are dropped and recreated, missing tables and views are
+    created, and views are rebuilt when a table they read is created or rebuilt.  Everything else,
+    including its data, is left untouched, so an unchanged schema needs no statements.
+
+    Args:
+        catalog (dict): output of read_catalog
+        relations (set): names of the tables and views in the database
+        redshift (bool): whether the catalog is Redshift's
+
+    Returns:
+        tuple: (DDL statements in execution order, dict of table/view -> reason)
+    """
+
+    reasons = {}
+
+    for table in tables:
+        if table.name not in catalog:
+            reasons[table.name] = "missing"
+        else:
+            differences = table_differences(table, catalog[table.name], redshift)
+            if differences:
+                reasons[table.name] = "changed: " + ", ".join(differences)
+
+    rebuilt = {name for name, reason in reasons.items() if reason != "missing"}
+    created = set(reasons)
+
+    for view in rollup_views:
+        if view.name not in relations:
+            reasons[view.name] = "missing"
+        elif view_tables(view) & created:
+            reasons[view.name] = "reads rebuilt " + ", ".join(sorted(view_tables(view) & created))
+
+    statements = [view.drop_sql() for view in rollup_views if view.name in reasons and view.name in relations]
+    statements += [table.drop_sql() for table in tables if table.name in rebuilt]
+    statements += [table.create_sql() for table in tables if table.name in reasons]
+    statements += [view.create_sql() for view in rollup_views if view.name in reasons]
+
+    return statements, reasons
+
+
+def ensure_schema(cur, conn, redshift=True):
+    """
+    Brings the schema in line with the model in one transaction, rebuilding only the tables
+    and views that differ from the catalog (see plan_schema).
 
     Args:
         cur (class): psycopg2 cursor for db interaction
         conn (class): psycopg2 db connection session
+        redshift (bool): whether the connection is Redshift
+
+    Returns:
+        dict: table/view -> reason it was created or rebuilt
     """
 
-    print("Creating new tables...")
-    for query in create_table_queries:
-        cur.execute(query)
-        conn.commit()
-    print("New tables created!")
+    print("Comparing the table model with the catalog...")
+    catalog = read_catalog(cur, redshift)
+    cur.execute(RELATIONS_QUERY)
+    relations = {row[0] for row in cur.fetchall()}
+    conn.commit()
+
+    statements, reasons = plan_schema(catalog, relations, redshift)
+    for name, reason in reasons.items():
+        print(f" {name}: {reason}")
+
+    apply_schema(cur, conn, statements)
+
+    return reasons
+
+
+def reset_schema(cur, conn):
+    """
+    Drops and recreates every table and rollup view of the model in one transaction.
+
+    Args:
+        cur (class): psycopg2 cursor for db interaction
+        conn (class): psycopg2 db connection session
+    """
+
+    print("Dropping and recreating all tables...")
+    apply_schema(cur, conn, drop_view_queries + drop_table_queries + create_table_queries + create_view_queries)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Create the staging, fact and dimension tables and the rollup views")
+    parser.add_argument("--mode", choices=("reset", "ensure"),
+                        help="reset drops and recreates everything, ensure only rebuilds what differs from the model "
+                             "(default: SCHEMA_MODE in dwh.cfg)")
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
+    mode = args.mode or config.get("ETL", "SCHEMA_MODE", fallback="reset")
+
+    conn = connect(config)
+    report = RunReport("create_tables", redshift=not is_local(config))
+    cur = InstrumentedCursor(conn.cursor(), report)
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['DB'].values()))
-    cur = conn.cursor()
+    if mode == "ensure":
+        with report.step("ensure_schema"):
+            report.extras["schema_changes"] = ensure_schema(cur, conn, report.redshift)
+    else:
+        with report.step("reset_schema"):
+            reset_schema(cur, conn)
 
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    if report.redshift:
+        report_queue_times(conn.cursor(), report)
 
     conn.close()
+    report.write(config.get("ETL", "RUN_LOG_DIR", fallback="logs"))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
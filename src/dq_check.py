@@ -1,34 +1,105 @@
 import configparser
-import psycopg2
-from sql_queries import count_table_queries
+from backends import connect, connection_pool, is_local
+from dq_engine import run_checks, run_table_checks
+from instrumentation import InstrumentedCursor, RunReport, report_queue_times
+from sql_queries import dq_checks
 
-def table_validation(cur, conn):
+def print_results(results):
     """
-    This function loops through the count_table_queries list imported from sql_queries.py,
-    returning row counts for all fact and dimension tables in the Redshift database.
+    Prints the metrics of every table and any failed checks.
+
+    Args:
+        results (dict): table -> {"metrics": {...}, "failures": [...]} from dq_engine
+    """
+
+    for table, result in results.items():
+        metrics = ", ".join(f"{name} = {value}" for name, value in result["metrics"].items())
+        print(f"{table}: {metrics}")
+        for failure in result["failures"]:
+            print(f" FAILED: {failure}")
+        print()
+
+
+def table_validation(cur, conn, catalog=False):
+    """
+    This function runs the checks declared in dq_checks (imported from sql_queries.py)
+    table by table, one aggregate scan per table, returning row counts, NULL key rates,
+    duplicate keys, orphaned foreign keys and time coverage for all tables in the
+    Redshift database.
 
     Args:
         cur (class): psycopg2 cursor for db interaction
         conn (class): psycopg2 db connection session
+        catalog (bool): answer catalog row counts from the system tables (Redshift only)
+
+    Returns:
+        dict: table -> {"metrics": {...}, "failures": [...]}
     """
 
-    print("Validating table row counts...")
-    for query in count_table_queries:
-        cur.execute(query)
+    print("Validating tables...")
+    results = {}
+    for table, checks in dq_checks.items():
+        results[table] = run_table_checks(cur, table, checks, catalog)
         conn.commit()
-        print(query + " = " + str(cur.fetchone()[0]) + "\n")
+
+    print_results(results)
+
+    return results
+
+
+def table_validation_parallel(config, workers, report=None):
+    """
+    Parallel alternative to table_validation, checking up to workers tables at once on
+    pooled connections.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+        workers (int): number of tables checked at once
+        report (class): optional instrumentation.RunReport recording every statement
+
+    Returns:
+        dict: table -> {"metrics": {...}, "failures": [...]}
+    """
+
+    print(f"Validating tables with {workers} workers...")
+    conn_pool = connection_pool(config, workers)
+
+    try:
+        results = run_checks(conn_pool, dq_checks, workers, not is_local(config), report)
+    finally:
+        conn_pool.closeall()
+
+    print_results(results)
+
+    return results
+
 
 def main():
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['DB'].values()))
-    cur = conn.cursor()
-    
-    table_validation(cur, conn)
+    report = RunReport("dq_check", redshift=not is_local(config))
+    workers = config.getint("DQ", "WORKERS", fallback=1)
+
+    with report.step("table_validation"):
+        if workers > 1:
+            results = table_validation_parallel(config, workers, report)
+        else:
+            conn = connect(config)
+            results = table_validation(InstrumentedCursor(conn.cursor(), report), conn, not is_local(config))
+            conn.close()
+
+    report.extras["dq"] = results
+    failed = sum(len(result["failures"]) for result in results.values())
+    print(f"{failed} data quality checks failed")
+
+    if report.redshift:
+        conn = connect(config)
+        report_queue_times(conn.cursor(), report)
+        conn.close()
 
-    conn.close()
+    report.write(config.get("ETL", "RUN_LOG_DIR", fallback="logs"))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,148 @@
+from concurrent.futures import ThreadPoolExecutor
+from backends import execute_prepared
+from instrumentation import InstrumentedCursor
+
+CATALOG_ROW_COUNT_QUERY = """
+ SELECT SUM(rows)
+ FROM stv_tbl_perm
+ WHERE TRIM(name) = %s
+  AND db_id = (SELECT oid FROM pg_database WHERE datname = CURRENT_DATABASE())
+"""
+
+
+def compile_checks(table, checks):
+    """
+    Compiles every check declared for a table into a single aggregate query, so the
+    table is scanned once no matter how many checks it has.  Orphan checks LEFT JOIN the
+    distinct keys of the referenced table.
+
+    Args:
+        table (string): table name
+        checks (dict): declared checks, see dq_checks in sql_queries.py
+
+    Returns:
+        tuple: (SQL statement, list of metric names in select order)
+    """
+
+    selects, metrics, joins = ["COUNT(*)"], ["row_count"], []
+
+    for column in checks.get("not_null", []):
+        selects.append(f"SUM(CASE WHEN t.{column} IS NULL THEN 1 ELSE 0 END)")
+        metrics.append(f"null_{column}")
+
+    if "unique" in checks:
+        column = checks["unique"]
+        selects.append(f"COUNT(t.{column}) - COUNT(DISTINCT t.{column})")
+        metrics.append(f"duplicate_{column}")
+
+    for i, (column, (parent, parent_column)) in enumerate(checks.get("orphans", {}).items()):
+        joins.append(f" LEFT JOIN (SELECT DISTINCT {parent_column} FROM {parent}) o{i}\n  ON (o{i}.{parent_column} = t.{column})")
+        selects.append(f"SUM(CASE WHEN t.{column} IS NOT NULL AND o{i}.{parent_column} IS NULL THEN 1 ELSE 0 END)")
+        metrics.append(f"orphan_{column}")
+
+    if "time_coverage" in checks:
+        column = checks["time_coverage"]
+        selects += [f"MIN(t.{column})", f"MAX(t.{column})", f"COUNT(DISTINCT DATE_TRUNC('day', t.{column}))"]
+        metrics += ["min_time", "max_time", "days_covered"]
+
+    query = "SELECT\n  " + ",\n  ".join(selects) + f"\n FROM {table} t\n" + "\n".join(joins)
+
+    return query, metrics
+
+
+def evaluate(metrics):
+    """
+    Turns the metrics of one table into failed check descriptions: empty tables, NULL
+    business keys, duplicate primary keys, orphaned foreign keys and days missing between
+    the first and last timestamp.
+
+    Args:
+        metrics (dict): metric name -> value from the compiled query
+
+    Returns:
+        list: failure descriptions, empty when every check passed
+    """
+
+    failures = []
+    row_count = metrics["row_count"]
+
+    if not row_count:
+        failures.append("table is empty")
+
+    for name, value in list(metrics.items()):
+        if name.startswith("null_") and value:
+            failures.append(f"{value} NULL {name[5:]} ({value / row_count:.2%})")
+            metrics[f"{name}_rate"] = value / row_count
+        elif name.startswith(("duplicate_", "orphan_")) and value:
+            failures.append(f"{value} {name.replace('_', ' ', 1)}")
+
+    if metrics.get("min_time") is not None:
+        gap_days = (metrics["max_time"].date() - metrics["min_time"].date()).days + 1 - metrics["days_covered"]
+        metrics["days_missing"] = gap_days
+        if gap_days:
+            failures.append(f"{gap_days} days without rows between {metrics['min_time']} and {metrics['max_time']}")
+
+    return failures
+
+
+def run_table_checks(cur, table, checks, catalog=True):
+    """
+    Runs the checks of one table.  A table whose only check is a catalog row count is
+    answered from STV_TBL_PERM of the current database without scanning; everything else
+    runs as one compiled aggregate query.  STV_TBL_PERM still counts deleted rows until
+    they are vacuumed away, so the catalog count is only declared for tables that are
+    never cleared with DELETE.
+
+    Args:
+        cur (class): psycopg2 cursor for db interaction
+        table (string): table name
+        checks (dict): declared checks
+        catalog (bool): whether system catalog tables are available (False on the local engine)
+
+    Returns:
+        dict: {"metrics": {...}, "failures": [...]}
+    """
+
+    if checks == {"row_count": "catalog"} and catalog:
+        execute_prepared(cur, "catalog_row_count", CATALOG_ROW_COUNT_QUERY, (table,))
+        metrics = {"row_count": cur.fetchone()[0] or 0}
+
+    else:
+        query, names = compile_checks(table, checks)
+        cur.execute(query)
+        metrics = dict(zip(names, cur.fetchone()))
+
+    return {"metrics": metrics, "failures": evaluate(metrics)}
+
+
+def run_checks(conn_pool, declared_checks, workers, catalog=True, report=None):
+    """
+    Runs the checks of every table concurrently, one pooled connection per table.
+
+    Args:
+        conn_pool (class): connection pool from backends.connection_pool
+        declared_checks (dict): table -> declared checks
+        workers (int): number of tables checked at once
+        catalog (bool): whether system catalog tables are available
+        report (class): optional instrumentation.RunReport recording every statement
+
+    Returns:
+        dict: table -> {"metrics": {...}, "failures": [...]}, in declaration order
+    """
+
+    def check(table):
+        conn = conn_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                if report is not None:
+                    cur = InstrumentedCursor(cur, report, f"dq_{table}")
+                result = run_table_checks(cur, table, declared_checks[table], catalog)
+            conn.commit()
+            return result
+        finally:
+            conn_pool.putconn(conn)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(check, declared_checks))
+
+    return dict(zip(declared_checks, results))
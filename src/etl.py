@@ -1,54 +1,513 @@
+import argparse
 import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sql_queries import copy_table_queries, insert_table_queries, etl_graph, landing_tables, landing_insert_queries, get_song_match_counts, clear_table_queries
+from sql_queries import (staging_events_partition_copy, staging_events_clear, staging_events_copy, staging_songs_copy,
+                         get_count_staging_songs, get_log_data_watermark, log_data_watermark_update,
+                         merge_events_queries, merge_songs_queries, upsert_events_queries, upsert_songs_queries,
+                         songplays_table_insert, calendar_merge, time_table_merge, dimension_upserts, upsert_graph,
+                         rollup_views, get_view_refresh_status)
+from scheduler import run_graph
+from manifests import build_manifest_copy, get_slice_count
+from compaction import compact, gzip_copy
+from storage import log_partitions, partitions_after
+from backends import connect, connection_pool, data_prefix, execute_prepared, is_local
+from instrumentation import InstrumentedCursor, RunReport, report_queue_times
+from journal import RunJournal, copy_sources
+from maintenance import run_maintenance
 
 
-def load_staging_tables(cur, conn):
+def copy_target(query):
+    """
+    The staging table a COPY statement loads, through its landing table.
+    """
+
+    return landing_tables[query.split()[1]]
+
+
+def load_staging_tables(cur, conn, queries=copy_table_queries):
     """
     This function loops through the copy_table_queries list imported from sql_queries.py,
-    copying S3 bucket datasets into staging tables in the Redshift database.
+    copying S3 bucket datasets into staging tables in the Redshift database.  Each staging
+    table is cleared, copied into its landing table and filled from it with match keys in
+    one transaction.
 
     Args:
         cur (class): psycopg2 cursor for db interaction
         conn (class): psycopg2 db connection session
+        queries (list): COPY statements to run, defaults to copy_table_queries
     """
 
     print("Loading staging tables from S3...")
-    for query in copy_table_queries:
-        cur.execute(query)
+    for table in dict.fromkeys(copy_target(query) for query in queries):
+        cur.execute(clear_table_queries[table])
+        for query in queries:
+            if copy_target(query) == table:
+                cur.execute(query)
+        for query in landing_insert_queries[table]:
+            cur.execute(query)
+        conn.commit()
+    print("Staging tables loaded! \n")
+
+
+def copy_table(conn_pool, query, report=None):
+    """
+    Executes a single COPY statement on a connection borrowed from the pool, moves the
+    landed rows into the staging table with their match keys and commits, returning the
+    target table and the wall time.
+
+    Args:
+        conn_pool (class): connection pool from backends.connection_pool
+        query (string): COPY statement from copy_table_queries
+        report (class): optional instrumentation.RunReport recording the statement
+
+    Returns:
+        tuple: (table name, wall time in seconds)
+    """
+
+    table = copy_target(query)
+    conn = conn_pool.getconn()
+
+    try:
+        start = time.perf_counter()
+        with conn.cursor() as cur:
+            if report is not None:
+                cur = InstrumentedCursor(cur, report, "load_staging_tables")
+            cur.execute(query)
+            for landing_query in landing_insert_queries[table]:
+                cur.execute(landing_query)
         conn.commit()
+
+        return table, time.perf_counter() - start
+
+    finally:
+        conn_pool.putconn(conn)
+
+
+def load_staging_tables_parallel(config, workers, queries=copy_table_queries, report=None):
+    """
+    Parallel alternative to load_staging_tables.  The staging tables share no data, so
+    each COPY in copy_table_queries is issued concurrently on its own pooled connection
+    and the wall time of each table load is reported as it finishes.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+        workers (int): number of concurrent COPY statements (and pooled connections)
+        queries (list): COPY statements to run, defaults to copy_table_queries
+        report (class): optional instrumentation.RunReport recording every statement
+    """
+
+    print(f"Loading staging tables from S3 with {workers} workers...")
+    conn_pool = connection_pool(config, workers)
+
+    try:
+        conn = conn_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                for table in dict.fromkeys(copy_target(query) for query in queries):
+                    cur.execute(clear_table_queries[table])
+            conn.commit()
+        finally:
+            conn_pool.putconn(conn)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(copy_table, conn_pool, query, report) for query in queries]
+
+            for future in as_completed(futures):
+                table, seconds = future.result()
+                print(f"{table} loaded in {seconds:.2f}s")
+
+    finally:
+        conn_pool.closeall()
+
     print("Staging tables loaded! \n")
 
 
-def insert_tables(cur, conn):
+def insert_tables(cur, conn, watermark=None):
     """
     This function loops through the insert_table_queries list imported from sql_queries.py,
     loading staging table data into 1 fact and 4 dimension tables in the Redshift database.
+    Each table is cleared and reloaded in one transaction, and the calendar gains the play
+    hours of songplays before time looks them up.  The log_data watermark is set in the
+    songplays transaction, so a later incremental load starts after the partitions loaded.
 
     Args:
         cur (class): psycopg2 cursor for db interaction
         conn (class): psycopg2 db connection session
+        watermark (date): newest log_data partition of the load, None to leave the watermark
     """
 
     print("Loading Data Warehouse tables...")
     for query in insert_table_queries:
+        table = query.split()[2]
+        if table in clear_table_queries:
+            cur.execute(clear_table_queries[table])
         cur.execute(query)
+        if query == songplays_table_insert and watermark is not None:
+            cur.execute(log_data_watermark_update, {"watermark": watermark})
+        conn.commit()
+    print("Data Warehouse tables loaded! \n")
+
+
+def upsert_tables(cur, conn, watermark=None):
+    """
+    Upsert alternative to insert_tables.  songplays is inserted as before and time only
+    receives start_times it doesn't have yet, while each dimension in dimension_upserts is
+    staged with one row per key, has its existing rows for those keys deleted and the staged
+    rows inserted, committed as one transaction per dimension.
+
+    Args:
+        cur (class): psycopg2 cursor for db interaction
+        conn (class): psycopg2 db connection session
+        watermark (date): newest log_data partition of the load, None to leave the watermark
+    """
+
+    print("Upserting Data Warehouse tables...")
+    cur.execute(clear_table_queries["songplays"])
+    cur.execute(songplays_table_insert)
+    if watermark is not None:
+        cur.execute(log_data_watermark_update, {"watermark": watermark})
+    conn.commit()
+    cur.execute(calendar_merge)
+    cur.execute(time_table_merge)
+    conn.commit()
+
+    for table, queries in dimension_upserts.items():
+        for query in queries:
+            cur.execute(query)
         conn.commit()
     print("Data Warehouse tables loaded! \n")
 
 
+def report_upserts(report):
+    """
+    Prints, from the rows affected by the recorded DELETE/INSERT statements, how many rows
+    each upserted dimension received and how many existing rows they replaced.  The first
+    upsert after append-only loads also replaces the duplicate copies those loads left, so
+    its updated count can exceed the number of keys.
+
+    Args:
+        report (class): instrumentation.RunReport the counts are read from and added to
+    """
+
+    upserts = {}
+
+    for table in dimension_upserts:
+        written = [entry["rows"] for entry in report.statements if entry["statement"] == f"INSERT INTO {table}"]
+        if not written:
+            continue
+
+        updated = sum(max(entry["rows"], 0) for entry in report.statements if entry["statement"] == f"DELETE FROM {table}")
+        upserts[table] = {"inserted": max(sum(written) - updated, 0), "updated": updated}
+        print(f"{table}: {upserts[table]['inserted']} inserted, {updated} updated")
+
+    report.extras["upserts"] = upserts
+
+
+def refresh_views(config, report):
+    """
+    Refreshes the rollup_views imported from sql_queries.py once the tables are loaded, on an
+    autocommit connection since REFRESH can't run inside a transaction block.  The duration
+    of every refresh is recorded, and on Redshift whether it was applied incrementally or
+    recomputed from scratch, as read from SVL_MV_REFRESH_STATUS.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+        report (class): instrumentation.RunReport recording the statements and refreshes
+
+    Returns:
+        dict: view -> {"seconds", "status"}
+    """
+
+    print("Refreshing rollup views...")
+    conn = connect(config)
+    conn.autocommit = True
+    cur = InstrumentedCursor(conn.cursor(), report)
+    refreshes = {}
+
+    try:
+        for view in rollup_views:
+            start = time.perf_counter()
+            cur.execute(view.refresh_sql())
+            refreshes[view.name] = {"seconds": round(time.perf_counter() - start, 4), "status": None}
+
+            if report.redshift:
+                execute_prepared(cur, "view_refresh_status", get_view_refresh_status, (view.name,))
+                refreshes[view.name]["status"] = cur.fetchone()[0]
+
+            print(f"{view.name}: {refreshes[view.name]['seconds']:.2f}s", refreshes[view.name]["status"] or "")
+    finally:
+        conn.close()
+
+    report.extras["view_refreshes"] = refreshes
+    print("Rollup views refreshed! \n")
+
+    return refreshes
+
+
+def manifest_copy_queries(config):
+    """
+    Builds a single manifest for the song_data prefix (see manifests.py) and returns
+    the staging COPY statements with staging_songs_copy replaced by one COPY of the manifest.
+    The slice count comes from MANIFEST_SLICES in dwh.cfg, or from the cluster when unset.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+
+    Returns:
+        list: COPY statements for staging_events and staging_songs
+    """
+
+    slices = int(config.get("ETL", "MANIFEST_SLICES", fallback="") or 0)
+
+    if not slices:
+        conn = connect(config)
+        slices = get_slice_count(conn.cursor())
+        conn.close()
+
+    song_copy = build_manifest_copy(
+        query=staging_songs_copy,
+        data_prefix=data_prefix(config, "SONG_DATA"),
+        manifest_prefix=config.get("ETL", "MANIFEST_PREFIX"),
+        slices=slices,
+        run_log_dir=config.get("ETL", "RUN_LOG_DIR", fallback="logs")
+    )
+
+    return [query for query in copy_table_queries if query != staging_songs_copy] + [song_copy]
+
+
+def compacted_copy_queries(config):
+    """
+    Optional preprocessing stage run before the staging load: packs the one-record-per-file
+    song_data objects and the daily log_data files into large gzip'd NDJSON batches (see
+    compaction.py) and returns COPY statements that load those batches with GZIP.  Each run
+    writes to its own timestamped folder under OUTPUT_PREFIX so stale batches are never loaded.
+    Raises a ValueError when OUTPUT_PREFIX is not set, rather than writing from the root.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+
+    Returns:
+        list: COPY statements for staging_events and staging_songs
+    """
+
+    output_prefix = config.get("COMPACTION", "OUTPUT_PREFIX", fallback="").strip("'\"").rstrip("/")
+
+    if not output_prefix:
+        raise ValueError("OUTPUT_PREFIX is not set in the [COMPACTION] section of dwh.cfg")
+
+    target_bytes = int(config.getfloat("COMPACTION", "TARGET_BATCH_MB", fallback=64) * 1024 * 1024)
+    workers = config.getint("COMPACTION", "WORKERS", fallback=4)
+    run_id = datetime.now().strftime("%Y%m%d%H%M%S")
+    queries = []
+
+    for query, source in ((staging_events_copy, "LOG_DATA"), (staging_songs_copy, "SONG_DATA")):
+        table = copy_target(query)
+        prefix = f"{output_prefix}/{table}/{run_id}"
+
+        print(f"Compacting {data_prefix(config, source)} into {prefix}...")
+        stats = compact(data_prefix(config, source), prefix, target_bytes, workers)
+        print(f"{stats['files']} files ({stats['records']} records, {stats['raw_bytes']} bytes) packed into "
+              f"{stats['batches']} batches ({stats['compressed_bytes']} bytes gzip'd)")
+
+        queries.append(gzip_copy(query, prefix + "/"))
+
+    return queries
+
+
+def load_incremental(cur, conn, log_prefix, upsert=False):
+    """
+    Incremental alternative to load_staging_tables + insert_tables.  Only the log_data
+    partitions dated after the watermark in load_watermark are copied into staging_events,
+    and only those staged rows are merged into the fact and dimension tables.  song_data
+    is only staged (and merged into songs/artists) while staging_songs is empty.  The whole
+    load, including advancing the watermark, is committed as one transaction.
+
+    Args:
+        cur (class): psycopg2 cursor for db interaction
+        conn (class): psycopg2 db connection session
+        log_prefix (string): S3 prefix (or local directory) of the log data partitions
+        upsert (bool): replace dimension rows by key (see upsert_tables) instead of only adding new keys
+
+    Returns:
+        list: paths of the partitions loaded
+    """
+
+    if upsert:
+        events_queries, songs_queries = upsert_events_queries, upsert_songs_queries
+    else:
+        events_queries, songs_queries = merge_events_queries, merge_songs_queries
+
+    cur.execute(get_log_data_watermark)
+    row = cur.fetchone()
+    watermark = row[0] if row else None
+
+    partitions = partitions_after(log_partitions(log_prefix), watermark)
+
+    if not partitions:
+        print(f"No log_data partitions newer than {watermark}, nothing to load \n")
+        return []
+
+    print(f"Loading {len(partitions)} log_data partitions newer than {watermark}...")
+    cur.execute(staging_events_clear)
+    for day, path in partitions:
+        cur.execute(staging_events_partition_copy, {"source": path})
+        print(f"{path} staged")
+    for query in landing_insert_queries["staging_events"]:
+        cur.execute(query)
+
+    cur.execute(get_count_staging_songs)
+    if cur.fetchone()[0] == 0:
+        print("Staging song data...")
+        cur.execute(staging_songs_copy)
+        for query in landing_insert_queries["staging_songs"]:
+            cur.execute(query)
+        for query in songs_queries:
+            cur.execute(query)
+
+    print("Merging new events into Data Warehouse tables...")
+    for query in events_queries:
+        cur.execute(query)
+
+    cur.execute(log_data_watermark_update, {"watermark": partitions[-1][0]})
+    conn.commit()
+    print(f"Watermark advanced to {partitions[-1][0]} \n")
+
+    return [path for day, path in partitions]
+
+
+def report_song_matches(cur, report):
+    """
+    Prints how many NextSong events in staging_events matched a song in staging_songs on
+    the hashed match key, i.e. how many events made it into songplays, and how many missed.
+
+    Args:
+        cur (class): psycopg2 cursor for db interaction
+        report (class): instrumentation.RunReport the counts are added to
+    """
+
+    cur.execute(get_song_match_counts)
+    matched, missed = cur.fetchone()
+    report.extras["song_matches"] = {"matched": matched, "missed": missed}
+
+    print(f"NextSong events matched to songs: {matched}, missed: {missed} \n")
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Load the staging, fact and dimension tables")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the steps the journal records as done and restart at the first unfinished one")
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['DB'].values()))
-    cur = conn.cursor()
-    
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    report = RunReport("etl", redshift=not is_local(config))
+    report.extras["cluster"] = {"node_type": config.get("CLUSTER", "NODE_TYPE"), "num_nodes": config.getint("CLUSTER", "NUM_NODES")}
+    journal = RunJournal(config.get("ETL", "JOURNAL_PATH", fallback="logs/etl_journal.json"), report, args.resume)
+
+    try:
+        run_etl(config, report, journal)
+        journal.run("refresh_views", lambda: refresh_views(config, report))
+
+        if config.getboolean("MAINTENANCE", "AFTER_LOAD", fallback=False):
+            journal.run("maintenance", lambda: run_maintenance(config).extras["operations"])
+
+        if report.redshift:
+            conn = connect(config)
+            report_queue_times(conn.cursor(), report)
+            conn.close()
+    finally:
+        report.extras["journal"] = journal.state
+        report.write(config.get("ETL", "RUN_LOG_DIR", fallback="logs"))
+
+
+def run_etl(config, report, journal):
+    """
+    Runs the load selected by the [ETL] and [COMPACTION] sections of dwh.cfg, recording
+    every statement in the run report and every step in the journal.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+        report (class): instrumentation.RunReport for this run
+        journal (class): journal.RunJournal for this run
+    """
+
+    upsert = config.get("ETL", "DIMENSION_LOAD", fallback="append") == "upsert"
+    log_prefix = data_prefix(config, "LOG_DATA")
+
+    if config.get("ETL", "LOAD_MODE", fallback="full") == "incremental":
+        conn = connect(config)
+        journal.run("load_incremental",
+                    lambda: load_incremental(InstrumentedCursor(conn.cursor(), report), conn, log_prefix, upsert),
+                    inputs=[log_prefix])
+        report_song_matches(conn.cursor(), report)
+        if upsert:
+            report_upserts(report)
+        conn.close()
+        return
+
+    copy_queries = copy_table_queries
+    graph = upsert_graph if upsert else etl_graph
+
+    # A full load reads every log_data partition, so the newest one becomes the watermark
+    partitions = log_partitions(log_prefix)
+    watermark = partitions[-1][0] if partitions else None
+
+    if config.getboolean("COMPACTION", "ENABLED", fallback=False):
+        copy_queries = journal.run("compaction", lambda: compacted_copy_queries(config),
+                                   inputs=[data_prefix(config, "LOG_DATA"), data_prefix(config, "SONG_DATA")])
+    elif config.getboolean("ETL", "USE_MANIFESTS", fallback=False):
+        copy_queries = journal.run("manifests", lambda: manifest_copy_queries(config),
+                                   inputs=[data_prefix(config, "SONG_DATA")])
+
+    graph = dict(graph)
+
+    if copy_queries is not copy_table_queries:
+        for table in ("staging_events", "staging_songs"):
+            table_copies = [query for query in copy_queries if copy_target(query) == table]
+            graph[table] = dict(graph[table], queries=[clear_table_queries[table]] + table_copies + landing_insert_queries[table])
+
+    if watermark is not None:
+        graph["songplays"] = dict(graph["songplays"], queries=graph["songplays"]["queries"] + [(log_data_watermark_update, {"watermark": watermark})])
+
+    if config.getboolean("ETL", "USE_DAG", fallback=False):
+        max_parallelism = config.getint("ETL", "MAX_PARALLELISM", fallback=4)
+        conn_pool = connection_pool(config, max_parallelism)
+
+        try:
+            report.extras["nodes"] = run_graph(graph, conn_pool, max_parallelism, report, journal, not is_local(config))
+        finally:
+            conn_pool.closeall()
+
+        conn = connect(config)
+        report_song_matches(conn.cursor(), report)
+        conn.close()
+        if upsert:
+            report_upserts(report)
+        return
+
+    conn = connect(config)
+    cur = InstrumentedCursor(conn.cursor(), report)
+    sources = copy_sources(copy_queries, getattr(conn, "resolve", None))
+
+    if config.getboolean("ETL", "PARALLEL_LOAD", fallback=False):
+        workers = config.getint("ETL", "LOAD_WORKERS", fallback=2)
+        journal.run("load_staging_tables", lambda: load_staging_tables_parallel(config, workers, copy_queries, report),
+                    inputs=sources)
+    else:
+        journal.run("load_staging_tables", lambda: load_staging_tables(cur, conn, copy_queries),
+                    inputs=sources)
+
+    journal.run("insert_tables", lambda: upsert_tables(cur, conn, watermark) if upsert else insert_tables(cur, conn, watermark))
 
+    report_song_matches(conn.cursor(), report)
     conn.close()
+    if upsert:
+        report_upserts(report)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
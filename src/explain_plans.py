@@ -0,0 +1,193 @@
+import argparse
+import configparser
+import json
+import os
+import re
+import sys
+from collections import Counter
+from backends import connect, is_local
+from instrumentation import RunReport, describe_statement
+from sql_queries import analytics_queries, insert_table_queries
+
+# Plan steps that move data between slices or compare every row pair.  Redshift marks join
+# redistribution on the join step (DS_BCAST_INNER broadcasts the whole inner table to every
+# node, DS_DIST_BOTH redistributes both sides); the local engine's nested loop joins are
+# matched too, so a join condition lost in a rewrite is caught offline as well.
+COSTLY_STEPS = {
+    "DS_BCAST_INNER": re.compile(r"\bDS_BCAST_INNER\b"),
+    "DS_DIST_BOTH": re.compile(r"\bDS_DIST_BOTH\b"),
+    "DS_DIST_ALL_INNER": re.compile(r"\bDS_DIST_ALL_INNER\b"),
+    "nested loop": re.compile(r"Nested Loop|NESTED_LOOP_JOIN|BLOCKWISE_NL_JOIN|CROSS_PRODUCT", re.IGNORECASE)
+}
+
+OPERATOR_LINE = re.compile(r"^\s*(?:->\s*)?(.*?)\s*\(cost=([\d.]+)\.\.([\d.]+) rows=(\d+) width=(\d+)\)")
+
+
+def plan_queries():
+    """
+    Statements whose plans are checked: every insert of insert_table_queries, named by
+    its target table, and the registered analytics_queries.
+    """
+
+    return dict({describe_statement(query): query for query in insert_table_queries}, **analytics_queries)
+
+
+def explain(cur, query):
+    """
+    Runs EXPLAIN for a statement and returns the plan text, one line per plan row.  The
+    local engine returns a (key, plan) pair per row, Redshift a single text column.
+
+    Args:
+        cur (class): psycopg2 cursor for db interaction
+        query (string): SQL statement
+    """
+
+    cur.execute("EXPLAIN " + query)
+
+    return [line for row in cur.fetchall() for line in row[-1].splitlines()]
+
+
+def parse_plan(lines):
+    """
+    Extracts the plan steps, the total cost estimate and the costly data movement of a
+    Redshift plan.  The cost is None for the local engine, whose plans carry no cost.
+
+    Args:
+        lines (list): output of explain
+
+    Returns:
+        dict: {"cost", "rows", "operators", "flags", "plan"}
+    """
+
+    operators, cost, rows = [], None, None
+
+    for line in lines:
+        match = OPERATOR_LINE.match(line)
+        if match:
+            operators.append(match.group(1))
+            if cost is None:
+                cost, rows = float(match.group(3)), int(match.group(4))
+
+    flags = [{"flag": flag, "step": line.strip(" ->│┌┐└┘─")}
+             for line in lines for flag, pattern in COSTLY_STEPS.items() if pattern.search(line)]
+
+    return {"cost": cost, "rows": rows, "operators": operators, "flags": flags, "plan": lines}
+
+
+def compare_plans(plans, baseline, cost_tolerance_pct):
+    """
+    Diffs the captured plans against a saved baseline.  A statement regresses when a
+    costly step appears more often than in the baseline, or its cost estimate grows by
+    more than cost_tolerance_pct; a different sequence of plan steps is reported without
+    failing, since the planner reorders steps as table statistics change.
+
+    Args:
+        plans (dict): statement name -> output of parse_plan
+        baseline (dict): plans of the baseline file
+        cost_tolerance_pct (float): allowed cost estimate growth in percent
+
+    Returns:
+        dict: statement name -> {"status", "changes"}, status one of new, unchanged,
+              changed or regressed
+    """
+
+    results = {}
+
+    for name, plan in plans.items():
+        if name not in baseline:
+            results[name] = {"status": "new", "changes": []}
+            continue
+
+        previous, changes, regressed = baseline[name], [], False
+
+        added = Counter(flag["flag"] for flag in plan["flags"]) - Counter(flag["flag"] for flag in previous["flags"])
+        for flag, count in added.items():
+            changes.append(f"{count} more {flag} step(s)")
+            regressed = True
+
+        if plan["cost"] is not None and previous["cost"]:
+            growth = 100.0 * (plan["cost"] - previous["cost"]) / previous["cost"]
+            if growth > cost_tolerance_pct:
+                changes.append(f"cost {previous['cost']:.0f} -> {plan['cost']:.0f} (+{growth:.0f}%)")
+                regressed = True
+
+        if plan["operators"] != previous["operators"]:
+            changes.append("plan steps changed")
+
+        results[name] = {"status": "regressed" if regressed else "changed" if changes else "unchanged", "changes": changes}
+
+    return results
+
+
+def load_baseline(path):
+    """
+    Returns the plans of the baseline file, or an empty dict when there is none yet.
+    """
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)["plans"]
+
+
+def save_baseline(path, plans):
+    """
+    Writes the captured plans as the baseline later runs are compared with.
+    """
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    with open(path, "w") as f:
+        json.dump({"plans": plans}, f, indent=1)
+
+    print(f"Baseline written to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Capture query plans and check them against a baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="save the captured plans as the new baseline")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    baseline_file = config.get("EXPLAIN", "BASELINE_FILE", fallback="plans/explain_baseline.json")
+    cost_tolerance_pct = config.getfloat("EXPLAIN", "COST_TOLERANCE_PCT", fallback=20)
+
+    report = RunReport("explain", redshift=not is_local(config))
+    conn = connect(config)
+    cur = conn.cursor()
+
+    print("Capturing query plans...")
+    try:
+        plans = {name: parse_plan(explain(cur, query)) for name, query in plan_queries().items()}
+    finally:
+        conn.close()
+
+    results = compare_plans(plans, load_baseline(baseline_file), cost_tolerance_pct)
+
+    print(f"{'statement':<30} {'cost':>14} {'status':>10}  costly steps")
+    for name, plan in plans.items():
+        cost = "" if plan["cost"] is None else f"{plan['cost']:.0f}"
+        flags = ", ".join(sorted(set(flag["flag"] for flag in plan["flags"])))
+        print(f"{name:<30} {cost:>14} {results[name]['status']:>10}  {flags}")
+        for change in results[name]["changes"]:
+            print(f" {change}")
+
+    report.extras["plans"] = plans
+    report.extras["comparison"] = results
+    report.write(config.get("ETL", "RUN_LOG_DIR", fallback="logs"))
+
+    if args.save_baseline:
+        save_baseline(baseline_file, plans)
+        return
+
+    regressed = [name for name, result in results.items() if result["status"] == "regressed"]
+    if regressed:
+        print(f"{len(regressed)} statements regressed against {baseline_file}: {', '.join(regressed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+import argparse
+import configparser
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from backends import connect, is_local
+from instrumentation import RunReport
+from sql_queries import tables
+from storage import submit_bounded
+
+FORMATS = ("rows", "numpy", "arrow")
+
+
+def table_query(table, columns=None, where=None):
+    """
+    SELECT statement reading a table of the star schema, optionally restricted to some
+    columns and a predicate.
+    """
+
+    return f"SELECT {', '.join(columns) if columns else '*'} FROM {table}" + (f" WHERE {where}" if where else "")
+
+
+def columnar(names, rows, fmt="rows"):
+    """
+    Converts a batch of rows into the requested format.  NumPy and Arrow are only imported
+    when asked for, so streaming plain rows needs neither.
+
+    Args:
+        names (list): column names of the result
+        rows (list): row tuples fetched from the cursor
+        fmt (string): "rows" keeps the row tuples, "numpy" returns a dict of column name ->
+                      numpy array (columns with NULLs or mixed types have object dtype),
+                      "arrow" returns a pyarrow.RecordBatch
+
+    Returns:
+        object: the batch in the requested format
+    """
+
+    if fmt == "rows":
+        return rows
+
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+
+    if fmt == "numpy":
+        import numpy
+
+        return {name: numpy.array(values) for name, values in zip(names, columns)}
+
+    if fmt == "arrow":
+        import pyarrow
+
+        return pyarrow.RecordBatch.from_arrays([pyarrow.array(values) for values in columns], names=names)
+
+    raise ValueError(f"Unknown batch format {fmt}, expected one of {', '.join(FORMATS)}")
+
+
+def batch_length(batch, fmt):
+    """
+    Number of rows in a batch returned by columnar.
+    """
+
+    if fmt == "arrow":
+        return batch.num_rows
+    if fmt == "numpy":
+        return len(next(iter(batch.values()), ()))
+
+    return len(batch)
+
+
+def iter_batches(conn, query, params=None, batch_rows=10000, fmt="rows", name="extract"):
+    """
+    Streams the result of a query through a named (server-side) cursor, batch_rows rows
+    per round trip, so only one batch is held in memory at a time however large the result.
+    The cursor lives in a transaction of its own, which is ended once the result is read.
+
+    On Redshift the leader node materializes the whole cursor result before the first
+    fetch, up to a maximum size per node type; extract_parallel splits large tables into
+    several smaller cursors.
+
+    Args:
+        conn (class): psycopg2 db connection session, not in autocommit mode
+        query (string): SELECT statement
+        params (dict): query parameters
+        batch_rows (int): rows fetched per batch
+        fmt (string): batch format, see columnar
+        name (string): cursor name, unique per connection
+
+    Yields:
+        object: one batch in the requested format
+    """
+
+    cur = conn.cursor(name)
+    cur.itersize = batch_rows
+
+    try:
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(batch_rows)
+            if not rows:
+                break
+            yield columnar([column[0] for column in cur.description], rows, fmt)
+    finally:
+        cur.close()
+        conn.commit()
+
+
+def stream(config, query, params=None, batch_rows=10000, fmt="rows"):
+    """
+    Streams a query on a connection of its own, see iter_batches.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+        query (string): SELECT statement, e.g. from table_query
+        params (dict): query parameters
+        batch_rows (int): rows fetched per batch
+        fmt (string): batch format, see columnar
+
+    Yields:
+        object: one batch in the requested format
+    """
+
+    conn = connect(config)
+
+    try:
+        yield from iter_batches(conn, query, params, batch_rows, fmt)
+    finally:
+        conn.close()
+
+
+def partition_ranges(cur, table, column, partitions):
+    """
+    Splits the value range of a column into equally wide, non-overlapping predicates whose
+    bounds are query parameters.  On start_time, the leading sort key column of songplays,
+    each range only reads the blocks its zone maps say can hold matching rows.
+
+    Args:
+        cur (class): psycopg2 cursor for db interaction
+        table (string): table name
+        column (string): TIMESTAMP or numeric column to split on
+        partitions (int): number of ranges
+
+    Returns:
+        list: (SQL predicate, parameters) pairs covering every row, a single (None, None)
+              for an empty table
+    """
+
+    cur.execute(f"SELECT MIN({column}), MAX({column}) FROM {table}")
+    low, high = cur.fetchone()
+
+    if low is None or partitions <= 1 or low == high:
+        return [(None, None)]
+
+    bounds = [low + (high - low) * i / partitions for i in range(partitions)] + [high]
+
+    return [(f"{column} >= %(start)s AND {column} {'<=' if i == partitions - 1 else '<'} %(end)s", {"start": start, "end": end})
+            for i, (start, end) in enumerate(zip(bounds, bounds[1:]))]
+
+
+def extract_partition(config, query, params, partition, batch_rows, fmt, handler=None, output=None):
+    """
+    Worker of extract_parallel: streams one range of a table on a connection of its own and
+    hands every batch to handler and/or writes them to output (Parquet for Arrow batches, CSV
+    for rows), so nothing but the totals travels back to the parent process.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+        query (string): SELECT statement of the partition
+        params (dict): parameters of the partition's range predicate
+        partition (int): partition number, used to name the cursor
+        batch_rows (int): rows fetched per batch
+        fmt (string): batch format, see columnar
+        handler (function): module-level function called with each batch, returning a
+                            picklable result
+        output (string): file the partition is written to
+
+    Returns:
+        dict: {"partition", "rows", "batches", "seconds", "results"}
+    """
+
+    start = time.perf_counter()
+    result = {"partition": partition, "rows": 0, "batches": 0, "results": []}
+    writer, output_file = None, None
+    conn = connect(config)
+
+    try:
+        for batch in iter_batches(conn, query, params, batch_rows, fmt, name=f"extract_{partition}"):
+            result["batches"] += 1
+            result["rows"] += batch_length(batch, fmt)
+
+            if handler:
+                result["results"].append(handler(batch))
+
+            if output and fmt == "arrow":
+                import pyarrow
+                import pyarrow.parquet
+
+                table = pyarrow.Table.from_batches([batch])
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(output, table.schema)
+                writer.write_table(table.cast(writer.schema))
+            elif output:
+                if writer is None:
+                    output_file = open(output, "w", newline="")
+                    writer = csv.writer(output_file)
+                writer.writerows(batch)
+    finally:
+        conn.close()
+        if output_file:
+            output_file.close()
+        elif writer is not None:
+            writer.close()
+
+    result["seconds"] = round(time.perf_counter() - start, 4)
+
+    return result
+
+
+def extract_parallel(config, table, column="start_time", partitions=4, workers=4, batch_rows=10000, fmt="rows",
+                     columns=None, handler=None, output_dir=None):
+    """
+    Reads a whole table with bounded memory on several cores: the range of column is split
+    into partitions, and each is streamed through its own server-side cursor by
+    extract_partition on a process pool, at most two partitions per worker in flight.  The
+    local engine's database file can only be opened by one process, so it runs the
+    partitions on threads instead.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+        table (string): table name
+        column (string): TIMESTAMP or numeric column the ranges are split on, None to
+                         stream the table through a single cursor
+        partitions (int): number of ranges
+        workers (int): pool size
+        batch_rows (int): rows fetched per batch
+        fmt (string): batch format, see columnar
+        columns (list): columns to read, all by default
+        handler (function): module-level function called with each batch in the worker
+        output_dir (string): directory the partitions are written to, one file each
+
+    Returns:
+        list: output of extract_partition for every partition, in partition order
+    """
+
+    if column:
+        conn = connect(config)
+        try:
+            predicates = partition_ranges(conn.cursor(), table, column, partitions)
+        finally:
+            conn.close()
+    else:
+        predicates = [(None, None)]
+
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    executor_class = ThreadPoolExecutor if is_local(config) else ProcessPoolExecutor
+    results = []
+
+    def task(i, predicate, params):
+        output = os.path.join(output_dir, f"{table}_{i:03d}.{'parquet' if fmt == 'arrow' else 'csv'}") if output_dir else None
+        return config, table_query(table, columns, predicate), params, i, batch_rows, fmt, handler, output
+
+    with executor_class(max_workers=workers) as executor:
+        submit_bounded(executor, extract_partition,
+                       (task(i, predicate, params) for i, (predicate, params) in enumerate(predicates)),
+                       workers * 2, lambda done: results.extend(future.result() for future in done))
+
+    return sorted(results, key=lambda result: result["partition"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream a table of the star schema through server-side cursors")
+    parser.add_argument("table", choices=[table.name for table in tables])
+    parser.add_argument("--column", help="column to range-partition on (default: start_time when the table has it)")
+    parser.add_argument("--partitions", type=int, help="number of ranges (default: WORKERS)")
+    parser.add_argument("--format", choices=FORMATS, default="rows", help="batch format")
+    parser.add_argument("--output", help="directory to write the partitions to, Parquet for arrow and CSV for rows")
+    args = parser.parse_args()
+
+    if args.output and args.format == "numpy":
+        parser.error("--output writes Parquet (arrow) or CSV (rows) files, not numpy batches")
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    workers = config.getint("EXTRACT", "WORKERS", fallback=4)
+    batch_rows = config.getint("EXTRACT", "BATCH_ROWS", fallback=10000)
+    table = next(table for table in tables if table.name == args.table)
+    column = args.column or ("start_time" if any(column.name == "start_time" for column in table.columns) else None)
+
+    report = RunReport("extract", redshift=not is_local(config))
+
+    print(f"Extracting {table.name} in batches of {batch_rows} rows...")
+    with report.step("extract"):
+        results = extract_parallel(config, table.name, column, args.partitions or workers, workers, batch_rows,
+                                   args.format, output_dir=args.output)
+
+    seconds = report.extras["steps"]["extract"]
+    rows = sum(result["rows"] for result in results)
+    for result in results:
+        print(f" partition {result['partition']}: {result['rows']} rows in {result['batches']} batches, {result['seconds']:.2f}s")
+    print(f"{rows} rows in {seconds:.2f}s ({rows / seconds if seconds else 0:.0f} rows/s)")
+
+    report.extras["partitions"] = [{key: value for key, value in result.items() if key != "results"} for result in results]
+    report.write(config.get("ETL", "RUN_LOG_DIR", fallback="logs"))
+
+
+if __name__ == "__main__":
+    main()
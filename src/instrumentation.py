@@ -0,0 +1,245 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from backends import execute_prepared
+
+LOAD_COMMITS_QUERY = """
+ SELECT COUNT(DISTINCT filename), SUM(lines_scanned)
+ FROM stl_load_commits
+ WHERE query = %s
+"""
+
+QUERY_SUMMARY_QUERY = """
+ SELECT SUM(rows), SUM(bytes), BOOL_OR(is_diskbased = 't')
+ FROM svl_query_summary
+ WHERE query = %s
+"""
+
+WLM_QUEUE_QUERY = """
+ SELECT
+  TRIM(c.name),
+  COUNT(*),
+  SUM(w.total_queue_time) / 1000000.0,
+  MAX(w.total_queue_time) / 1000000.0,
+  SUM(w.total_exec_time) / 1000000.0
+ FROM stl_wlm_query w
+ LEFT JOIN stv_wlm_service_class_config c
+  ON (c.service_class = w.service_class)
+ WHERE w.query IN %s
+ GROUP BY 1
+ ORDER BY 3 DESC
+"""
+
+
+# Tables the load fills for its own use rather than for readers of the warehouse
+BOOKKEEPING_TABLES = ("calendar", "load_watermark")
+
+
+def describe_statement(query):
+    """
+    Short, stable label for a statement (e.g. "INSERT INTO songplays"), used to line up
+    the same statement across run reports.
+
+    Args:
+        query (string): SQL statement
+    """
+
+    match = re.match(r"\s*(COPY|INSERT\s+INTO|DELETE\s+FROM|UPDATE|DROP\s+TABLE\s+IF\s+EXISTS|CREATE\s+TABLE\s+IF\s+NOT\s+EXISTS"
+                     r"|(?:CREATE|REFRESH)\s+MATERIALIZED\s+VIEW|DROP\s+MATERIALIZED\s+VIEW\s+IF\s+EXISTS)\s+(\w+)",
+                     query, re.IGNORECASE)
+
+    if match:
+        return f"{' '.join(match.group(1).upper().split())} {match.group(2)}"
+
+    return " ".join(query.split())[:80]
+
+
+class RunReport:
+    """
+    Collects one entry per executed statement (step, statement, wall time, rows affected,
+    Redshift query id and COPY load statistics) and writes them as a JSON report that can
+    be diffed between runs.  Safe to share between threads.
+
+    Args:
+        run (string): name of the entry point, e.g. "etl"
+        redshift (bool): whether the connection is Redshift, i.e. has query ids and system tables
+    """
+
+    def __init__(self, run, redshift=True):
+        self.run = run
+        self.redshift = redshift
+        self.started_at = datetime.now()
+        self.current_step = None
+        self.statements = []
+        self.extras = {}
+        self.lock = threading.Lock()
+
+    def record(self, entry):
+        with self.lock:
+            self.statements.append(entry)
+
+    def loaded_rows(self, step):
+        """
+        Rows a step loaded into the warehouse: the rows of its INSERT statements only, so
+        the clears, the COPY into a landing table and the landing table's DELETE don't
+        count the same records again.  The calendar and load_watermark bookkeeping rows
+        are left out.
+
+        Args:
+            step (string): step name
+
+        Returns:
+            int: rows inserted by the step
+        """
+
+        with self.lock:
+            return sum(max(entry["rows"], 0) for entry in self.statements
+                       if entry["step"] == step and entry["statement"].startswith("INSERT INTO ")
+                       and entry["statement"].split()[2] not in BOOKKEEPING_TABLES)
+
+    @contextmanager
+    def step(self, name):
+        """
+        Labels every statement executed inside the block with a step name and records
+        the wall time of the whole step.
+        """
+
+        previous, self.current_step = self.current_step, name
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.current_step = previous
+            self.extras.setdefault("steps", {})[name] = round(time.perf_counter() - start, 4)
+
+    def write(self, run_log_dir):
+        """
+        Writes the report to run_log_dir as <run>_<timestamp>.json.
+
+        Returns:
+            string: path of the report
+        """
+
+        finished_at = datetime.now()
+        report = {
+            "run": self.run,
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "finished_at": finished_at.isoformat(timespec="seconds"),
+            "seconds": round((finished_at - self.started_at).total_seconds(), 4),
+            "statements": self.statements,
+            **self.extras
+        }
+
+        os.makedirs(run_log_dir, exist_ok=True)
+        path = os.path.join(run_log_dir, f"{self.run}_{self.started_at.strftime('%Y%m%d%H%M%S')}.json")
+
+        with open(path, "w") as f:
+            json.dump(report, f, indent=1, default=str)
+
+        print(f"Run report written to {path}")
+
+        return path
+
+
+class InstrumentedCursor:
+    """
+    Cursor wrapper that times every execute() and records it in a RunReport.  On Redshift
+    the statement's query id is looked up with pg_last_query_id(), and COPY statements are
+    enriched with file/line counts from STL_LOAD_COMMITS and rows, bytes and disk spills
+    from SVL_QUERY_SUMMARY.  Everything else is delegated to the wrapped cursor.
+
+    Args:
+        cur (class): psycopg2 (or backends.LocalCursor) cursor
+        report (class): RunReport receiving the entries
+        step (string): step name, defaults to the report's current step
+    """
+
+    def __init__(self, cur, report, step=None):
+        self.cur = cur
+        self.report = report
+        self.step = step
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cur.close()
+
+    def execute(self, query, params=None):
+        start = time.perf_counter()
+        self.cur.execute(query, params)
+        seconds = time.perf_counter() - start
+
+        entry = {
+            "step": self.step or self.report.current_step,
+            "statement": describe_statement(query),
+            "seconds": round(seconds, 4),
+            "rows": self.cur.rowcount
+        }
+
+        if self.report.redshift:
+            entry.update(self.query_stats(entry["statement"].startswith("COPY")))
+
+        self.report.record(entry)
+
+    def query_stats(self, is_copy):
+        """
+        Looks up the query id of the last statement and, for COPY, its load statistics with
+        prepared statements, since they run after every COPY.  Uses a separate cursor so the
+        wrapped cursor's result set is left untouched.
+        """
+
+        stats = {}
+
+        with self.cur.connection.cursor() as cur:
+            cur.execute("SELECT pg_last_query_id()")
+            stats["query_id"] = cur.fetchone()[0]
+
+            if is_copy:
+                execute_prepared(cur, "load_commits", LOAD_COMMITS_QUERY, (stats["query_id"],))
+                stats["files"], stats["lines_scanned"] = cur.fetchone()
+
+                execute_prepared(cur, "query_summary", QUERY_SUMMARY_QUERY, (stats["query_id"],))
+                stats["summary_rows"], stats["summary_bytes"], stats["disk_based"] = cur.fetchone()
+
+        return stats
+
+
+def report_queue_times(cur, report):
+    """
+    Looks up the WLM queue of every statement in a Redshift run report in STL_WLM_QUERY and
+    prints, per queue, how long the statements waited in the queue and executed.  Long
+    queue waits mean the queue's slots are taken by other work; long execution on a queue
+    with little memory usually means steps spilling to disk.
+
+    Args:
+        cur (class): psycopg2 cursor for db interaction
+        report (class): RunReport with query ids, the totals are added to its extras
+    """
+
+    query_ids = tuple(entry["query_id"] for entry in report.statements if entry.get("query_id"))
+
+    if not query_ids:
+        return
+
+    cur.execute(WLM_QUEUE_QUERY, (query_ids,))
+    queues = {}
+
+    for queue, statements, queue_seconds, max_queue_seconds, exec_seconds in cur.fetchall():
+        queues[queue or "unknown"] = {"statements": statements, "queue_seconds": float(queue_seconds),
+                                      "max_queue_seconds": float(max_queue_seconds), "exec_seconds": float(exec_seconds)}
+
+    report.extras["wlm_queues"] = queues
+
+    print(f"{'WLM queue':<30} {'statements':>10} {'queued':>10} {'max queued':>10} {'executing':>10}")
+    for queue, times in queues.items():
+        print(f"{queue:<30} {times['statements']:>10} {times['queue_seconds']:>9.2f}s "
+              f"{times['max_queue_seconds']:>9.2f}s {times['exec_seconds']:>9.2f}s")
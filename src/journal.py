@@ -0,0 +1,129 @@
+import json
+import os
+import re
+import threading
+import traceback
+from datetime import datetime
+
+
+def copy_sources(queries, resolve=None):
+    """
+    S3 prefixes, manifests or local paths read by the COPY statements among queries, the
+    inputs journaled for a staging load step.  resolve, e.g. LocalConnection.resolve, maps
+    each source onto the location actually read.
+    """
+
+    return [(resolve or str)(match.group(1)) for query in queries
+            for match in [re.match(r"\s*COPY\s.*?\sFROM\s+'([^']+)'", query, re.IGNORECASE | re.DOTALL)] if match]
+
+
+class RunJournal:
+    """
+    Step journal of an ETL run, kept in a local JSON state file.  Every step records its
+    status (running, done or failed), inputs, outputs, rows loaded and timestamps, and
+    the file is rewritten after each change so it survives the process dying mid-step.
+    A resumed run skips the steps already done and re-executes the rest, which is safe
+    because every load step clears its table in the same transaction it loads it.
+    Safe to share between threads.
+
+    Args:
+        path (string): JSON state file, e.g. logs/etl_journal.json
+        report (class): instrumentation.RunReport the steps' rows are read from
+        resume (bool): continue the journal in path instead of starting a new one
+    """
+
+    def __init__(self, path, report, resume=False):
+        self.path = path
+        self.report = report
+        self.lock = threading.Lock()
+        self.state = None
+
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+            print(f"Resuming run {self.state['run_id']} from {path}")
+
+        if self.state is None:
+            self.state = {"run_id": report.started_at.strftime("%Y%m%d%H%M%S"), "steps": {}}
+
+        self.state["resumed_at"] = datetime.now().isoformat(timespec="seconds") if resume else None
+        self.save()
+
+    def save(self):
+        """
+        Writes the state file atomically, so a crash never leaves a truncated journal.
+        """
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.state, f, indent=1, default=str)
+        os.replace(self.path + ".tmp", self.path)
+
+    def completed(self, name):
+        return self.state["steps"].get(name, {}).get("status") == "done"
+
+    def outputs(self, name):
+        return self.state["steps"].get(name, {}).get("outputs")
+
+    def start(self, name, inputs=None):
+        with self.lock:
+            attempts = self.state["steps"].get(name, {}).get("attempts", 0)
+            self.state["steps"][name] = {
+                "status": "running",
+                "inputs": inputs,
+                "attempts": attempts + 1,
+                "started_at": datetime.now().isoformat(timespec="seconds")
+            }
+            self.save()
+
+    def finish(self, name, outputs=None):
+        with self.lock:
+            self.state["steps"][name].update(
+                status="done",
+                outputs=outputs,
+                rows=self.report.loaded_rows(name),
+                finished_at=datetime.now().isoformat(timespec="seconds")
+            )
+            self.save()
+
+    def fail(self, name, error):
+        with self.lock:
+            self.state["steps"][name].update(
+                status="failed",
+                error="".join(traceback.format_exception_only(type(error), error)).strip(),
+                finished_at=datetime.now().isoformat(timespec="seconds")
+            )
+            self.save()
+
+    def run(self, name, function, inputs=None):
+        """
+        Runs one step of the ETL inside a report step of the same name, unless the journal
+        already records it as done.  The step's return value is journaled as its outputs,
+        and returned again by a resumed run that skips the step.
+
+        Args:
+            name (string): step name
+            function (function): callable running the step, its result must be JSON serializable
+            inputs (object): description of the step's inputs, e.g. data prefixes or partitions
+
+        Returns:
+            object: the step's outputs
+        """
+
+        if self.completed(name):
+            print(f"Skipping {name}, completed in run {self.state['run_id']}")
+            return self.outputs(name)
+
+        self.start(name, inputs)
+
+        try:
+            with self.report.step(name):
+                outputs = function()
+        except Exception as e:
+            self.fail(name, e)
+            raise
+
+        self.finish(name, outputs)
+
+        return outputs
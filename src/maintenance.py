@@ -0,0 +1,206 @@
+import configparser
+import glob
+import json
+import os
+import re
+import time
+from backends import connect, is_local
+from instrumentation import InstrumentedCursor, RunReport
+from sql_queries import create_table_queries
+
+TABLE_HEALTH_QUERY = """
+ SELECT "table", COALESCE(unsorted, 0), COALESCE(stats_off, 0), tbl_rows, estimated_visible_rows, size
+ FROM svv_table_info
+"""
+
+
+def table_names():
+    """
+    Names of the tables created by create_table_queries.
+    """
+
+    return [re.search(r"CREATE\s+TABLE\s+IF\s+NOT\s+EXISTS\s+(\w+)", query, re.IGNORECASE).group(1)
+            for query in create_table_queries]
+
+
+def previous_report(run_log_dir):
+    """
+    Returns the most recent maintenance run report in run_log_dir, or an empty dict.
+    """
+
+    paths = sorted(glob.glob(os.path.join(run_log_dir, "maintenance_*.json")))
+
+    if not paths:
+        return {}
+
+    with open(paths[-1]) as f:
+        return json.load(f)
+
+
+def table_health(cur, names, previous_tables):
+    """
+    Reads SVV_TABLE_INFO for the given tables: percentage of unsorted rows, how stale the
+    planner statistics are, percentage of deleted rows not yet reclaimed, and row growth
+    since the previous maintenance run (100% for a table not seen before).
+
+    Args:
+        cur (class): psycopg2 cursor for db interaction
+        names (list): table names
+        previous_tables (dict): table health from the previous maintenance run report
+
+    Returns:
+        dict: table -> {"unsorted_pct", "stats_off_pct", "deleted_pct", "growth_pct", "rows", "size_mb"}
+    """
+
+    cur.execute(TABLE_HEALTH_QUERY)
+    health = {}
+
+    for table, unsorted, stats_off, tbl_rows, visible_rows, size in cur.fetchall():
+        table = table.strip()
+        if table not in names:
+            continue
+
+        tbl_rows, visible_rows = int(tbl_rows or 0), int(visible_rows or 0)
+        previous_rows = previous_tables.get(table, {}).get("rows", 0)
+
+        health[table] = {
+            "unsorted_pct": float(unsorted),
+            "stats_off_pct": float(stats_off),
+            "deleted_pct": 100.0 * (tbl_rows - visible_rows) / tbl_rows if tbl_rows else 0.0,
+            "growth_pct": 100.0 * (visible_rows - previous_rows) / previous_rows if previous_rows else (100.0 if visible_rows else 0.0),
+            "rows": visible_rows,
+            "size_mb": int(size or 0)
+        }
+
+    return health
+
+
+def plan_operations(health, thresholds):
+    """
+    Picks the maintenance operations each table needs and orders them by priority, the
+    percentage over threshold weighted by the table size, so the largest gains run first:
+     VACUUM DELETE ONLY           deleted rows above thresholds["deleted_pct"]
+     VACUUM SORT ONLY             unsorted rows above thresholds["unsorted_pct"]
+     ANALYZE PREDICATE COLUMNS    stale statistics above thresholds["stats_off_pct"], or row
+                                  growth above thresholds["growth_pct"]
+
+    Args:
+        health (dict): output of table_health
+        thresholds (dict): metric name -> percentage that triggers an operation
+
+    Returns:
+        list: {"table", "operation", "statement", "reason", "priority"} in execution order
+    """
+
+    operations = []
+
+    for table, metrics in health.items():
+        weight = max(metrics["size_mb"], 1)
+
+        if metrics["deleted_pct"] >= thresholds["deleted_pct"]:
+            operations.append({"table": table, "operation": "vacuum_delete", "statement": f"VACUUM DELETE ONLY {table}",
+                               "reason": f"{metrics['deleted_pct']:.1f}% deleted rows",
+                               "priority": metrics["deleted_pct"] * weight})
+
+        if metrics["unsorted_pct"] >= thresholds["unsorted_pct"]:
+            operations.append({"table": table, "operation": "vacuum_sort", "statement": f"VACUUM SORT ONLY {table}",
+                               "reason": f"{metrics['unsorted_pct']:.1f}% unsorted rows",
+                               "priority": metrics["unsorted_pct"] * weight})
+
+        if metrics["stats_off_pct"] >= thresholds["stats_off_pct"] or metrics["growth_pct"] >= thresholds["growth_pct"]:
+            operations.append({"table": table, "operation": "analyze", "statement": f"ANALYZE {table} PREDICATE COLUMNS",
+                               "reason": f"statistics {metrics['stats_off_pct']:.1f}% off, {metrics['growth_pct']:.1f}% row growth",
+                               "priority": max(metrics["stats_off_pct"], metrics["growth_pct"]) * weight})
+
+    return sorted(operations, key=lambda operation: operation["priority"], reverse=True)
+
+
+def run_operations(cur, operations, budget_seconds, previous_operations):
+    """
+    Runs the planned operations in order until the time budget is spent.  An operation
+    whose duration in the previous maintenance run would overrun the remaining budget is
+    skipped, so a cheaper one further down the list can still run.
+
+    Args:
+        cur (class): psycopg2 cursor on an autocommit connection (VACUUM can't run in a transaction)
+        operations (list): output of plan_operations, updated with status and seconds
+        budget_seconds (float): time budget for the whole stage
+        previous_operations (list): operations of the previous maintenance run report
+    """
+
+    estimates = {(operation["table"], operation["operation"]): operation["seconds"]
+                 for operation in previous_operations if operation.get("status") == "done"}
+    start = time.perf_counter()
+
+    for operation in operations:
+        elapsed = time.perf_counter() - start
+        estimate = estimates.get((operation["table"], operation["operation"]), 0)
+
+        if elapsed + estimate > budget_seconds:
+            operation.update(status="skipped", seconds=0)
+            print(f"Skipping {operation['statement']} ({operation['reason']}), "
+                  f"~{estimate:.0f}s does not fit in the remaining {max(budget_seconds - elapsed, 0):.0f}s")
+            continue
+
+        operation_start = time.perf_counter()
+        cur.execute(operation["statement"])
+        operation.update(status="done", seconds=round(time.perf_counter() - operation_start, 4))
+        print(f"{operation['statement']} ({operation['reason']}) took {operation['seconds']:.2f}s")
+
+
+def run_maintenance(config):
+    """
+    Runs the maintenance stage on every table of create_table_queries and writes its run
+    report, which the next run reads for row growth and operation durations.
+
+    Args:
+        config (class): configparser.ConfigParser() for dwh.cfg
+
+    Returns:
+        class: instrumentation.RunReport of the stage
+    """
+
+    run_log_dir = config.get("ETL", "RUN_LOG_DIR", fallback="logs")
+    previous = previous_report(run_log_dir)
+    thresholds = {key: config.getfloat("MAINTENANCE", key.upper(), fallback=default)
+                  for key, default in (("unsorted_pct", 5), ("deleted_pct", 5), ("stats_off_pct", 10), ("growth_pct", 10))}
+    budget_seconds = config.getfloat("MAINTENANCE", "TIME_BUDGET_MINUTES", fallback=10) * 60
+
+    report = RunReport("maintenance", redshift=not is_local(config))
+    conn = connect(config)
+    conn.autocommit = True
+    cur = InstrumentedCursor(conn.cursor(), report)
+
+    print("Planning table maintenance...")
+    try:
+        with report.step("table_health"):
+            health = table_health(cur, table_names(), previous.get("tables", {}))
+        operations = plan_operations(health, thresholds)
+
+        if not operations:
+            print("Every table is within its thresholds, nothing to do")
+
+        with report.step("operations"):
+            run_operations(cur, operations, budget_seconds, previous.get("operations", []))
+    finally:
+        conn.close()
+
+    report.extras["tables"] = health
+    report.extras["operations"] = operations
+    report.write(run_log_dir)
+
+    print(f"Table maintenance done: {sum(operation['status'] == 'done' for operation in operations)} operations run, "
+          f"{sum(operation['status'] == 'skipped' for operation in operations)} skipped \n")
+
+    return report
+
+
+def main():
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    run_maintenance(config)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import json
+import os
+import re
+import time
+from storage import list_objects, split_s3_uri
+
+
+def size_summary(objects, slices):
+    """
+    Summarizes the files a manifest lists: their count and the spread of their sizes.  A
+    skew of 1.0 means every file has the same size.  Redshift decides which slice loads
+    which file, so this describes the input, not a per-slice assignment; with a file count
+    that isn't a multiple of the slice count, short_slices slices get one file fewer.
+
+    Args:
+        objects (list): (path, size in bytes) tuples, e.g. from storage.list_objects
+        slices (int): cluster slice count
+
+    Returns:
+        dict: file and byte counts, smallest/largest/mean file size, the max/mean skew and
+              short slices
+    """
+
+    sizes = [size for _, size in objects]
+    mean = sum(sizes) / len(sizes) if sizes else 0
+
+    return {
+        "total_files": len(sizes),
+        "total_bytes": sum(sizes),
+        "min_bytes": min(sizes, default=0),
+        "max_bytes": max(sizes, default=0),
+        "mean_bytes": round(mean),
+        "skew": max(sizes) / mean if mean else 1.0,
+        "short_slices": -len(sizes) % slices
+    }
+
+
+def write_manifest(location, entries):
+    """
+    Writes a Redshift COPY manifest to an S3 URI or a local file.
+
+    Args:
+        location (string): s3://bucket/key or local path of the manifest
+        entries (list): (path, size in bytes) tuples listed in the manifest
+    """
+
+    body = json.dumps({
+        "entries": [{"url": path, "mandatory": True, "meta": {"content_length": size}} for path, size in entries]
+    }, indent=1)
+
+    if location.startswith("s3://"):
+        import boto3
+
+        bucket, key = split_s3_uri(location)
+        boto3.client("s3").put_object(Bucket=bucket, Key=key, Body=body.encode("utf-8"))
+
+    else:
+        os.makedirs(os.path.dirname(location) or ".", exist_ok=True)
+        with open(location, "w") as manifest:
+            manifest.write(body)
+
+
+def manifest_copy(query, manifest_location):
+    """
+    Rewrites a COPY statement to read from a manifest instead of a prefix.
+
+    Args:
+        query (string): COPY statement from sql_queries.py
+        manifest_location (string): s3:// URI or local path of the manifest
+
+    Returns:
+        string: COPY statement reading FROM the manifest with the MANIFEST option
+    """
+
+    query = re.sub(r"FROM\s+\S+", lambda _: f"FROM '{manifest_location}'", query, count=1)
+
+    return query.rstrip() + "\n MANIFEST\n"
+
+
+def get_slice_count(cur):
+    """
+    Returns the number of slices in the cluster, i.e. how many files COPY loads at once.
+
+    Args:
+        cur (class): psycopg2 cursor for db interaction
+    """
+
+    cur.execute("SELECT COUNT(*) FROM stv_slices")
+
+    return cur.fetchone()[0]
+
+
+def build_manifest_copy(query, data_prefix, manifest_prefix, slices, run_log_dir):
+    """
+    Lists a COPY input prefix and writes all of its files to a single manifest, so one
+    COPY loads them on every slice at once instead of one COPY per group of files.  Every
+    file size and the size distribution are written to a JSON run log.  Files are listed
+    as they are, so uneven sizes or a file count that isn't a multiple of the slice count
+    leave some slices idle before the COPY ends; compaction (see compaction.py) rewrites
+    the input into evenly sized batches.
+
+    Args:
+        query (string): COPY statement from sql_queries.py to rewrite
+        data_prefix (string): S3 prefix or local directory the COPY reads from
+        manifest_prefix (string): S3 prefix or local directory the manifest is written to
+        slices (int): the cluster's slice count
+        run_log_dir (string): local directory for the manifest run log
+
+    Returns:
+        string: COPY ... MANIFEST statement
+    """
+
+    manifest_prefix = manifest_prefix.strip("'\"").rstrip("/")
+    if not manifest_prefix:
+        raise ValueError("MANIFEST_PREFIX is not set in the [ETL] section of dwh.cfg")
+
+    table = query.split()[1]
+    objects = list_objects(data_prefix)
+    summary = size_summary(objects, slices)
+
+    location = f"{manifest_prefix}/{table}.manifest"
+    write_manifest(location, objects)
+
+    os.makedirs(run_log_dir, exist_ok=True)
+    log_path = os.path.join(run_log_dir, f"manifest_{table}_{time.strftime('%Y%m%d%H%M%S')}.json")
+    with open(log_path, "w") as log:
+        json.dump({"table": table, "prefix": data_prefix, "slices": slices, "sizes": summary,
+                   "files": [{"path": path, "bytes": size} for path, size in objects]}, log, indent=1)
+
+    print(f"{summary['total_files']} files for {table} listed in {location} for {slices} slices "
+          f"(file size skew {summary['skew']:.2f}, {summary['short_slices']} slices with one file fewer), "
+          f"run log written to {log_path}")
+
+    return manifest_copy(query, location)
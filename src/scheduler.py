@@ -0,0 +1,225 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dq_engine import run_table_checks
+from instrumentation import InstrumentedCursor
+from journal import copy_sources
+
+
+def topological_order(graph):
+    """
+    Validates an ETL dependency graph and returns its nodes in dependency order.
+    Raises a ValueError when a node depends on an undeclared node or the graph has a cycle.
+
+    Args:
+        graph (dict): node name -> {"queries": [...], "depends_on": [...]}, plus optional
+                      "checks"
+
+    Returns:
+        list: node names, each appearing after all of its dependencies
+    """
+
+    for name, node in graph.items():
+        for dep in node["depends_on"]:
+            if dep not in graph:
+                raise ValueError(f"{name} depends on undeclared node {dep}")
+
+    remaining = {name: set(node["depends_on"]) for name, node in graph.items()}
+    order = []
+
+    while remaining:
+        ready = sorted(name for name, deps in remaining.items() if not deps)
+
+        if not ready:
+            raise ValueError(f"Dependency cycle between nodes: {sorted(remaining)}")
+
+        for name in ready:
+            order.append(name)
+            del remaining[name]
+
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+    return order
+
+
+def run_node(conn_pool, name, queries, report=None, journal=None, checks=None, catalog=True):
+    """
+    Executes every statement of a graph node on one pooled connection as a single
+    transaction.  A statement that takes parameters is given as a (statement, parameters)
+    pair.  Statements that return rows have their first value printed.  A node
+    with checks then runs them through dq_engine, table by table, printing every failed
+    check and adding the results to the report under "dq".
+
+    Args:
+        conn_pool (class): connection pool from backends.connection_pool
+        name (string): graph node name, used for output
+        queries (list): SQL statements, or (statement, parameters) pairs, executed in order
+        report (class): optional instrumentation.RunReport recording every statement
+        journal (class): optional journal.RunJournal recording the node's status
+        checks (dict): table -> declared checks, see dq_checks in sql_queries.py
+        catalog (bool): whether system catalog tables are available (False on the local engine)
+
+    Returns:
+        float: wall time of the node in seconds
+    """
+
+    conn = conn_pool.getconn()
+    statements = [query if isinstance(query, tuple) else (query, None) for query in queries]
+
+    if journal is not None:
+        journal.start(name, copy_sources([query for query, _ in statements], getattr(conn, "resolve", None)) or None)
+
+    try:
+        start = time.perf_counter()
+        with conn.cursor() as cur:
+            if report is not None:
+                cur = InstrumentedCursor(cur, report, name)
+
+            for query, params in statements:
+                cur.execute(query, params)
+                if cur.description is not None:
+                    print(f"{name}: {' '.join(query.split())} = {cur.fetchone()[0]}")
+
+            results = {table: run_table_checks(cur, table, table_checks, catalog) for table, table_checks in (checks or {}).items()}
+        conn.commit()
+
+        for table, result in results.items():
+            for failure in result["failures"]:
+                print(f"{name}: {table} FAILED: {failure}")
+        if checks:
+            print(f"{name}: {sum(len(result['failures']) for result in results.values())} data quality checks failed")
+        if checks and report is not None:
+            report.extras["dq"] = results
+
+        if journal is not None:
+            journal.finish(name)
+
+        return time.perf_counter() - start
+
+    except Exception as e:
+        if journal is not None:
+            journal.fail(name, e)
+        raise
+
+    finally:
+        conn_pool.putconn(conn)
+
+
+def critical_path(graph, durations):
+    """
+    Finds the chain of dependent nodes with the longest total duration, which bounds
+    the wall time of the run no matter how much parallelism is available.
+
+    Args:
+        graph (dict): ETL dependency graph
+        durations (dict): node name -> wall time in seconds
+
+    Returns:
+        tuple: (list of node names on the critical path, total seconds)
+    """
+
+    finish = {}
+    previous = {}
+
+    for name in topological_order(graph):
+        deps = graph[name]["depends_on"]
+        slowest = max(deps, key=lambda dep: finish[dep], default=None)
+        previous[name] = slowest
+        finish[name] = durations[name] + (finish[slowest] if slowest else 0.0)
+
+    node = max(finish, key=finish.get)
+    total = finish[node]
+    path = []
+
+    while node:
+        path.append(node)
+        node = previous[node]
+
+    return list(reversed(path)), total
+
+
+def run_graph(graph, conn_pool, max_parallelism, report=None, journal=None, catalog=True):
+    """
+    Runs an ETL dependency graph, executing every node whose dependencies have completed
+    concurrently on separate connections, with at most max_parallelism nodes in flight.
+    A per-node and critical-path timing summary is printed at the end.  If a node fails,
+    no new nodes are started and the error is raised once running nodes finish.  Nodes a
+    resumed journal records as done are not executed again.
+
+    Args:
+        graph (dict): node name -> {"queries": [...], "depends_on": [...]}, plus optional
+                      "checks" run after the queries, see run_node
+        conn_pool (class): connection pool from backends.connection_pool, with at least
+                           max_parallelism connections
+        max_parallelism (int): maximum number of nodes executing at once
+        report (class): optional instrumentation.RunReport recording every statement
+        journal (class): optional journal.RunJournal recording every node's status
+        catalog (bool): whether system catalog tables are available to the checks
+
+    Returns:
+        dict: node name -> wall time in seconds
+    """
+
+    topological_order(graph)
+
+    skipped = [name for name in graph if journal is not None and journal.completed(name)]
+    waiting_on = {name: set(node["depends_on"]) - set(skipped) for name, node in graph.items() if name not in skipped}
+    ready = sorted(name for name, deps in waiting_on.items() if not deps)
+    running = {}
+    durations = {name: 0.0 for name in skipped}
+    error = None
+
+    if skipped:
+        print(f"Skipping {', '.join(skipped)}, completed in run {journal.state['run_id']}")
+
+    print(f"Running {len(graph)} ETL steps with max parallelism {max_parallelism}...")
+    run_start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max_parallelism) as executor:
+        while ready or running:
+            while ready and len(running) < max_parallelism and error is None:
+                name = ready.pop(0)
+                print(f"Starting {name}")
+                running[executor.submit(run_node, conn_pool, name, graph[name]["queries"], report, journal,
+                                        graph[name].get("checks"), catalog)] = name
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                name = running.pop(future)
+
+                try:
+                    durations[name] = future.result()
+                except Exception as e:
+                    print(f"{name} failed: {e}")
+                    error = error or e
+                    continue
+
+                print(f"{name} finished in {durations[name]:.2f}s")
+
+                for other, deps in waiting_on.items():
+                    if name in deps:
+                        deps.discard(name)
+                        if not deps:
+                            ready.append(other)
+
+    if error is not None:
+        raise error
+
+    wall_time = time.perf_counter() - run_start
+    path, path_time = critical_path(graph, durations)
+
+    print("\nETL timing summary")
+    for name in topological_order(graph):
+        print(f" {name:<20} {durations[name]:>8.2f}s")
+    print(f" serial total         {sum(durations.values()):>8.2f}s")
+    print(f" wall time            {wall_time:>8.2f}s")
+    print(f" critical path        {path_time:>8.2f}s  ({' -> '.join(path)})\n")
+
+    if report is not None:
+        report.extras["critical_path"] = {"nodes": path, "seconds": round(path_time, 4)}
+
+    return durations
@@ -1,146 +1,462 @@
 import configparser
 import os
+import re
+from functools import lru_cache
+from table_model import Column, MaterializedView, Table, apply_encodings, load_encodings
 
 # CONFIG
+# Config files are parsed on first use and cached.  Importing this module only reads
+# COMPRESSION_FILE from dwh.cfg for the table model; the [S3] locations and the IAM role in
+# ~\.aws\config are only read when a COPY statement is first used (see LAZY QUERIES below).
 main_config_path = "dwh.cfg"
-main_config = configparser.ConfigParser()
-main_config.read(main_config_path)
-
 aws_config_path = os.path.expanduser("~\\.aws\\config")
-aws_config = configparser.ConfigParser()
-aws_config.read(aws_config_path)
+
+
+@lru_cache(maxsize=None)
+def read_config(path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+def quote_literal(value):
+    """
+    Renders a value as a SQL literal with psycopg2's adapter: quotes are doubled and
+    backslashes escaped, as Redshift reads string literals.
+    """
+
+    from psycopg2.extensions import adapt
+
+    literal = adapt(value)
+    if hasattr(literal, "encoding"):
+        literal.encoding = "utf-8"
+
+    return literal.getquoted().decode("utf-8")
+
+
+def bind(template, **values):
+    """
+    Binds config values (the [S3] locations and the IAM role) into the %(name)s placeholders
+    of a statement as quoted SQL literals, so statements that only depend on the config can
+    be rendered once and run as plain text.  Values only known at run time, like a log_data
+    partition or the watermark, are passed to cur.execute as parameters instead.
+    Placeholders without a value are left in place for those parameters.
+
+    Args:
+        template (string): SQL statement with %(name)s placeholders
+        **values: placeholder name -> value
+
+    Returns:
+        string: SQL statement
+    """
+
+    return re.sub(r"%\((\w+)\)s",
+                  lambda match: quote_literal(values[match.group(1)]) if match.group(1) in values else match.group(0),
+                  template)
+
+
+def config_value(path, section, key, **kwargs):
+    """
+    Reads a config value, unwrapping the quotes dwh.cfg keeps around the S3 locations.
+    """
+
+    return read_config(path).get(section, key, **kwargs).strip("'\"")
+
+
+# TABLE MODEL
+# Every table's columns, widths, encodings and dist/sort keys.  The CREATE and DROP statements
+# below are rendered from these definitions, with encodings overridden by the ANALYZE COMPRESSION
+# suggestions in COMPRESSION_FILE (see table_model.py) when that file exists.
+
+staging_events_table = Table(
+    name="staging_events",
+    columns=(
+        Column("artist", "VARCHAR", 512, "ZSTD"),
+        Column("auth", "VARCHAR", 16, "ZSTD"),
+        Column("firstName", "VARCHAR", 64, "ZSTD"),
+        Column("gender", "VARCHAR", 1, "ZSTD"),
+        Column("itemInSession", "VARCHAR", 16, "ZSTD"),
+        Column("lastName", "VARCHAR", 64, "ZSTD"),
+        Column("length", "DOUBLE PRECISION", encoding="ZSTD"),
+        Column("level", "VARCHAR", 8, "ZSTD"),
+        Column("location", "VARCHAR", 256, "ZSTD"),
+        Column("method", "VARCHAR", 8, "ZSTD"),
+        Column("page", "VARCHAR", 32, "ZSTD"),
+        Column("registration", "NUMERIC", "18,0", "AZ64"),
+        Column("sessionId", "NUMERIC", "18,0", "AZ64"),
+        Column("song", "VARCHAR", 512, "ZSTD"),
+        Column("status", "NUMERIC", "18,0", "AZ64"),
+        Column("ts", "TIMESTAMP", encoding="AZ64"),
+        Column("userAgent", "VARCHAR", 256, "ZSTD"),
+        Column("userId", "VARCHAR", 32, "ZSTD"),
+        Column("match_key", "BIGINT", encoding="RAW")
+    ),
+    distkey="match_key",
+    sortkey=("match_key",)
+)
+
+staging_songs_table = Table(
+    name="staging_songs",
+    columns=(
+        Column("artist_id", "VARCHAR", 32, "ZSTD"),
+        Column("artist_latitude", "DOUBLE PRECISION", encoding="ZSTD"),
+        Column("artist_location", "VARCHAR", 512, "ZSTD"),
+        Column("artist_longitude", "DOUBLE PRECISION", encoding="ZSTD"),
+        Column("artist_name", "VARCHAR", 512, "ZSTD"),
+        Column("duration", "DOUBLE PRECISION", encoding="ZSTD"),
+        Column("num_songs", "NUMERIC", "18,0", "AZ64"),
+        Column("song_id", "VARCHAR", 32, "ZSTD"),
+        Column("title", "VARCHAR", 512, "ZSTD"),
+        Column("year", "NUMERIC", "18,0", "AZ64"),
+        Column("match_key", "BIGINT", encoding="RAW")
+    ),
+    distkey="match_key",
+    sortkey=("match_key",)
+)
+
+# Landing tables: COPY loads the raw files here, EVEN-distributed and unsorted, and the rows
+# are then inserted into their staging table with the match key computed on the way.  The
+# key is written once, so staging rows land on their slices and in sort key order instead
+# of being rewritten by an UPDATE after the COPY.
+
+staging_events_landing_table = Table(
+    name="staging_events_landing",
+    columns=tuple(column for column in staging_events_table.columns if column.name != "match_key"),
+    diststyle="EVEN"
+)
+
+staging_songs_landing_table = Table(
+    name="staging_songs_landing",
+    columns=tuple(column for column in staging_songs_table.columns if column.name != "match_key"),
+    diststyle="EVEN"
+)
+
+songplays_table = Table(
+    name="songplays",
+    columns=(
+        Column("songplay_id", "INT", encoding="AZ64", identity=(0, 1), primary_key=True),
+        Column("start_time", "TIMESTAMP", encoding="RAW", not_null=True),
+        Column("user_id", "VARCHAR", 32, "ZSTD", not_null=True),
+        Column("level", "VARCHAR", 8, "ZSTD"),
+        Column("song_id", "VARCHAR", 32, "ZSTD", not_null=True),
+        Column("artist_id", "VARCHAR", 32, "ZSTD", not_null=True),
+        Column("session_id", "VARCHAR", 32, "ZSTD", not_null=True),
+        Column("location", "VARCHAR", 256, "ZSTD"),
+        Column("user_agent", "VARCHAR", 256, "ZSTD")
+    ),
+    distkey="artist_id",
+    sortkey=("start_time",)
+)
+
+users_table = Table(
+    name="users",
+    columns=(
+        Column("user_id", "VARCHAR", 32, "ZSTD", primary_key=True),
+        Column("first_name", "VARCHAR", 64, "ZSTD"),
+        Column("last_name", "VARCHAR", 64, "ZSTD"),
+        Column("gender", "VARCHAR", 1, "ZSTD"),
+        Column("level", "VARCHAR", 8, "RAW")
+    ),
+    sortkey=("level",)
+)
+
+songs_table = Table(
+    name="songs",
+    columns=(
+        Column("song_id", "VARCHAR", 32, "ZSTD", primary_key=True),
+        Column("title", "VARCHAR", 512, "ZSTD"),
+        Column("artist_id", "VARCHAR", 32, "ZSTD", not_null=True),
+        Column("year", "VARCHAR", 4, "ZSTD"),
+        Column("duration", "DOUBLE PRECISION", encoding="ZSTD")
+    ),
+    distkey="artist_id"
+)
+
+artists_table = Table(
+    name="artists",
+    columns=(
+        Column("artist_id", "VARCHAR", 32, "ZSTD", primary_key=True),
+        Column("name", "VARCHAR", 512, "ZSTD"),
+        Column("location", "VARCHAR", 512, "ZSTD"),
+        Column("latitude", "DOUBLE PRECISION", encoding="ZSTD"),
+        Column("longitude", "DOUBLE PRECISION", encoding="ZSTD")
+    ),
+    distkey="artist_id"
+)
+
+time_table = Table(
+    name="time",
+    columns=(
+        Column("start_time", "TIMESTAMP", encoding="AZ64", primary_key=True),
+        Column("hour", "INT", encoding="AZ64", not_null=True),
+        Column("day", "INT", encoding="AZ64", not_null=True),
+        Column("week", "INT", encoding="AZ64", not_null=True),
+        Column("month", "INT", encoding="AZ64", not_null=True),
+        Column("year", "INT", encoding="AZ64", not_null=True),
+        Column("weekday", "VARCHAR", 1, "RAW", not_null=True)
+    ),
+    sortkey=("weekday",)
+)
+
+# One row per hour with the attributes of the time dimension, filled from the play hours of
+# songplays right before time is loaded, so time looks them up instead of running six
+# EXTRACTs per row.
+
+calendar_table = Table(
+    name="calendar",
+    columns=(
+        Column("hour_start", "TIMESTAMP", encoding="RAW", primary_key=True),
+        Column("date", "DATE", encoding="AZ64", not_null=True),
+        Column("hour", "INT", encoding="AZ64", not_null=True),
+        Column("day", "INT", encoding="AZ64", not_null=True),
+        Column("week", "INT", encoding="AZ64", not_null=True),
+        Column("month", "INT", encoding="AZ64", not_null=True),
+        Column("year", "INT", encoding="AZ64", not_null=True),
+        Column("weekday", "VARCHAR", 1, "ZSTD", not_null=True)
+    ),
+    diststyle="ALL",
+    sortkey=("hour_start",)
+)
+
+load_watermark_table = Table(
+    name="load_watermark",
+    columns=(
+        Column("source", "VARCHAR", 64, "ZSTD", primary_key=True),
+        Column("watermark", "DATE", encoding="AZ64", not_null=True),
+        Column("loaded_at", "TIMESTAMP", encoding="AZ64", not_null=True)
+    ),
+    diststyle="ALL"
+)
+
+encodings = load_encodings(read_config(main_config_path).get("ETL", "COMPRESSION_FILE", fallback=""))
+tables = [apply_encodings(table, encodings.get(table.name, {})) if table.name in encodings else table
+          for table in (staging_events_table, staging_songs_table, staging_events_landing_table,
+                        staging_songs_landing_table, songplays_table, users_table,
+                        songs_table, artists_table, time_table, calendar_table, load_watermark_table)]
+
+# ROLLUP VIEWS
+# Plays per hour, per subscription level and per artist, pre-aggregated so dashboards read
+# a few thousand rows instead of joining and re-aggregating songplays on every request.
+# Only inner joins and COUNT aggregates, so REFRESH can apply each load incrementally.
+
+rollup_views = [
+    MaterializedView(
+        name="songplays_hourly",
+        query="""
+ SELECT
+  t.year,
+  t.month,
+  t.day,
+  t.hour,
+  COUNT(*) AS songplay_count
+ FROM songplays sp
+ JOIN time t
+  ON (sp.start_time = t.start_time)
+ GROUP BY
+  t.year,
+  t.month,
+  t.day,
+  t.hour
+""",
+        sortkey=("year", "month", "day", "hour")
+    ),
+    MaterializedView(
+        name="songplays_by_level",
+        query="""
+ SELECT
+  u.level,
+  t.year,
+  t.month,
+  COUNT(*) AS songplay_count
+ FROM songplays sp
+ JOIN users u
+  ON (sp.user_id = u.user_id)
+ JOIN time t
+  ON (sp.start_time = t.start_time)
+ GROUP BY
+  u.level,
+  t.year,
+  t.month
+""",
+        sortkey=("level",)
+    ),
+    MaterializedView(
+        name="songplays_by_artist",
+        query="""
+ SELECT
+  s.artist_id,
+  a.name AS artist_name,
+  COUNT(*) AS songplay_count
+ FROM songplays sp
+ JOIN songs s
+  ON (sp.song_id = s.song_id)
+ JOIN artists a
+  ON (s.artist_id = a.artist_id)
+ GROUP BY
+  s.artist_id,
+  a.name
+"""
+    )
+]
+
+get_view_refresh_status = ("""
+ SELECT TRIM(status)
+ FROM svl_mv_refresh_status
+ WHERE mv_name = %s
+ ORDER BY starttime DESC
+ LIMIT 1
+""")
 
 # DROP TABLES
 
-staging_events_table_drop = "DROP TABLE IF EXISTS staging_events"
-staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs"
-songplay_table_drop = "DROP TABLE IF EXISTS songplay"
-user_table_drop = "DROP TABLE IF EXISTS users"
-song_table_drop = "DROP TABLE IF EXISTS songs"
-artist_table_drop = "DROP TABLE IF EXISTS artists"
-time_table_drop = "DROP TABLE IF EXISTS time"
+staging_events_table_drop, staging_songs_table_drop, staging_events_landing_table_drop, \
+    staging_songs_landing_table_drop, songplay_table_drop, user_table_drop, song_table_drop, \
+    artist_table_drop, time_table_drop, calendar_table_drop, load_watermark_table_drop = [table.drop_sql() for table in tables]
 
 # CREATE TABLES
 
-staging_events_table_create= ("""
-CREATE TABLE IF NOT EXISTS staging_events (
- artist              text,
- auth		             text,
- firstName           text,
- gender              text,
- itemInSession       text,
- lastName            text,
- length              double precision,
- level               text,
- location            text,
- method              text,
- page                text,
- registration        numeric,
- sessionId           numeric,
- song                text,
- status              numeric,
- ts                  timestamp,
- userAgent           text,
- userId              text
-);
-""")
+staging_events_table_create, staging_songs_table_create, staging_events_landing_table_create, \
+    staging_songs_landing_table_create, songplays_table_create, users_table_create, \
+    songs_table_create, artists_table_create, time_table_create, calendar_table_create, load_watermark_table_create = [table.create_sql() for table in tables]
+
+# CLEAR TABLES
+# DELETE rather than TRUNCATE, which commits immediately in Redshift: running a table's clear
+# in the same transaction as its load makes every load step safe to re-execute after a failure.
+# The watermark and the calendar outlive a load and are never cleared.
+
+clear_table_queries = {table.name: table.delete_sql() for table in tables if table.name not in ("load_watermark", "calendar")}
 
-staging_songs_table_create = ("""
-CREATE TABLE IF NOT EXISTS staging_songs (
- artist_id           text,
- artist_latitude     double precision,
- artist_location     text,
- artist_longitude    double precision,
- artist_name         text,
- duration            double precision,
- num_songs           numeric,
- song_id             text,
- title               text,
- year                numeric
-);
+# STAGING TABLES
+
+# Bound with the [S3] locations and the IAM role when first used, see LAZY QUERIES
+
+staging_events_copy_template = ("""
+ COPY staging_events_landing (artist, auth, firstName, gender, itemInSession, lastName, length, level, location, method, page, registration, sessionId, song, status, ts, userAgent, userId)
+ FROM %(source)s
+ credentials %(credentials)s
+ region 'us-west-2'
+ JSON %(jsonpath)s
+ timeformat as 'epochmillisecs'
 """)
 
-songplays_table_create = ("""
-CREATE TABLE IF NOT EXISTS songplays (
- songplay_id          INT         IDENTITY(0,1) PRIMARY KEY, 
- start_time           TIMESTAMP   NOT NULL SORTKEY, 
- user_id              VARCHAR     NOT NULL, 
- level                VARCHAR, 
- song_id              VARCHAR     NOT NULL, 
- artist_id            VARCHAR     NOT NULL DISTKEY, 
- session_id           VARCHAR     NOT NULL, 
- location             VARCHAR, 
- user_agent           VARCHAR
-);
+staging_songs_copy_template = ("""
+ COPY staging_songs_landing (artist_id, artist_latitude, artist_location, artist_longitude, artist_name, duration, num_songs, song_id, title, year)
+ FROM %(source)s
+ credentials %(credentials)s
+ region 'us-west-2'
+ JSON 'auto'
 """)
 
-users_table_create = ("""
-CREATE TABLE IF NOT EXISTS users (
- user_id              VARCHAR     PRIMARY KEY, 
- first_name           VARCHAR, 
- last_name            VARCHAR, 
- gender               VARCHAR, 
- level                VARCHAR    SORTKEY
-);
+# MATCH KEYS
+# Normalized (trimmed, case-folded) hash of song title + artist name, computed while the
+# landed rows are inserted into the staging tables.  Both staging tables are distributed and
+# sorted on it, so the songplays join is a co-located join on a single BIGINT; the join still
+# compares the normalized text, so two songs whose keys collide are never matched.  Events
+# other than NextSong have no song to match and are keyed on their session position instead,
+# which spreads them over the slices rather than piling them onto one.
+
+staging_events_insert = ("""
+ INSERT INTO staging_events (artist, auth, firstName, gender, itemInSession, lastName, length, level, location, method, page, registration, sessionId, song, status, ts, userAgent, userId, match_key)
+  SELECT
+   artist, auth, firstName, gender, itemInSession, lastName, length, level, location, method, page, registration, sessionId, song, status, ts, userAgent, userId,
+   FNV_HASH(
+    CASE WHEN page = 'NextSong' AND song IS NOT NULL AND artist IS NOT NULL
+     THEN LOWER(TRIM(song)) || '|' || LOWER(TRIM(artist))
+     ELSE COALESCE(CAST(sessionId AS VARCHAR), '') || '|' || COALESCE(itemInSession, '') || '|' || COALESCE(CAST(ts AS VARCHAR), '')
+    END
+   )
+  FROM staging_events_landing
 """)
 
-songs_table_create = ("""
-CREATE TABLE IF NOT EXISTS songs (
- song_id             VARCHAR      PRIMARY KEY, 
- title               VARCHAR, 
- artist_id           VARCHAR      NOT NULL DISTKEY, 
- year                VARCHAR, 
- duration            DOUBLE PRECISION
-);
+staging_songs_insert = ("""
+ INSERT INTO staging_songs (artist_id, artist_latitude, artist_location, artist_longitude, artist_name, duration, num_songs, song_id, title, year, match_key)
+  SELECT
+   artist_id, artist_latitude, artist_location, artist_longitude, artist_name, duration, num_songs, song_id, title, year,
+   FNV_HASH(LOWER(TRIM(title)) || '|' || LOWER(TRIM(artist_name)))
+  FROM staging_songs_landing
 """)
 
-artists_table_create = ("""
-CREATE TABLE IF NOT EXISTS artists (
- artist_id           VARCHAR      PRIMARY KEY DISTKEY, 
- name                VARCHAR, 
- location            VARCHAR, 
- latitude            DOUBLE PRECISION, 
- longitude           DOUBLE PRECISION
-);
+get_song_match_counts = ("""
+ SELECT
+  COUNT(s.match_key) AS matched,
+  COUNT(*) - COUNT(s.match_key) AS missed
+ FROM staging_events e
+ LEFT JOIN (SELECT DISTINCT match_key, LOWER(TRIM(title)) AS title, LOWER(TRIM(artist_name)) AS artist_name FROM staging_songs) s
+  ON (s.match_key = e.match_key AND s.title = LOWER(TRIM(e.song)) AND s.artist_name = LOWER(TRIM(e.artist)))
+ WHERE e.page = 'NextSong'
 """)
 
-time_table_create = ("""
-CREATE TABLE IF NOT EXISTS time (
- start_time         TIMESTAMP     PRIMARY KEY, 
- hour               INT           NOT NULL, 
- day                INT           NOT NULL, 
- week               INT           NOT NULL, 
- month              INT           NOT NULL, 
- year               INT           NOT NULL, 
- weekday            VARCHAR       NOT NULL SORTKEY
-)
+# INCREMENTAL STAGING
+# staging_events_partition_copy is staging_events_copy_template with the credentials and
+# jsonpaths bound; etl.py passes the source of each log_data/YYYY/MM/YYYY-MM-DD-events.json
+# partition as a parameter, like the watermark of log_data_watermark_update.
+
+staging_events_clear = "DELETE FROM staging_events"
+get_count_staging_songs = "SELECT COUNT(1) FROM staging_songs"
+
+get_log_data_watermark = "SELECT watermark FROM load_watermark WHERE source = 'log_data'"
+
+log_data_watermark_update = ("""
+ DELETE FROM load_watermark WHERE source = 'log_data';
+ INSERT INTO load_watermark (source, watermark, loaded_at) VALUES ('log_data', %(watermark)s, GETDATE());
 """)
 
-# STAGING TABLES
+# CALENDAR
+# The hours of songplays not in the calendar yet, with their attributes extracted once per
+# hour.  The merge variant only reads the play times of the events just staged, like
+# time_table_merge.
 
-staging_events_copy = ("""
- COPY staging_events
- FROM {}
- credentials 'aws_iam_role={}'
- region 'us-west-2'
- JSON {}
- timeformat as 'epochmillisecs'
-""").format(
-    main_config.get("S3","LOG_DATA"),
-    aws_config.get("profile Redshift","role_arn"),
-    main_config.get("S3","LOG_JSONPATH")
-)
+calendar_fill = ("""
+ INSERT INTO calendar (
+  hour_start,
+  date,
+  hour,
+  day,
+  week,
+  month,
+  year,
+  weekday
+ )
+  SELECT
+   h.hour_start,
+   CAST(h.hour_start AS DATE),
+   EXTRACT(hour FROM h.hour_start),
+   EXTRACT(day FROM h.hour_start),
+   EXTRACT(week FROM h.hour_start),
+   EXTRACT(month FROM h.hour_start),
+   EXTRACT(year FROM h.hour_start),
+   EXTRACT(dayofweek FROM h.hour_start)
+  FROM (SELECT DISTINCT DATE_TRUNC('hour', start_time) AS hour_start FROM songplays) h
+  WHERE NOT EXISTS (SELECT 1 FROM calendar c WHERE c.hour_start = h.hour_start)
+""")
 
-staging_songs_copy = ("""
- COPY staging_songs
- FROM {}
- credentials 'aws_iam_role={}'
- region 'us-west-2'
- JSON 'auto'
-""").format(
-    main_config.get("S3","SONG_DATA"),
-    aws_config.get("profile Redshift","role_arn")
-)
+calendar_merge = ("""
+ INSERT INTO calendar (
+  hour_start,
+  date,
+  hour,
+  day,
+  week,
+  month,
+  year,
+  weekday
+ )
+  SELECT
+   h.hour_start,
+   CAST(h.hour_start AS DATE),
+   EXTRACT(hour FROM h.hour_start),
+   EXTRACT(day FROM h.hour_start),
+   EXTRACT(week FROM h.hour_start),
+   EXTRACT(month FROM h.hour_start),
+   EXTRACT(year FROM h.hour_start),
+   EXTRACT(dayofweek FROM h.hour_start)
+  FROM (
+   SELECT DISTINCT DATE_TRUNC('hour', start_time) AS hour_start
+   FROM songplays
+   WHERE start_time >= (SELECT MIN(ts) FROM staging_events WHERE page = 'NextSong')
+  ) h
+  WHERE NOT EXISTS (SELECT 1 FROM calendar c WHERE c.hour_start = h.hour_start)
+""")
 
 # FINAL TABLES
 
@@ -166,7 +482,9 @@ songplays_table_insert = ("""
    e.useragent
   FROM staging_songs s
   INNER JOIN staging_events e
-   ON (s.title = e.song AND s.artist_name = e.artist)
+   ON (s.match_key = e.match_key
+       AND LOWER(TRIM(s.title)) = LOWER(TRIM(e.song))
+       AND LOWER(TRIM(s.artist_name)) = LOWER(TRIM(e.artist)))
   WHERE e.page = 'NextSong'
 """)
 
@@ -224,34 +542,392 @@ artists_table_insert = ("""
 time_table_insert = ("""
  INSERT INTO time (
   start_time,
-  hour, 
-  day, 
-  week, 
-  month, 
+  hour,
+  day,
+  week,
+  month,
+  year,
+  weekday
+ )
+  SELECT
+   sp.start_time,
+   c.hour,
+   c.day,
+   c.week,
+   c.month,
+   c.year,
+   c.weekday
+  FROM (SELECT DISTINCT start_time FROM songplays) sp
+  JOIN calendar c
+   ON (c.hour_start = DATE_TRUNC('hour', sp.start_time))
+""")
+
+# DIMENSION UPSERTS
+# Each dimension is staged with one row per key (the latest record wins), then existing rows
+# for those keys are deleted and the staged rows inserted, all in one transaction.  Re-running
+# a load replaces rows instead of appending another copy, and a user whose level changed keeps
+# a single row.
+
+users_stage_create = ("""
+ CREATE TEMP TABLE users_stage AS
+  SELECT user_id, first_name, last_name, gender, level
+  FROM (
+   SELECT
+    userid AS user_id,
+    firstname AS first_name,
+    lastname AS last_name,
+    gender,
+    level,
+    ROW_NUMBER() OVER (PARTITION BY userid ORDER BY ts DESC) AS recency
+   FROM staging_events
+   WHERE userid IS NOT NULL AND userid <> ''
+  ) latest
+  WHERE recency = 1
+""")
+
+songs_stage_create = ("""
+ CREATE TEMP TABLE songs_stage AS
+  SELECT song_id, title, artist_id, year, duration
+  FROM (
+   SELECT
+    song_id,
+    title,
+    artist_id,
+    year,
+    duration,
+    ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY year DESC, title) AS recency
+   FROM staging_songs
+   WHERE song_id IS NOT NULL
+  ) latest
+  WHERE recency = 1
+""")
+
+artists_stage_create = ("""
+ CREATE TEMP TABLE artists_stage AS
+  SELECT artist_id, name, location, latitude, longitude
+  FROM (
+   SELECT
+    artist_id,
+    artist_name AS name,
+    artist_location AS location,
+    artist_latitude AS latitude,
+    artist_longitude AS longitude,
+    ROW_NUMBER() OVER (PARTITION BY artist_id ORDER BY year DESC, song_id) AS recency
+   FROM staging_songs
+   WHERE artist_id IS NOT NULL
+  ) latest
+  WHERE recency = 1
+""")
+
+users_upsert_delete = "DELETE FROM users USING users_stage WHERE users.user_id = users_stage.user_id"
+users_upsert_insert = "INSERT INTO users (user_id, first_name, last_name, gender, level) SELECT user_id, first_name, last_name, gender, level FROM users_stage"
+users_stage_drop = "DROP TABLE users_stage"
+
+songs_upsert_delete = "DELETE FROM songs USING songs_stage WHERE songs.song_id = songs_stage.song_id"
+songs_upsert_insert = "INSERT INTO songs (song_id, title, artist_id, year, duration) SELECT song_id, title, artist_id, year, duration FROM songs_stage"
+songs_stage_drop = "DROP TABLE songs_stage"
+
+artists_upsert_delete = "DELETE FROM artists USING artists_stage WHERE artists.artist_id = artists_stage.artist_id"
+artists_upsert_insert = "INSERT INTO artists (artist_id, name, location, latitude, longitude) SELECT artist_id, name, location, latitude, longitude FROM artists_stage"
+artists_stage_drop = "DROP TABLE artists_stage"
+
+# INCREMENTAL MERGES
+# staging_events only holds partitions newer than the watermark, yet a replayed partition
+# must not add its plays twice, so songplays skips plays already in the table (same
+# session, start_time and user); dimension rows are only added when their key isn't in the
+# target table yet.
+
+songplays_table_merge = ("""
+ INSERT INTO songplays (
+  start_time, 
+  user_id, 
+  level, 
+  song_id, 
+  artist_id, 
+  session_id, 
+  location, 
+  user_agent
+ )
+  SELECT
+   e.ts,
+   e.userid,
+   e.level,
+   s.song_id,
+   s.artist_id,
+   e.sessionid,
+   e.location,
+   e.useragent
+  FROM staging_songs s
+  INNER JOIN staging_events e
+   ON (s.match_key = e.match_key
+       AND LOWER(TRIM(s.title)) = LOWER(TRIM(e.song))
+       AND LOWER(TRIM(s.artist_name)) = LOWER(TRIM(e.artist)))
+  WHERE e.page = 'NextSong'
+   AND NOT EXISTS (SELECT 1 FROM songplays sp
+                   WHERE sp.session_id = e.sessionid AND sp.start_time = e.ts AND sp.user_id = e.userid)
+""")
+
+users_table_merge = ("""
+ INSERT INTO users (
+  user_id,
+  first_name,
+  last_name,
+  gender,
+  level  
+ )
+  SELECT
+   DISTINCT(e.userid),
+   e.firstname,
+   e.lastname,
+   e.gender,
+   e.level
+  FROM staging_events e
+  WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.user_id = e.userid)
+""")
+
+songs_table_merge = ("""
+ INSERT INTO songs (
+  song_id, 
+  title, 
+  artist_id, 
   year, 
+  duration
+ )
+  SELECT
+   s.song_id,
+   s.title,
+   s.artist_id,
+   s.year,
+   s.duration
+  FROM staging_songs s
+  WHERE NOT EXISTS (SELECT 1 FROM songs t WHERE t.song_id = s.song_id)
+""")
+
+artists_table_merge = ("""
+ INSERT INTO artists (
+  artist_id, 
+  name, 
+  location, 
+  latitude, 
+  longitude
+ )
+  SELECT
+   DISTINCT(s.artist_id),
+   s.artist_name,
+   s.artist_location,
+   s.artist_latitude,
+   s.artist_longitude
+  FROM staging_songs s
+  WHERE NOT EXISTS (SELECT 1 FROM artists a WHERE a.artist_id = s.artist_id)
+""")
+
+# Only the play times of the events just staged are read, a range-restricted scan on the
+# songplays sort key, and only those not in time yet are added.
+time_table_merge = ("""
+ INSERT INTO time (
+  start_time,
+  hour,
+  day,
+  week,
+  month,
+  year,
   weekday
  )
   SELECT
-   ts,
-   EXTRACT(hour from ts),
-   EXTRACT(day from ts),
-   EXTRACT(week from ts),
-   EXTRACT(month from ts),
-   EXTRACT(year from ts),
-   EXTRACT(dayofweek from ts)
-  FROM staging_events
+   sp.start_time,
+   c.hour,
+   c.day,
+   c.week,
+   c.month,
+   c.year,
+   c.weekday
+  FROM (
+   SELECT DISTINCT start_time
+   FROM songplays
+   WHERE start_time >= (SELECT MIN(ts) FROM staging_events WHERE page = 'NextSong')
+  ) sp
+  JOIN calendar c
+   ON (c.hour_start = DATE_TRUNC('hour', sp.start_time))
+  WHERE NOT EXISTS (SELECT 1 FROM time t WHERE t.start_time = sp.start_time)
 """)
 
-# BASIC DATA QUALITY CHECKS
-get_count_songplay = "SELECT COUNT(1) FROM songplays"
-get_count_users_table = "SELECT COUNT(1) FROM users"
-get_count_artists_table = "SELECT COUNT(1) FROM artists"
-get_count_songs_table = "SELECT COUNT(1) FROM songs"
-get_count_time_table = "SELECT COUNT(1) FROM time"
+# DATA QUALITY CHECKS
+# Checks per table, compiled by dq_engine.py into one aggregate scan per table:
+#  row_count      True to count rows in the scan, "catalog" to read the count from the system catalog;
+#                 the catalog keeps counting DELETEd rows until VACUUM, so any table in
+#                 clear_table_queries counts its rows with True
+#  not_null       business keys whose NULL rate is reported (any NULL fails)
+#  unique         primary key checked for duplicates
+#  orphans        foreign key column -> (parent table, parent column) that must exist
+#  time_coverage  timestamp column whose range is checked for days without rows
+
+dq_checks = {
+    "staging_events": {"row_count": True},
+    "staging_songs": {"row_count": True},
+    "songplays": {
+        "row_count": True,
+        "not_null": ["start_time", "user_id", "song_id", "artist_id", "session_id"],
+        "unique": "songplay_id",
+        "orphans": {"user_id": ("users", "user_id"), "song_id": ("songs", "song_id"),
+                    "artist_id": ("artists", "artist_id"), "start_time": ("time", "start_time")},
+        "time_coverage": "start_time"
+    },
+    "users": {"row_count": True, "not_null": ["user_id"], "unique": "user_id"},
+    "songs": {"row_count": True, "not_null": ["song_id", "artist_id"], "unique": "song_id"},
+    "artists": {"row_count": True, "not_null": ["artist_id"], "unique": "artist_id"},
+    "time": {"row_count": True, "not_null": ["start_time"], "unique": "start_time", "time_coverage": "start_time"}
+}
+
+# ANALYTICS QUERIES
+# The reporting queries of the Common Use Cases in README.md.  explain_plans.py checks their
+# plans, together with the inserts', for data redistribution whenever the table model changes.
+
+analytics_queries = {
+    "artists_by_songplays": ("""
+ SELECT
+  a.name AS artist_name,
+  COUNT(sp.songplay_id) AS songplay_count
+ FROM songplays sp
+ JOIN artists a
+  ON (sp.artist_id = a.artist_id)
+ GROUP BY
+  a.artist_id,
+  a.name
+ ORDER BY
+  COUNT(sp.songplay_id) DESC
+"""),
+    "songplays_by_level": ("""
+ SELECT
+  u.level,
+  COUNT(sp.songplay_id) AS songplay_count
+ FROM songplays sp
+ JOIN users u
+  ON (sp.user_id = u.user_id)
+ GROUP BY
+  u.level
+"""),
+    "songplays_on_weekday": ("""
+ SELECT
+  sp.*
+ FROM songplays sp
+ JOIN time t
+  ON (sp.start_time = t.start_time)
+ WHERE t.weekday = 6
+"""),
+    "top_songs": ("""
+ SELECT
+  s.title,
+  a.name AS artist_name,
+  COUNT(sp.songplay_id) AS songplay_count
+ FROM songplays sp
+ JOIN songs s
+  ON (sp.song_id = s.song_id)
+ JOIN artists a
+  ON (s.artist_id = a.artist_id)
+ GROUP BY
+  s.title,
+  a.name
+ ORDER BY
+  COUNT(sp.songplay_id) DESC
+ LIMIT 10
+""")
+}
 
 # QUERY LISTS
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplays_table_create, users_table_create, songs_table_create, artists_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
-copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplays_table_insert, users_table_insert, songs_table_insert, artists_table_insert, time_table_insert]
-count_table_queries = [get_count_songplay, get_count_users_table, get_count_artists_table, get_count_songs_table, get_count_time_table]
\ No newline at end of file
+create_table_queries = [staging_events_table_create, staging_songs_table_create, staging_events_landing_table_create, staging_songs_landing_table_create, songplays_table_create, users_table_create, songs_table_create, artists_table_create, time_table_create, calendar_table_create, load_watermark_table_create]
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, staging_events_landing_table_drop, staging_songs_landing_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, calendar_table_drop, load_watermark_table_drop]
+create_view_queries = [view.create_sql() for view in rollup_views]
+drop_view_queries = [view.drop_sql() for view in rollup_views]
+refresh_view_queries = [view.refresh_sql() for view in rollup_views]
+landing_tables = {"staging_events_landing": "staging_events", "staging_songs_landing": "staging_songs"}
+landing_insert_queries = {
+    "staging_events": [staging_events_insert, clear_table_queries["staging_events_landing"]],
+    "staging_songs": [staging_songs_insert, clear_table_queries["staging_songs_landing"]]
+}
+insert_table_queries = [songplays_table_insert, users_table_insert, songs_table_insert, artists_table_insert, calendar_fill, time_table_insert]
+merge_events_queries = [songplays_table_merge, users_table_merge, calendar_merge, time_table_merge]
+merge_songs_queries = [songs_table_merge, artists_table_merge]
+dimension_upserts = {
+    "users": [users_stage_create, users_upsert_delete, users_upsert_insert, users_stage_drop],
+    "songs": [songs_stage_create, songs_upsert_delete, songs_upsert_insert, songs_stage_drop],
+    "artists": [artists_stage_create, artists_upsert_delete, artists_upsert_insert, artists_stage_drop]
+}
+upsert_table_queries = [songplays_table_insert] + dimension_upserts["users"] + dimension_upserts["songs"] + dimension_upserts["artists"] + [calendar_merge, time_table_merge]
+upsert_events_queries = [songplays_table_merge] + dimension_upserts["users"] + [calendar_merge, time_table_merge]
+upsert_songs_queries = dimension_upserts["songs"] + dimension_upserts["artists"]
+
+# LAZY QUERIES
+# Statements bound with the [S3] locations and the IAM role, rendered on first access through
+# the module __getattr__ (PEP 562) and cached as module attributes, so DDL-only and DQ-only
+# imports never read them.
+
+def credentials():
+    return "aws_iam_role=" + config_value(aws_config_path, "profile Redshift", "role_arn", fallback="")
+
+
+# ETL DEPENDENCY GRAPH
+# Each node runs its queries as one transaction once every node in depends_on has finished,
+# clearing its table first so a node can be re-run on resume.
+# Staging loads are independent, the fact and user/song/artist inserts only read staging
+# tables, time (and the calendar) reads the play times of songplays, and the dq_checks run
+# through dq_engine.py once all target tables are loaded.
+
+def render_etl_graph():
+    return {
+        "staging_events": {"queries": [clear_table_queries["staging_events"], lazy_query("staging_events_copy")] + landing_insert_queries["staging_events"], "depends_on": []},
+        "staging_songs": {"queries": [clear_table_queries["staging_songs"], lazy_query("staging_songs_copy")] + landing_insert_queries["staging_songs"], "depends_on": []},
+        "songplays": {"queries": [clear_table_queries["songplays"], songplays_table_insert], "depends_on": ["staging_events", "staging_songs"]},
+        "users": {"queries": [clear_table_queries["users"], users_table_insert], "depends_on": ["staging_events"]},
+        "songs": {"queries": [clear_table_queries["songs"], songs_table_insert], "depends_on": ["staging_songs"]},
+        "artists": {"queries": [clear_table_queries["artists"], artists_table_insert], "depends_on": ["staging_songs"]},
+        "time": {"queries": [calendar_fill, clear_table_queries["time"], time_table_insert], "depends_on": ["songplays"]},
+        "dq": {"queries": [], "checks": dq_checks, "depends_on": ["songplays", "users", "songs", "artists", "time"]}
+    }
+
+
+# With DIMENSION_LOAD = upsert the dimension nodes replace rows by key instead of appending
+def render_upsert_graph():
+    etl_graph = lazy_query("etl_graph")
+
+    return dict(
+        etl_graph,
+        users=dict(etl_graph["users"], queries=dimension_upserts["users"]),
+        songs=dict(etl_graph["songs"], queries=dimension_upserts["songs"]),
+        artists=dict(etl_graph["artists"], queries=dimension_upserts["artists"]),
+        time=dict(etl_graph["time"], queries=[calendar_merge, time_table_merge])
+    )
+
+
+LAZY_QUERIES = {
+    "staging_events_copy": lambda: bind(staging_events_copy_template,
+                                        source=config_value(main_config_path, "S3", "LOG_DATA"),
+                                        credentials=credentials(),
+                                        jsonpath=config_value(main_config_path, "S3", "LOG_JSONPATH")),
+    "staging_songs_copy": lambda: bind(staging_songs_copy_template,
+                                       source=config_value(main_config_path, "S3", "SONG_DATA"),
+                                       credentials=credentials()),
+    "staging_events_partition_copy": lambda: bind(staging_events_copy_template,
+                                                  credentials=credentials(),
+                                                  jsonpath=config_value(main_config_path, "S3", "LOG_JSONPATH")),
+    "copy_table_queries": lambda: [lazy_query("staging_events_copy"), lazy_query("staging_songs_copy")],
+    "etl_graph": render_etl_graph,
+    "upsert_graph": render_upsert_graph
+}
+
+
+def lazy_query(name):
+    """
+    Renders one of the LAZY_QUERIES on first use and caches it as a module attribute.
+    """
+
+    if name not in globals():
+        globals()[name] = LAZY_QUERIES[name]()
+
+    return globals()[name]
+
+
+def __getattr__(name):
+    if name not in LAZY_QUERIES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    return lazy_query(name)
@@ -0,0 +1,124 @@
+import os
+import re
+from concurrent.futures import FIRST_COMPLETED, wait
+from datetime import date
+
+LOG_PARTITION_PATTERN = re.compile(r"(\d{4})-(\d{2})-(\d{2})-events\.json$")
+
+
+def split_s3_uri(uri):
+    """
+    Splits an s3://bucket/key URI into its bucket and key.
+
+    Returns:
+        tuple: (bucket, key), the key empty for a bare bucket
+    """
+
+    bucket, _, key = uri[len("s3://"):].partition("/")
+
+    return bucket, key
+
+
+def submit_bounded(executor, fn, tasks, limit, collect):
+    """
+    Submits fn(*args) to an executor for every args tuple of tasks, with at most limit
+    tasks in flight, so tasks are only planned as fast as the workers finish them and
+    memory stays bounded however many there are.  Finished futures are handed to collect
+    as they complete.
+
+    Args:
+        executor (class): concurrent.futures executor
+        fn (function): module-level function, picklable for a process pool
+        tasks (iterable): argument tuples, one per call
+        limit (int): maximum number of tasks in flight, normally twice the pool size
+        collect (function): called with each set of finished futures
+    """
+
+    in_flight = set()
+
+    for args in tasks:
+        if len(in_flight) >= limit:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(done)
+
+        in_flight.add(executor.submit(fn, *args))
+
+    collect(wait(in_flight).done)
+
+
+def list_objects(prefix, region="us-west-2"):
+    """
+    Lists every object under an S3 prefix, or every file under a local directory that
+    stands in for one, so the same code can plan loads against either.
+
+    Args:
+        prefix (string): s3://bucket/key prefix or local directory (surrounding quotes
+                         as written in dwh.cfg are ignored)
+        region (string): region of the S3 bucket
+
+    Returns:
+        list: (path, size in bytes) tuples sorted by path, where path is an s3:// URI
+              or a local file path
+    """
+
+    prefix = prefix.strip("'\"")
+
+    if prefix.startswith("s3://"):
+        import boto3
+
+        bucket, key_prefix = split_s3_uri(prefix)
+        s3 = boto3.client("s3", region_name=region)
+        objects = []
+
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=key_prefix):
+            for obj in page.get("Contents", []):
+                if not obj["Key"].endswith("/"):
+                    objects.append((f"s3://{bucket}/{obj['Key']}", obj["Size"]))
+
+        return sorted(objects)
+
+    objects = []
+    for root, _, files in os.walk(prefix):
+        for name in files:
+            path = os.path.join(root, name)
+            objects.append((path, os.path.getsize(path)))
+
+    return sorted(objects)
+
+
+def log_partitions(prefix, region="us-west-2"):
+    """
+    Lists the daily log_data partitions (log_data/YYYY/MM/YYYY-MM-DD-events.json) under
+    a prefix, ignoring any object that doesn't follow the naming scheme.
+
+    Args:
+        prefix (string): s3:// prefix or local directory of the log data
+        region (string): region of the S3 bucket
+
+    Returns:
+        list: (partition date, path) tuples sorted by date
+    """
+
+    partitions = []
+
+    for path, _ in list_objects(prefix, region):
+        match = LOG_PARTITION_PATTERN.search(path)
+        if match:
+            partitions.append((date(*map(int, match.groups())), path))
+
+    return sorted(partitions)
+
+
+def partitions_after(partitions, watermark):
+    """
+    The log_data partitions dated after a watermark, or all of them when there is none.
+
+    Args:
+        partitions (list): (partition date, path) tuples from log_partitions
+        watermark (date): date of the newest partition already loaded, or None
+
+    Returns:
+        list: (partition date, path) tuples newer than the watermark
+    """
+
+    return [(day, path) for day, path in partitions if watermark is None or day > watermark]
@@ -0,0 +1,212 @@
+import configparser
+import json
+from dataclasses import dataclass, field, replace
+
+
+@dataclass(frozen=True)
+class Column:
+    """
+    A column of a Redshift table.
+
+    Attributes:
+        name (string): column name
+        type (string): Redshift type without length, e.g. VARCHAR, BIGINT, TIMESTAMP
+        length (int|string): VARCHAR/CHAR length or NUMERIC precision, e.g. 256 or "18,0"
+        encoding (string): compression encoding, e.g. ZSTD, AZ64, RAW (None lets Redshift choose)
+        not_null (bool): NOT NULL constraint
+        primary_key (bool): informational PRIMARY KEY constraint (not enforced by Redshift)
+        identity (tuple): (seed, step) for an IDENTITY column
+    """
+
+    name: str
+    type: str
+    length: object = None
+    encoding: str = None
+    not_null: bool = False
+    primary_key: bool = False
+    identity: tuple = None
+
+    def render(self):
+        parts = [f"{self.name:<20}", f"{self.type}({self.length})" if self.length else self.type]
+
+        if self.identity:
+            parts.append("IDENTITY({},{})".format(*self.identity))
+        if self.encoding:
+            parts.append(f"ENCODE {self.encoding}")
+        if self.not_null:
+            parts.append("NOT NULL")
+        if self.primary_key:
+            parts.append("PRIMARY KEY")
+
+        return " ".join(parts)
+
+
+@dataclass(frozen=True)
+class Table:
+    """
+    A Redshift table: its columns plus distribution and sort keys, rendered as DDL.
+
+    Attributes:
+        name (string): table name
+        columns (tuple): Column definitions in order
+        diststyle (string): AUTO, EVEN, KEY or ALL (None leaves the Redshift default)
+        distkey (string): distribution key column, implies DISTSTYLE KEY
+        sortkey (tuple): sort key columns
+        sortkey_style (string): COMPOUND or INTERLEAVED
+    """
+
+    name: str
+    columns: tuple
+    diststyle: str = None
+    distkey: str = None
+    sortkey: tuple = field(default=())
+    sortkey_style: str = "COMPOUND"
+
+    def column(self, name):
+        return next(column for column in self.columns if column.name == name)
+
+    def create_sql(self):
+        attributes = []
+
+        if self.distkey:
+            attributes.append(f"DISTSTYLE KEY DISTKEY ({self.distkey})")
+        elif self.diststyle:
+            attributes.append(f"DISTSTYLE {self.diststyle}")
+        if self.sortkey:
+            attributes.append(f"{self.sortkey_style} SORTKEY ({', '.join(self.sortkey)})")
+
+        lines = [f"CREATE TABLE IF NOT EXISTS {self.name} (",
+                 ",\n".join(" " + column.render() for column in self.columns),
+                 ")"] + attributes
+
+        return "\n" + "\n".join(lines) + "\n"
+
+    def drop_sql(self):
+        return f"DROP TABLE IF EXISTS {self.name}"
+
+    def delete_sql(self):
+        return f"DELETE FROM {self.name}"
+
+
+@dataclass(frozen=True)
+class MaterializedView:
+    """
+    A Redshift materialized view over the star schema, refreshed by etl.py after each load.
+    Redshift refreshes it incrementally when the query allows (inner joins, COUNT/SUM/MIN/
+    MAX aggregates), applying only the rows changed since the last refresh, and recomputes
+    it from scratch otherwise.
+
+    Attributes:
+        name (string): view name
+        query (string): SELECT defining the view
+        sortkey (tuple): sort key columns
+    """
+
+    name: str
+    query: str
+    sortkey: tuple = field(default=())
+
+    def create_sql(self):
+        lines = [f"CREATE MATERIALIZED VIEW {self.name}"]
+
+        if self.sortkey:
+            lines.append(f"SORTKEY ({', '.join(self.sortkey)})")
+
+        return "\n" + "\n".join(lines + ["AUTO REFRESH NO", "AS"]) + self.query
+
+    def drop_sql(self):
+        return f"DROP MATERIALIZED VIEW IF EXISTS {self.name}"
+
+    def refresh_sql(self):
+        return f"REFRESH MATERIALIZED VIEW {self.name}"
+
+
+def apply_encodings(table, encodings):
+    """
+    Returns a copy of a table with the column encodings replaced, e.g. by the output of
+    ANALYZE COMPRESSION.  The leading sort key column is always kept RAW, since compressing
+    it makes range-restricted scans read more blocks than they save.
+
+    Args:
+        table (class): Table to re-encode
+        encodings (dict): column name -> encoding, columns not listed are left unchanged
+
+    Returns:
+        class: re-encoded Table
+    """
+
+    leading_sortkey = table.sortkey[0] if table.sortkey else None
+    columns = tuple(
+        replace(column, encoding="RAW" if column.name == leading_sortkey else encodings.get(column.name, column.encoding))
+        for column in table.columns
+    )
+
+    return replace(table, columns=columns)
+
+
+def analyze_compression(cur, table_names):
+    """
+    Runs ANALYZE COMPRESSION on loaded tables and collects the suggested encodings.
+
+    Args:
+        cur (class): psycopg2 cursor for db interaction
+        table_names (list): tables to analyze
+
+    Returns:
+        dict: table -> {column -> {"encoding": ..., "est_reduction_pct": ...}}
+    """
+
+    suggestions = {}
+
+    for table_name in table_names:
+        cur.execute(f"ANALYZE COMPRESSION {table_name}")
+        for table, column, encoding, reduction in cur.fetchall():
+            suggestions.setdefault(table, {})[column] = {"encoding": encoding, "est_reduction_pct": float(reduction)}
+
+    return suggestions
+
+
+def load_encodings(path):
+    """
+    Reads a compression file written by this module's main() into
+    table -> {column -> encoding}.  A missing or empty path returns no encodings.
+    """
+
+    try:
+        with open(path) as f:
+            suggestions = json.load(f)
+    except (FileNotFoundError, IsADirectoryError):
+        return {}
+
+    return {table: {column: value["encoding"] for column, value in columns.items()}
+            for table, columns in suggestions.items()}
+
+
+def main():
+    """
+    Runs ANALYZE COMPRESSION on every table of the model and writes the suggestions to
+    COMPRESSION_FILE, which sql_queries.py reads to pick the encodings in its DDL.
+    """
+
+    from backends import connect
+    from sql_queries import tables
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    conn = connect(config)
+    suggestions = analyze_compression(conn.cursor(), [table.name for table in tables])
+    conn.close()
+
+    path = config.get("ETL", "COMPRESSION_FILE")
+    with open(path, "w") as f:
+        json.dump(suggestions, f, indent=1)
+
+    for table, columns in suggestions.items():
+        for column, value in columns.items():
+            print(f"{table}.{column}: {value['encoding']} ({value['est_reduction_pct']}% smaller)")
+    print(f"Encodings written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+import argparse
+import configparser
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from backends import data_prefix, jsonpath_keys
+from compaction import iter_records, plan_batches, read_object
+from instrumentation import RunReport
+from sql_queries import staging_events_landing_table, staging_songs_landing_table
+from storage import list_objects, split_s3_uri, submit_bounded
+
+# Inputs checked before COPY: the landing table each prefix loads into, how its fields are
+# mapped (the jsonpaths file, or 'auto' name matching) and whether timestamps are epoch millis
+SOURCES = {
+    "LOG_DATA": {"table": staging_events_landing_table, "jsonpath": "LOG_JSONPATH", "epoch_millis": True},
+    "SONG_DATA": {"table": staging_songs_landing_table, "jsonpath": None, "epoch_millis": False}
+}
+
+INTEGER_TYPES = ("INT", "INTEGER", "BIGINT", "SMALLINT", "NUMERIC")
+
+# Epoch milliseconds from 2000 to 2100; an epoch in seconds or microseconds falls outside
+EPOCH_MILLIS_RANGE = (946684800000, 4102444800000)
+
+
+def jsonpaths(table):
+    """
+    Generates a Redshift jsonpaths document mapping each copied column to the JSON field of
+    the same name, in COPY column list order.
+    """
+
+    return {"jsonpaths": [f"$['{column.name}']" for column in table.columns]}
+
+
+def check_value(column, value, epoch_millis=False):
+    """
+    Checks a JSON value against the column COPY loads it into.
+
+    Args:
+        column (class): table_model.Column
+        value (object): parsed JSON value, None for null
+        epoch_millis (bool): whether COPY reads timestamps with timeformat 'epochmillisecs'
+
+    Returns:
+        string: the problem, e.g. "string instead of number", or None when the value loads as is
+    """
+
+    if value is None:
+        return None
+
+    column_type = column.type.upper()
+
+    if isinstance(value, (dict, list)):
+        return "nested value"
+
+    if column_type in ("VARCHAR", "CHAR"):
+        text = value if isinstance(value, str) else json.dumps(value)
+        if column.length and len(text.encode("utf-8")) > int(column.length):
+            return f"longer than {column_type}({column.length})"
+        return None
+
+    if column_type in INTEGER_TYPES + ("DOUBLE PRECISION", "REAL", "FLOAT"):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return "string instead of number" if isinstance(value, str) else f"{type(value).__name__} instead of number"
+        if column_type in INTEGER_TYPES and str(column.length or "18,0").endswith(",0") and value != int(value):
+            return "fraction in integer column"
+        return None
+
+    if column_type == "TIMESTAMP" and epoch_millis:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return "not epoch milliseconds"
+        if not EPOCH_MILLIS_RANGE[0] <= value < EPOCH_MILLIS_RANGE[1]:
+            return "not epoch milliseconds"
+
+    return None
+
+
+def validate_batch(paths, columns, keys, epoch_millis):
+    """
+    Process pool worker: checks every record of a batch of files against the staging
+    columns and collects per-field statistics.
+
+    Args:
+        paths (list): input files of the batch
+        columns (list): table_model.Column loaded by COPY, in COPY column list order
+        keys (list): JSON field of each column (from the jsonpaths file), None for 'auto'
+        epoch_millis (bool): whether timestamps are read as epoch milliseconds
+
+    Returns:
+        dict: {"files": {path: [issues]}, "records": count, "fields": {column: stats}}
+    """
+
+    fields = {column.name: {"values": 0, "nulls": 0, "max_length": 0, "issues": {}} for column in columns}
+    files, records = {}, 0
+
+    for path in paths:
+        issues, seen, counts = [], {column.name: 0 for column in columns}, {}
+
+        try:
+            file_records = list(iter_records(read_object(path)))
+        except (ValueError, UnicodeDecodeError) as e:
+            files[path] = [f"invalid JSON: {e}"]
+            continue
+
+        for record in file_records:
+            records += 1
+            if keys is None:
+                record = {key.lower(): value for key, value in record.items()}
+
+            for column, key in zip(columns, keys or [column.name.lower() for column in columns]):
+                stats = fields[column.name]
+                stats["values"] += 1
+
+                if key in record:
+                    seen[column.name] += 1
+                value = record.get(key)
+
+                if value is None or value == "":
+                    stats["nulls"] += 1
+                if isinstance(value, str):
+                    stats["max_length"] = max(stats["max_length"], len(value.encode("utf-8")))
+
+                problem = check_value(column, value, epoch_millis)
+                if problem:
+                    stats["issues"][problem] = stats["issues"].get(problem, 0) + 1
+                    counts[(column.name, problem)] = counts.get((column.name, problem), 0) + 1
+
+        issues += [f"{name}: {problem} ({count} records)" for (name, problem), count in counts.items()]
+        issues += [f"{name}: missing from every record" for name, count in seen.items() if file_records and not count]
+
+        if issues:
+            files[path] = issues
+
+    return {"files": files, "records": records, "fields": fields}
+
+
+def merge_fields(totals, fields):
+    """
+    Adds the field statistics of a finished batch to the running totals.
+    """
+
+    for name, stats in fields.items():
+        total = totals.setdefault(name, {"values": 0, "nulls": 0, "max_length": 0, "issues": {}})
+        total["values"] += stats["values"]
+        total["nulls"] += stats["nulls"]
+        total["max_length"] = max(total["max_length"], stats["max_length"])
+        for problem, count in stats["issues"].items():
+            total["issues"][problem] = total["issues"].get(problem, 0) + count
+
+
+def validate(prefix, table, keys, epoch_millis, workers, target_bytes=8 * 1024 * 1024):
+    """
+    Streams every file under a prefix through validate_batch on a process pool.  Files are
+    grouped into batches of about target_bytes, so the one-record song_data files don't
+    cost a task each, and at most two batches per worker are in flight.
+
+    Args:
+        prefix (string): S3 prefix or local directory of the input JSON files
+        table (class): table_model.Table the files are copied into
+        keys (list): JSON field of each copied column, None for 'auto' name matching
+        epoch_millis (bool): whether timestamps are read as epoch milliseconds
+        workers (int): process pool size
+        target_bytes (int): bytes per batch
+
+    Returns:
+        dict: {"files", "records", "bad_files": {path: [issues]}, "fields": {column: stats}}
+    """
+
+    columns = table.columns
+    objects = list_objects(prefix)
+    result = {"files": len(objects), "records": 0, "bad_files": {}, "fields": {}}
+
+    def collect(futures):
+        for future in futures:
+            batch = future.result()
+            result["records"] += batch["records"]
+            result["bad_files"].update(batch["files"])
+            merge_fields(result["fields"], batch["fields"])
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        submit_bounded(executor, validate_batch,
+                       ((paths, columns, keys, epoch_millis) for paths in plan_batches(objects, target_bytes)),
+                       workers * 2, collect)
+
+    for stats in result["fields"].values():
+        stats["null_rate"] = round(stats["nulls"] / stats["values"], 4) if stats["values"] else 0.0
+
+    return result
+
+
+def quarantine(path, prefix, quarantine_prefix):
+    """
+    Moves a bad input file from under prefix to the same relative path under
+    quarantine_prefix, on S3 or locally, so the next COPY doesn't load it.  The source
+    bucket may be read-only, so this only runs when asked for with --quarantine.
+
+    Returns:
+        string: new location of the file
+    """
+
+    prefix = prefix.strip("'\"").rstrip("/")
+    location = quarantine_prefix.strip("'\"").rstrip("/") + "/" + path[len(prefix):].lstrip("/\\")
+
+    if path.startswith("s3://"):
+        import boto3
+
+        s3 = boto3.client("s3")
+        bucket, key = split_s3_uri(path)
+        target_bucket, target_key = split_s3_uri(location)
+        s3.copy_object(Bucket=target_bucket, Key=target_key, CopySource={"Bucket": bucket, "Key": key})
+        s3.delete_object(Bucket=bucket, Key=key)
+
+    else:
+        os.makedirs(os.path.dirname(location) or ".", exist_ok=True)
+        os.replace(path, location)
+
+    return location
+
+
+def print_fields(table, fields):
+    """
+    Prints the statistics of every copied column next to its declared type, so VARCHAR
+    widths can be compared with the longest value actually seen.
+    """
+
+    print(f" {'column':<16} {'type':<20} {'null rate':>9} {'max length':>10}  issues")
+    for column in table.columns:
+        stats = fields.get(column.name)
+        if not stats:
+            continue
+        declared = f"{column.type}({column.length})" if column.length else column.type
+        issues = ", ".join(f"{problem} x{count}" for problem, count in stats["issues"].items())
+        print(f" {column.name:<16} {declared:<20} {stats['null_rate']:>9.1%} {stats['max_length']:>10}  {issues}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the input JSON files against the staging tables before COPY")
+    parser.add_argument("--quarantine", action="store_true", help="move bad files to QUARANTINE_PREFIX")
+    parser.add_argument("--write-jsonpaths", metavar="PATH",
+                        help="write a jsonpaths file for staging_events generated from the table model and exit")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    if args.write_jsonpaths:
+        with open(args.write_jsonpaths, "w") as f:
+            json.dump(jsonpaths(staging_events_landing_table), f, indent=1)
+        print(f"jsonpaths for {staging_events_landing_table.name} written to {args.write_jsonpaths}")
+        return
+
+    workers = config.getint("VALIDATION", "WORKERS", fallback=4)
+    target_bytes = int(config.getfloat("VALIDATION", "TARGET_BATCH_MB", fallback=8) * 1024 * 1024)
+    quarantine_prefix = config.get("VALIDATION", "QUARANTINE_PREFIX", fallback="")
+    report = RunReport("validation", redshift=False)
+    bad_files = 0
+
+    for source, spec in SOURCES.items():
+        prefix = data_prefix(config, source)
+        table = spec["table"]
+        keys = None
+
+        if spec["jsonpath"]:
+            jsonpath = data_prefix(config, spec["jsonpath"]).strip("'\"")
+            keys = jsonpath_keys(jsonpath)
+            if len(keys) != len(table.columns):
+                raise ValueError(f"{jsonpath} maps {len(keys)} fields but COPY loads {len(table.columns)} "
+                                 f"columns into {table.name}")
+
+        print("**********************************************")
+        print(f"Validating {prefix} against {table.name}...")
+        with report.step(source.lower()):
+            result = validate(prefix, table, keys, spec["epoch_millis"], workers, target_bytes)
+
+        print(f"{result['files']} files, {result['records']} records, {len(result['bad_files'])} bad files")
+        print_fields(table, result["fields"])
+
+        for path, issues in result["bad_files"].items():
+            print(f" BAD: {path}")
+            for issue in issues:
+                print(f"  {issue}")
+            if args.quarantine and quarantine_prefix:
+                location = quarantine(path, prefix, quarantine_prefix.strip("'\"").rstrip("/") + "/" + source.lower())
+                print(f"  quarantined to {location}")
+
+        bad_files += len(result["bad_files"])
+        report.extras[source.lower()] = result
+
+    report.write(config.get("ETL", "RUN_LOG_DIR", fallback="logs"))
+
+    if args.quarantine and not quarantine_prefix:
+        print("QUARANTINE_PREFIX is not set in the [VALIDATION] section of dwh.cfg, no files were moved")
+
+    if bad_files and not (args.quarantine and quarantine_prefix):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The scripts under src/ and bench/ import their siblings by module name, as when run from there
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "src"), os.path.join(ROOT, "bench"), ROOT]
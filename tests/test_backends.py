@@ -0,0 +1,16 @@
+from backends import local_parameters
+
+
+def test_local_parameters_named():
+    statement, params = local_parameters("SELECT * FROM t WHERE a = %(a)s AND b LIKE 'x%%'", {"a": 1, "unused": 2})
+
+    assert statement == "SELECT * FROM t WHERE a = $a AND b LIKE 'x%'"
+    assert params == {"a": 1}
+
+
+def test_local_parameters_positional():
+    assert local_parameters("SELECT %s, %s", (1, 2)) == ("SELECT ?, ?", [1, 2])
+
+
+def test_local_parameters_without_params_leaves_statement():
+    assert local_parameters("SELECT '%%'", None) == ("SELECT '%%'", None)
@@ -0,0 +1,24 @@
+import pytest
+
+from compaction import iter_records, plan_batches
+
+
+def test_plan_batches_by_size():
+    objects = [("a", 40), ("b", 70), ("c", 10), ("d", 100), ("e", 5)]
+
+    assert list(plan_batches(objects, 100)) == [["a", "b"], ["c", "d"], ["e"]]
+
+
+def test_plan_batches_empty():
+    assert list(plan_batches([], 100)) == []
+
+
+def test_iter_records_single_object_and_lines():
+    assert list(iter_records('{"a": 1}')) == [{"a": 1}]
+    assert list(iter_records('{"a": 1}\n{"a": 2}\n\n')) == [{"a": 1}, {"a": 2}]
+    assert list(iter_records("  ")) == []
+
+
+def test_iter_records_invalid_json():
+    with pytest.raises(ValueError):
+        list(iter_records('{"a": 1}\n{"a": '))
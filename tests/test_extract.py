@@ -0,0 +1,35 @@
+from datetime import datetime
+
+from extract import partition_ranges
+
+
+class RangeCursor:
+    def __init__(self, low, high):
+        self.row = (low, high)
+
+    def execute(self, query, params=None):
+        self.query = query
+
+    def fetchone(self):
+        return self.row
+
+
+def test_partition_ranges_cover_the_range_without_overlap():
+    ranges = partition_ranges(RangeCursor(0, 100), "songplays", "songplay_id", 4)
+
+    assert [params for _, params in ranges] == [{"start": 0, "end": 25}, {"start": 25, "end": 50},
+                                                {"start": 50, "end": 75}, {"start": 75, "end": 100}]
+    assert all(predicate.endswith("< %(end)s") for predicate, _ in ranges[:-1])
+    assert ranges[-1][0] == "songplay_id >= %(start)s AND songplay_id <= %(end)s"
+
+
+def test_partition_ranges_on_timestamps():
+    ranges = partition_ranges(RangeCursor(datetime(2018, 11, 1), datetime(2018, 11, 3)), "songplays", "start_time", 2)
+
+    assert ranges[0][1] == {"start": datetime(2018, 11, 1), "end": datetime(2018, 11, 2)}
+
+
+def test_partition_ranges_single_range():
+    assert partition_ranges(RangeCursor(None, None), "songplays", "start_time", 4) == [(None, None)]
+    assert partition_ranges(RangeCursor(5, 5), "songplays", "start_time", 4) == [(None, None)]
+    assert partition_ranges(RangeCursor(0, 10), "songplays", "start_time", 1) == [(None, None)]
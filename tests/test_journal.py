@@ -0,0 +1,46 @@
+import pytest
+
+from instrumentation import RunReport
+from journal import RunJournal, copy_sources
+
+
+def test_copy_sources():
+    queries = ["DELETE FROM staging_events", "COPY staging_events_landing FROM 's3://bucket/log_data' JSON 'auto'"]
+
+    assert copy_sources(queries) == ["s3://bucket/log_data"]
+    assert copy_sources(queries, lambda path: path.replace("s3://bucket", "data")) == ["data/log_data"]
+
+
+def test_resume_skips_completed_steps(tmp_path):
+    path = str(tmp_path / "journal.json")
+    calls = []
+
+    journal = RunJournal(path, RunReport("etl", redshift=False))
+    assert journal.run("load", lambda: calls.append("load") or ["out"]) == ["out"]
+    with pytest.raises(RuntimeError):
+        journal.run("insert", lambda: (_ for _ in ()).throw(RuntimeError("boom")))
+
+    resumed = RunJournal(path, RunReport("etl", redshift=False), resume=True)
+    assert resumed.run("load", lambda: calls.append("load again")) == ["out"]
+    resumed.run("insert", lambda: calls.append("insert"))
+
+    assert calls == ["load", "insert"]
+    assert resumed.state["steps"]["insert"]["status"] == "done"
+    assert resumed.state["steps"]["insert"]["attempts"] == 2
+
+
+def test_new_journal_reruns_everything(tmp_path):
+    path = str(tmp_path / "journal.json")
+    RunJournal(path, RunReport("etl", redshift=False)).run("load", lambda: None)
+
+    assert not RunJournal(path, RunReport("etl", redshift=False)).completed("load")
+
+
+def test_loaded_rows_counts_inserts_only():
+    report = RunReport("etl", redshift=False)
+    for statement, rows in (("COPY staging_events_landing", 900), ("INSERT INTO staging_events", 900),
+                            ("DELETE FROM staging_events_landing", 900), ("INSERT INTO calendar", 24),
+                            ("INSERT INTO songplays", -1)):
+        report.record({"step": "load", "statement": statement, "rows": rows})
+
+    assert report.loaded_rows("load") == 900
@@ -0,0 +1,107 @@
+import configparser
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip("duckdb")
+
+from backends import connect
+from create_tables import reset_schema
+from etl import run_etl
+from generate_data import generate
+from instrumentation import RunReport
+from journal import RunJournal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def local_config(tmp_path, data_dir, database, **etl):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, "dwh.cfg"))
+
+    config["BACKEND"] = {"engine": "local"}
+    config["LOCAL"] = {
+        "database": str(tmp_path / database),
+        "log_data": str(data_dir / "log_data"),
+        "log_jsonpath": str(data_dir / "log_json_path.json"),
+        "song_data": str(data_dir / "song_data")
+    }
+    config["ETL"].update(run_log_dir=str(tmp_path / "logs"), journal_path=str(tmp_path / "logs" / "journal.json"), **etl)
+
+    # The COPY statements are rendered from the dwh.cfg in the working directory
+    with open(tmp_path / "dwh.cfg", "w") as f:
+        config.write(f)
+
+    return config
+
+
+def load(config, load_mode, reset=False):
+    config["ETL"]["load_mode"] = load_mode
+
+    if reset:
+        conn = connect(config)
+        reset_schema(conn.cursor(), conn)
+        conn.close()
+
+    report = RunReport("etl", redshift=False)
+    run_etl(config, report, RunJournal(config.get("ETL", "JOURNAL_PATH"), report))
+
+
+def query(config, sql):
+    conn = connect(config)
+    try:
+        cur = conn.cursor()
+        cur.execute(sql)
+        return cur.fetchone()
+    finally:
+        conn.close()
+
+
+def songplays(config):
+    return query(config, "SELECT COUNT(*), COUNT(DISTINCT CAST(session_id AS VARCHAR) || '|' || CAST(start_time AS VARCHAR) "
+                         "|| '|' || CAST(user_id AS VARCHAR)) FROM songplays")
+
+
+@pytest.mark.parametrize("etl", [
+    {"use_dag": "false", "dimension_load": "append", "parallel_load": "false"},
+    {"use_dag": "false", "dimension_load": "upsert", "parallel_load": "true"},
+    {"use_dag": "true", "dimension_load": "upsert"}
+])
+def test_incremental_after_full_load(tmp_path, monkeypatch, etl):
+    monkeypatch.chdir(tmp_path)
+    data_dir = tmp_path / "data"
+    generate(str(data_dir), scale=1, days=3)
+
+    # Hold the last partition back, it arrives after the full load
+    last = data_dir / "log_data" / "2018" / "11" / "2018-11-03-events.json"
+    held = tmp_path / last.name
+    shutil.move(last, held)
+
+    config = local_config(tmp_path, data_dir, "dwh.duckdb", **etl)
+    load(config, "full", reset=True)
+    full = songplays(config)
+
+    assert full[0] > 0
+    assert query(config, "SELECT CAST(watermark AS VARCHAR) FROM load_watermark WHERE source = 'log_data'") == ("2018-11-02",)
+
+    load(config, "incremental")
+    assert songplays(config) == full
+
+    shutil.move(held, last)
+    load(config, "incremental")
+    incremental = songplays(config)
+
+    # A replay without a watermark must not add the plays again
+    conn = connect(config)
+    conn.cursor().execute("DELETE FROM load_watermark")
+    conn.commit()
+    conn.close()
+    load(config, "incremental")
+    assert songplays(config) == incremental
+
+    reference = local_config(tmp_path, data_dir, "reference.duckdb", **etl)
+    load(reference, "full", reset=True)
+
+    assert incremental == songplays(reference)
+    assert incremental[0] == incremental[1]
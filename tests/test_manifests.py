@@ -0,0 +1,42 @@
+import json
+
+import pytest
+
+from manifests import build_manifest_copy, manifest_copy, size_summary, write_manifest
+
+COPY = "COPY staging_songs_landing (title) FROM 's3://bucket/song_data' CREDENTIALS 'x' JSON 'auto'"
+
+
+def test_size_summary():
+    summary = size_summary([("a", 10), ("b", 30), ("c", 20)], slices=2)
+
+    assert summary["total_files"] == 3
+    assert summary["total_bytes"] == 60
+    assert (summary["min_bytes"], summary["max_bytes"], summary["mean_bytes"]) == (10, 30, 20)
+    assert summary["skew"] == 1.5
+    assert summary["short_slices"] == 1
+
+
+def test_size_summary_empty():
+    assert size_summary([], slices=4)["skew"] == 1.0
+
+
+def test_manifest_copy_reads_the_manifest():
+    query = manifest_copy(COPY, "s3://bucket/manifests/songs.manifest")
+
+    assert "FROM 's3://bucket/manifests/songs.manifest'" in query
+    assert query.rstrip().endswith("MANIFEST")
+
+
+def test_write_manifest_local(tmp_path):
+    location = tmp_path / "m" / "songs.manifest"
+    write_manifest(str(location), [("s3://bucket/a.json", 12)])
+
+    assert json.loads(location.read_text()) == {
+        "entries": [{"url": "s3://bucket/a.json", "mandatory": True, "meta": {"content_length": 12}}]
+    }
+
+
+def test_build_manifest_copy_requires_a_prefix(tmp_path):
+    with pytest.raises(ValueError):
+        build_manifest_copy(COPY, str(tmp_path), "''", 4, str(tmp_path / "logs"))
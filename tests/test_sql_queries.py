@@ -0,0 +1,15 @@
+from sql_queries import bind, quote_literal
+
+
+def test_quote_literal_doubles_quotes():
+    assert quote_literal("it's") == "'it''s'"
+
+
+def test_quote_literal_escapes_backslashes():
+    assert quote_literal("s3://bucket/a\\b") == "'s3://bucket/a\\\\b'"
+
+
+def test_bind_renders_values_and_keeps_unbound_placeholders():
+    statement = bind("COPY t FROM %(source)s CREDENTIALS %(credentials)s", credentials="aws_iam_role=arn:x")
+
+    assert statement == "COPY t FROM %(source)s CREDENTIALS 'aws_iam_role=arn:x'"
@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from storage import list_objects, log_partitions, partitions_after, split_s3_uri, submit_bounded
+
+
+def write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def test_split_s3_uri():
+    assert split_s3_uri("s3://bucket/log_data/2018/11/a.json") == ("bucket", "log_data/2018/11/a.json")
+    assert split_s3_uri("s3://bucket") == ("bucket", "")
+
+
+def test_list_objects_local(tmp_path):
+    write(tmp_path / "b.json", "{}")
+    write(tmp_path / "a" / "c.json", "{ }")
+
+    assert list_objects(str(tmp_path)) == [(str(tmp_path / "a" / "c.json"), 3), (str(tmp_path / "b.json"), 2)]
+
+
+def test_log_partitions_ignores_other_files(tmp_path):
+    write(tmp_path / "2018" / "11" / "2018-11-02-events.json", "")
+    write(tmp_path / "2018" / "11" / "2018-11-01-events.json", "")
+    write(tmp_path / "2018" / "11" / "notes.txt", "")
+
+    assert [day for day, _ in log_partitions(str(tmp_path))] == [date(2018, 11, 1), date(2018, 11, 2)]
+
+
+def test_partitions_after_watermark():
+    partitions = [(date(2018, 11, day), f"p{day}") for day in (1, 2, 3)]
+
+    assert partitions_after(partitions, None) == partitions
+    assert partitions_after(partitions, date(2018, 11, 2)) == [(date(2018, 11, 3), "p3")]
+    assert partitions_after(partitions, date(2018, 11, 3)) == []
+
+
+def test_submit_bounded_limits_in_flight():
+    results, batches = [], []
+
+    def collect(done):
+        batches.append(len(done))
+        results.extend(future.result() for future in done)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        submit_bounded(executor, pow, ((i, 2) for i in range(20)), 4, collect)
+
+    assert sorted(results) == [i * i for i in range(20)]
+    assert max(batches) <= 4
@@ -0,0 +1,27 @@
+import pytest
+
+from table_model import Column
+from validation import check_value
+
+
+@pytest.mark.parametrize("column, value, problem", [
+    (Column("song", "VARCHAR", 4), "abcd", None),
+    (Column("song", "VARCHAR", 4), "abcde", "longer than VARCHAR(4)"),
+    (Column("song", "VARCHAR", 4), "ééé", "longer than VARCHAR(4)"),
+    (Column("length", "DOUBLE PRECISION"), "1.5", "string instead of number"),
+    (Column("length", "DOUBLE PRECISION"), True, "bool instead of number"),
+    (Column("sessionId", "INTEGER"), 1.5, "fraction in integer column"),
+    (Column("sessionId", "INTEGER"), 2, None),
+    (Column("artist", "VARCHAR", 256), {"name": "x"}, "nested value"),
+    (Column("artist", "VARCHAR", 256), None, None),
+])
+def test_check_value(column, value, problem):
+    assert check_value(column, value) == problem
+
+
+def test_check_value_epoch_millis():
+    ts = Column("ts", "TIMESTAMP")
+
+    assert check_value(ts, 1541105830796, epoch_millis=True) is None
+    assert check_value(ts, 1541105830, epoch_millis=True) == "not epoch milliseconds"
+    assert check_value(ts, "2018-11-01", epoch_millis=True) == "not epoch milliseconds"
@@ -0,0 +1,149 @@
+import configparser
+import os
+import random
+import re
+import time
+
+import boto3
+
+
+def aws_clients(main_config: object, services: list = ("iam", "redshift", "ec2")):
+    """
+    Creates the boto3 clients used by the deploy scripts from the default profile in
+     the local .aws/credentials and .aws/config files.  When ENDPOINT_URL is set in the
+     [AWS] section of dwh.cfg every client is pointed at it instead of AWS, so the
+     deploy can be exercised against a local AWS API stand-in (e.g. moto_server or
+     LocalStack).
+
+    Args
+     main_config (object): configparser.ConfigParser() for dwh.cfg
+     services (list): boto3 service names
+
+    Returns
+     dict: service name -> boto3 client, plus "ec2_resource" when ec2 is requested
+    """
+
+    aws_creds = configparser.ConfigParser()
+    aws_creds.read(os.path.expanduser("~\\.aws\\credentials"))
+
+    aws_config = configparser.ConfigParser()
+    aws_config.read(os.path.expanduser("~\\.aws\\config"))
+
+    session_args = {
+        "aws_access_key_id": aws_creds.get("default", "aws_access_key_id", fallback=None),
+        "aws_secret_access_key": aws_creds.get("default", "aws_secret_access_key", fallback=None),
+        "region_name": aws_config.get("default", "region", fallback=None),
+        "endpoint_url": main_config.get("AWS", "ENDPOINT_URL", fallback="") or None
+    }
+
+    clients = {service: boto3.client(service, **session_args) for service in services}
+
+    if "ec2" in services:
+        clients["ec2_resource"] = boto3.resource("ec2", **session_args)
+
+    return clients
+
+
+def wait_until(check: object,
+               description: str,
+               timeout: float = 1800,
+               initial_delay: float = 5,
+               max_delay: float = 60,
+               factor: float = 2
+               ):
+    """
+    Polls check() with exponential backoff and jitter until it returns a truthy value,
+     instead of calling a describe_* API in a tight loop and getting throttled.  The
+     delay starts at initial_delay, grows by factor up to max_delay, and never sleeps
+     past the deadline.
+
+    Args
+     check (function): callable returning a truthy value once the wait is over
+     description (string): what is being waited for, used in output and errors
+     timeout (float): deadline in seconds
+     initial_delay (float): first delay in seconds
+     max_delay (float): longest delay in seconds
+     factor (float): delay multiplier between attempts
+
+    Returns
+     object: the truthy value returned by check()
+
+    Raises
+     TimeoutError: check() did not succeed before the deadline
+    """
+
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    attempts = 0
+
+    while True:
+        attempts += 1
+        result = check()
+
+        if result:
+            return result
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Gave up waiting for {description} after {attempts} attempts ({timeout}s)")
+
+        sleep = min(delay * random.uniform(0.5, 1.0), remaining)
+        print(f"Waiting for {description}, next check in {sleep:.0f}s")
+        time.sleep(sleep)
+        delay = min(delay * factor, max_delay)
+
+
+def cluster_status(redshift: object, cluster_identifier: str):
+    """
+    Returns the cluster's status (e.g. available, paused, deleting), or None when there
+     is no such cluster.
+
+    Args
+     redshift (object): boto3 redshift client
+     cluster_identifier (string): cluster identifier
+    """
+
+    try:
+        return redshift.describe_clusters(ClusterIdentifier=cluster_identifier)['Clusters'][0]['ClusterStatus']
+    except redshift.exceptions.ClusterNotFoundFault:
+        return None
+
+
+def snapshot_status(redshift: object, snapshot_identifier: str):
+    """
+    Returns the snapshot's status (e.g. creating, available), or None when there is no
+     such snapshot.
+
+    Args
+     redshift (object): boto3 redshift client
+     snapshot_identifier (string): snapshot identifier
+    """
+
+    try:
+        return redshift.describe_cluster_snapshots(SnapshotIdentifier=snapshot_identifier)['Snapshots'][0]['Status']
+    except redshift.exceptions.ClusterSnapshotNotFoundFault:
+        return None
+
+
+def final_snapshots(redshift: object, snapshot_identifier: str):
+    """
+    Lists the final snapshots taken under a SNAPSHOT_IDENTIFIER, i.e. named either
+     snapshot_identifier or snapshot_identifier-<YYYYmmddHHMMSS>, oldest first.
+
+    Args
+     redshift (object): boto3 redshift client
+     snapshot_identifier (string): base snapshot identifier
+
+    Returns
+     list: snapshot identifiers ordered by creation time
+    """
+
+    pattern = re.compile(re.escape(snapshot_identifier) + r"(-\d{14})?")
+    snapshots = [
+        snapshot
+        for page in redshift.get_paginator("describe_cluster_snapshots").paginate(SnapshotType="manual")
+        for snapshot in page["Snapshots"]
+        if pattern.fullmatch(snapshot["SnapshotIdentifier"])
+    ]
+
+    return [snapshot["SnapshotIdentifier"] for snapshot in sorted(snapshots, key=lambda snapshot: snapshot["SnapshotCreateTime"])]